@@ -0,0 +1,167 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : One camera of many. Each camera has its own capture thread and face detection stage, and they all send their
+faces to the same AppLoopFaceCheck (made with cameras = the number of cameras), so the gallery is only loaded once.
+Follow the class below for flow.
+
+'''
+import cv2
+import frame_capture
+import face_detection
+
+'''
+    class CameraPipeline :
+    Opens a video source (device index, video file or image directory, see frame_capture.open_source) as camera id
+    camera. open starts reading frames, start_detection starts a detection stage feeding our shared recognizer. The recognizer tags the faces it finds with our camera id.
+'''
+class CameraPipeline:
+    def __init__(self, camera, source, name = None):
+        self.camera = camera #our camera id (0 to cameras - 1 of the recognizer)
+        self.source = source #device index, video file or image directory
+        self.still_images = False #True if our source is an image directory (every image is a new scene)
+        self.name = name if name else 'Camera ' + str(camera)
+        self.cap = None #our cv2.VideoCapture
+        self.capture_thread = None #reads our frames (see frame_capture.py)
+        self.detection_stage = None #finds the faces in our frames
+        self.frame_sequence = -1 #sequence number of the last frame latest_frame returned
+
+    '''
+        open :
+        Opens our source and starts reading frames (waiting a little for the first one). Returns False if it could not be opened.
+    '''
+    def open(self):
+        self.cap, frame_rate = frame_capture.open_source(self.source)
+
+        if not self.cap.isOpened():
+            self.cap.release()
+            self.cap = None
+            return False
+
+        self.still_images = isinstance(self.cap, frame_capture.ImageDirectoryCapture)
+        self.capture_thread = frame_capture.CaptureThread(self.cap, name=self.name, frame_rate=frame_rate)
+        self.capture_thread.start()
+
+        #so our frame size (which our frame slots are sized from) is from a frame we captured, not what the source says
+        self.capture_thread.wait_for_frame(face_detection.FIRST_FRAME_TIMEOUT)
+
+        return True
+
+    '''
+        is_open :
+        Returns True while our source is giving us frames (False once a video file or image directory has ended).
+    '''
+    def is_open(self):
+        return self.capture_thread is not None and not self.capture_thread.failed
+
+    '''
+        get_frame_dimensions :
+        Returns (width, height) of frames from our source. (0, 0) if we do not know.
+    '''
+    def get_frame_dimensions(self):
+        #our capture thread knows once it has a frame, and the source is busy reading on that thread
+        if self.capture_thread is not None and self.capture_thread.frame_shape is not None:
+            height, width = self.capture_thread.frame_shape[:2]
+            return width, height
+
+        if self.cap is None:
+            return 0, 0
+
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    '''
+        get_frame_size :
+        Returns the bytes of a full frame from our source. None if we do not know.
+    '''
+    def get_frame_size(self):
+        width, height = self.get_frame_dimensions()
+
+        if width <= 0 or height <= 0:
+            return None
+
+        return width * height * 3
+
+    '''
+        get_small_frame_size :
+        Returns the bytes of the half size frame detection sends to facial recognition. None if we do not know.
+    '''
+    def get_small_frame_size(self):
+        width, height = self.get_frame_dimensions()
+
+        if width <= 0 or height <= 0:
+            return None
+
+        #cv2.resize rounds, so leave room for 1 extra pixel each way
+        return (width // 2 + 1) * (height // 2 + 1) * 3
+
+    '''
+        start_detection :
+        Starts a detection stage on our frames, sending faces to recognizer (an AppLoopFaceCheck with room for our camera id).
+        Other keywords go to the DetectionStage. Images from an image directory are not tracked, faces are found and
+        recognized in each one.
+    '''
+    def start_detection(self, recognizer, **kwargs):
+        if self.still_images:
+            kwargs.setdefault('keyframe_interval', 1)
+            kwargs.setdefault('motion_gate', False)
+            kwargs.setdefault('recheck_seconds', 0)
+
+        self.detection_stage = face_detection.DetectionStage(recognizer, self.get_frame_size(), camera=self.camera, **kwargs)
+        self.detection_stage.start()
+        self.detection_stage.feed_from(self.capture_thread)
+
+    '''
+        stop_detection :
+        Stops our detection stage, if we have one.
+    '''
+    def stop_detection(self):
+        if self.detection_stage is not None:
+            self.detection_stage.stop()
+            self.detection_stage = None
+
+    '''
+        latest_frame :
+        Returns (copy of our newest frame, its timestamp), or (None, None) if there is no new one since we last asked.
+    '''
+    def latest_frame(self):
+        frame, sequence, timestamp = self.capture_thread.latest(after=self.frame_sequence)
+
+        if frame is not None:
+            self.frame_sequence = sequence
+
+        return frame, timestamp
+
+    '''
+        latest_result :
+        Returns the newest DetectionResult from our detection stage (None if we have none yet).
+    '''
+    def latest_result(self):
+        if self.detection_stage is None:
+            return None
+
+        return self.detection_stage.latest_result()
+
+    '''
+        confirm_identities :
+        Sends the faces recognition found on our camera back to our detection stage (see DetectionStage.confirm_identities).
+    '''
+    def confirm_identities(self, faces_data):
+        if self.detection_stage is not None:
+            self.detection_stage.confirm_identities(faces_data)
+
+    '''
+        close :
+        Stops detection, stops reading frames and releases our source.
+    '''
+    def close(self):
+        self.stop_detection()
+
+        if self.capture_thread is not None:
+            self.capture_thread.stop()
+            self.capture_thread = None
+
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
@@ -7,29 +7,56 @@ Purpose : Used to handle facial recognition. This is used with multiprocessing,
 Follow the functions below for flow.
 
 '''
+import sys
 import time
 import os
 from os.path import exists as file_exists
 import cv2
 import face_recognition
+import dlib
 import multiprocessing
 import uuid
 import numpy as np
 import math
 import pandas as pd
 import copy
+import json
+import io
+import queue
 from datetime import datetime
 import datetime
+import face_gallery
+import frame_ring
+import job_mailbox
+import sighting_log
 
 MAX_LINE_SIZE = 3
 
+MAX_RECOGNITION_WORKERS = 4 #most recognition worker processes AppLoopFaceCheck starts by default
+ENCODE_BATCH_SIZE = 4 #most jobs a worker encodes together in one batch (1 encodes each frame on its own)
+ENCODE_BATCH_WAIT = 0.005 #seconds a worker waits for more jobs to fill a batch, after it gets the first one
+FAIR_POLL_WAIT = 0.002 #seconds a worker sleeps between checks of the camera mailboxes, when there is more than one camera
+CROP_MARGIN = 0.5 #face crops we send to recognition are grown by this part of the face size each way (landmarks can reach past the box)
+MAX_FACE_TEMPLATES = 5 #most encodings (templates) we keep per person. More images than this are reduced with k-means. None keeps all
+
+#encoding cache files, stored in our face data directory
+ENCODING_CACHE_FILE = 'encodings_cache.npy' #encodings as one array (loaded memory mapped)
+ENCODING_MANIFEST_FILE = 'encodings_manifest.json' #which UUID and image each row is for
+ENCODING_MANIFEST_LOG_SUFFIX = '.log' #manifest entries appended since the manifest was last saved (see EncodingCache.append)
+ENCODING_CACHE_VERSION = 1
+
 '''
     class FaceData :
     Will store information on the person face.
 '''  
 class FaceData:
-    def __init__(self, id = None, image = None, encoder = None, name = "Unknown", description = None, location = None, frame = None, confidence = None, date_time = None):
+    def __init__(self, id = None, image = None, encoder = None, name = "Unknown", description = None, location = None, frame = None, confidence = None, date_time = None, track_id = None, distance = None, margin = None, capture_time = None, camera = 0):
         self.id = id
+        self.camera = camera #id of the camera this face was seen on
+        self.track_id = track_id #id of the face track (from face detection) this face was found on
+        self.distance = distance #distance to the best match
+        self.margin = margin #how much further the second best person is (small means we could have the wrong person)
+        self.capture_time = capture_time #time.perf_counter() when the frame this face was found in was captured
         self.image = image
         self.encoder = encoder
         self.name = name
@@ -75,31 +102,142 @@ class FaceData:
             self.frame = frame
             self.location = location
 
+'''
+    batch_face_encodings :
+    Encodes the faces in a list of RGB images (locations is the list of face locations in each image). Landmarks are found
+    for every face, then every aligned face chip goes through the face encoder in one batch. Returns a list of encodings
+    for each image, the same as calling face_recognition.face_encodings on each image.
+    The batch path uses face_recognition 1.3.0 internals (api._raw_face_landmarks and api.face_encoder). If they are
+    missing or changed, each image is encoded on its own with face_recognition.face_encodings.
+'''
+def batch_face_encodings(images, locations):
+    api = getattr(face_recognition, 'api', None)
+
+    #no batch encoder to use, encode each image on its own
+    if api is None or not hasattr(api, 'face_encoder') or not hasattr(api, '_raw_face_landmarks'):
+        return image_face_encodings(images, locations)
+
+    chips = []
+    counts = []
+
+    try:
+        for image, image_locations in zip(images, locations):
+            #same landmarks and chips face_recognition.face_encodings uses (5 point model, 150 pixels, 0.25 padding)
+            landmarks = api._raw_face_landmarks(image, image_locations, 'small')
+            chips.extend(dlib.get_face_chip(image, landmark, size=150, padding=0.25) for landmark in landmarks)
+            counts.append(len(landmarks))
+
+        descriptors = api.face_encoder.compute_face_descriptor(chips, 1) if chips else []
+    except (AttributeError, TypeError):
+        #the internals we use are not what face_recognition 1.3.0 has
+        return image_face_encodings(images, locations)
+
+    encodings = [np.array(descriptor) for descriptor in descriptors]
+
+    #split them back up by image
+    results = []
+    start = 0
+    for count in counts:
+        results.append(encodings[start:start + count])
+        start += count
+
+    return results
+
+'''
+    image_face_encodings :
+    Encodes the faces in each image on its own, with face_recognition.face_encodings (the same list batch_face_encodings returns).
+'''
+def image_face_encodings(images, locations):
+    return [face_recognition.face_encodings(image, image_locations) for image, image_locations in zip(images, locations)]
+
+'''
+    pack_face_crops :
+    Cuts each face (grown by margin) out of a frame and packs the crops one after another into a single buffer.
+    Returns (buffer, crops, crop_locations). crops is (offset, shape) of each crop in the buffer and crop_locations
+    is each face location moved into its crop.
+'''
+def pack_face_crops(frame, locations, margin = CROP_MARGIN):
+    height, width = frame.shape[:2]
+    boxes = []
+
+    for (top, right, bottom, left) in locations:
+        grow_y = int((bottom - top) * margin)
+        grow_x = int((right - left) * margin)
+        boxes.append((max(top - grow_y, 0), min(right + grow_x, width), min(bottom + grow_y, height), max(left - grow_x, 0)))
+
+    sizes = [(bottom - top) * (right - left) * frame.shape[2] for (top, right, bottom, left) in boxes]
+    buffer = np.empty(sum(sizes), dtype=frame.dtype)
+    crops = []
+    crop_locations = []
+    offset = 0
+
+    for (top, right, bottom, left), (crop_top, crop_right, crop_bottom, crop_left), size in zip(locations, boxes, sizes):
+        shape = (crop_bottom - crop_top, crop_right - crop_left, frame.shape[2])
+        buffer[offset:offset + size].reshape(shape)[...] = frame[crop_top:crop_bottom, crop_left:crop_right]
+        crops.append((offset, shape))
+        crop_locations.append((top - crop_top, right - crop_left, bottom - crop_top, left - crop_left))
+        offset += size
+
+    return buffer, crops, crop_locations
+
 '''
     class AppLoopFaceCheck :
     This is used for our multiprocessing, to handle all face data.
 '''  
 class AppLoopFaceCheck:
 
-    def __init__(self, in_queue, out_queue, faceencodings, facenames, faceimages, facedescriptions, uids):
+    def __init__(self, in_queue, out_queue, faceencodings, facenames, faceimages, facedescriptions, uids, gallery_index = None, workers = None, frame_slot_size = None, crop_faces = True, batch_size = ENCODE_BATCH_SIZE, batch_wait = ENCODE_BATCH_WAIT, cameras = 1):
         self.cpu_cores = multiprocessing.cpu_count() #number of cpus to use
         self.app_timer = time.perf_counter() #checks our time
         self.run_app = True #lets us know to run main loop
-        self.data_in_queue = in_queue #data coming in to process
+        self.data_in_queue = in_queue if in_queue is not None else job_mailbox.JobMailbox() #data coming in to process (a bounded JobMailbox)
         self.data_out_queue = out_queue #data we processed and send out
-        self.app_loop_process = multiprocessing.Process(target=self.app_loop) #main loop for facial rec
-        self.face_encodings = faceencodings #known face encodings
+        #number of worker processes. Leave a core for our video and GUI
+        self.worker_count = workers if workers else max(1, min(self.cpu_cores - 1, MAX_RECOGNITION_WORKERS))
+        self.worker_busy_time = multiprocessing.Array('d', self.worker_count) #seconds each worker spent checking faces
+        self.worker_jobs = multiprocessing.Array('i', self.worker_count) #number of jobs each worker handled
+        self.worker_batches = multiprocessing.Array('i', self.worker_count) #number of batches each worker encoded
+        self.batch_size = max(1, batch_size) #most jobs encoded together
+        self.batch_wait = batch_wait #seconds to wait for a batch to fill
+        self.camera_count = max(1, cameras) #cameras sending us jobs, each has its own mailbox and frame ring
+        self.next_sequence = [0] * self.camera_count #sequence number of the next job we submit, for each camera
+        self.next_result_sequence = [0] * self.camera_count #sequence number of the next result we hand out, for each camera
+        self.reorder_buffer = {} #results that came back before an earlier job finished ((camera, sequence) -> (faces data, capture time))
+        self.result_latency = None #seconds from capture to when we handed out our newest result (how stale recognition is)
+        self.camera_latency = [None] * self.camera_count #result_latency for each camera
+        self.next_camera = 0 #camera mailbox our worker takes from next (see get_fair_jobs)
+        #every camera gets its own mailbox (like our in queue), so a busy camera only drops its own jobs
+        self.camera_mailboxes = [self.data_in_queue] + [job_mailbox.JobMailbox(self.data_in_queue.capacity, self.data_in_queue.policy, self.data_in_queue.timeout) for _ in range(self.camera_count - 1)]
+        #frames go to our workers through shared memory, only the slot reference goes through the in queue.
+        #each worker can hold a full batch while the next jobs wait. Each camera has its own ring
+        self.frame_rings = [frame_ring.FrameRing(max(frame_ring.DEFAULT_SLOT_COUNT, self.worker_count * (self.batch_size + 1)), frame_slot_size if frame_slot_size else frame_ring.DEFAULT_SLOT_SIZE) for _ in range(self.camera_count)]
+        self.frame_ring = self.frame_rings[0] #frame ring of our first camera
+        self.crop_faces = crop_faces #send only the face crops to our workers, not the whole frame
+        self.bytes_submitted = multiprocessing.Value('q', 0) #bytes of frames (or crops) we copied into the frame ring
+        self.face_encodings = faceencodings #known face encodings (templates for each person)
+        #known face encodings index, for matching (keys are UUIDs, each person can have a few templates). Build one if not sent in
+        self.gallery_matcher = gallery_index if gallery_index is not None else face_gallery.create_gallery_index(*face_gallery.flatten_templates(faceencodings, uids))
         self.face_names = facenames #encoding names
         self.face_images = faceimages
         self.face_descriptions = facedescriptions
         self.unique_ids = uids
-        self.current_face_locations = 0 #set default to 0
+        #UUID -> (name, image, description), so we can find a match without searching our lists
+        self.known_people = {uid: (name, image, description) for uid, name, image, description in zip(uids, facenames, faceimages, facedescriptions)}
+        self.gallery_queues = [multiprocessing.Queue() for _ in range(self.worker_count)] #people added or removed while we are running (one per worker)
         #self.current_face_names = [] #our current face names detected
-        self.last_time_check = time.perf_counter() #keeps track of the last time we checked face matches
-        self.LAST_TIME_CHECK_RECHECK = 3 #we will recheck our time every this many seconds, no matter what
         self.current_faces_data = [] #list of all current FaceData we have
         self.previous_faces_data = []
-        
+        #main loops for facial rec, all pulling jobs from our in queue
+        self.app_loop_processes = [multiprocessing.Process(target=self.app_loop, args=(worker,)) for worker in range(self.worker_count)]
+
+    '''
+        __getstate__ :
+        Our worker processes get a copy of this class. Do not send the process handles with it.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('app_loop_processes', None)
+        return state
 
 
     '''
@@ -150,107 +288,381 @@ class AppLoopFaceCheck:
 
         return id   
 
+    '''
+        add_person :
+        Sends a new known person (and their templates) to our running loop. It is added to the gallery without stopping recognition.
+    '''  
+    def add_person(self, uid, templates, name, image, description):
+        for gallery_queue in self.gallery_queues:
+            gallery_queue.put(('add', uid, templates, name, image, description))
+
+    '''
+        remove_person :
+        Sends a removed person to our running loop. It is removed from the gallery without stopping recognition.
+    '''  
+    def remove_person(self, uid):
+        for gallery_queue in self.gallery_queues:
+            gallery_queue.put(('remove', uid))
+
+    '''
+        update_gallery :
+        Runs in our loop. Adds and removes the people sent in by add_person and remove_person.
+    '''  
+    def update_gallery(self, worker):
+        while not self.gallery_queues[worker].empty():
+            update = self.gallery_queues[worker].get()
+
+            if update[0] == 'add':
+                action, uid, templates, name, image, description = update
+
+                #replace them if we already have them
+                if uid in self.gallery_matcher:
+                    self.gallery_matcher.remove(uid)
+
+                for template in templates:
+                    self.gallery_matcher.add(template, uid)
+                self.known_people[uid] = (name, image, description)
+            elif update[0] == 'remove':
+                action, uid = update
+
+                if uid in self.gallery_matcher:
+                    self.gallery_matcher.remove(uid)
+
+                self.known_people.pop(uid, None)
+
+    '''
+        submit :
+        Sends a frame and its face locations to our workers. With crop_faces only the faces (with a margin) are packed into
+        our shared memory frame ring, otherwise the whole frame is copied. Only the slot reference and the locations go
+        through the queue. Each job gets a sequence number, so get_results can hand the results back in the order we
+        captured them. track_ids (one per location) are attached to the faces found, capture_time is used for our latency.
+        camera is the id of the camera the frame came from (0 to cameras - 1), it uses that camera's mailbox and frame ring.
+        If our mailbox is full, jobs are dropped by its policy (their results come back as skipped).
+        Returns False if every slot is busy and the frame was dropped, or our mailbox dropped it.
+    '''  
+    def submit(self, locations, small_frame, track_ids = None, capture_time = None, camera = 0):
+        locations = list(locations)
+        mailbox = self.camera_mailboxes[camera]
+        ring = self.frame_rings[camera]
+        crops = None
+        crop_locations = None
+        reference = None
+
+        #no faces, nothing to copy. The job is still sent (workers skip it, and get_results drops it), so it keeps its
+        #sequence number in this camera's order for the reorder buffer
+        if len(locations) > 0:
+            data = small_frame
+
+            if self.crop_faces or small_frame.nbytes > ring.slot_size:
+                buffer, crops, crop_locations = pack_face_crops(small_frame, locations)
+
+                #send the crops, unless faces cover most of the frame (then send it whole, if it fits)
+                if buffer.nbytes <= ring.slot_size and (buffer.nbytes <= small_frame.nbytes or small_frame.nbytes > ring.slot_size):
+                    data = buffer
+                else:
+                    crops = crop_locations = None
+
+            #too big for our frame ring (detection can use frames bigger than we were sized for)
+            if data.nbytes > ring.slot_size:
+                with ring.dropped.get_lock():
+                    ring.dropped.value += 1
+                return False
+
+            reference = ring.write(data, count_dropped=False)
+
+            #every slot is in use. Unless our mailbox waits for room, make room by dropping the oldest job waiting
+            if reference is None and mailbox.policy != job_mailbox.BLOCK:
+                for dropped_job in mailbox.drop_oldest():
+                    self.job_done(dropped_job, None)
+                reference = ring.write(data, count_dropped=False)
+
+            if reference is None:
+                with ring.dropped.get_lock():
+                    ring.dropped.value += 1
+                return False
+
+            with self.bytes_submitted.get_lock():
+                self.bytes_submitted.value += data.nbytes
+
+        job = (self.next_sequence[camera], locations, reference, track_ids, crops, crop_locations, time.perf_counter() if capture_time is None else capture_time, camera)
+        self.next_sequence[camera] += 1
+
+        accepted, dropped = mailbox.put(job)
+
+        #let the frames of dropped jobs go, and tell get_results they are done
+        for dropped_job in dropped:
+            self.job_done(dropped_job, None)
+
+        return accepted
+
+    '''
+        job_done :
+        Releases a job's frame (if it has one) and sends back its faces data (None if it was skipped or dropped).
+    '''  
+    def job_done(self, job, faces_data, release = True):
+        if release and job[2] is not None:
+            self.frame_rings[job[7]].release(job[2])
+
+        self.data_out_queue.put((job[7], job[0], faces_data, job[6]))
+
+    '''
+        get_results :
+        Returns the list of faces data for each job that finished, in the order they were submitted (for each camera, the
+        FaceData camera says which). Results that finish early wait in our reorder buffer, until the jobs before them from
+        the same camera are done. Skipped (and dropped) jobs are not returned. With sequences True, each result is
+        (camera, sequence, faces data), so it can be matched to the job submit sent.
+        Updates result_latency (and camera_latency), from when the frame of our newest result was captured.
+    '''  
+    def get_results(self, sequences = False):
+        results = []
+
+        #get everything our workers finished
+        while not self.data_out_queue.empty():
+            camera, sequence, faces_data, capture_time = self.data_out_queue.get()
+            self.reorder_buffer[(camera, sequence)] = (faces_data, capture_time)
+
+        #hand out results in order for each camera, until we hit a job that is not done yet
+        for camera in range(self.camera_count):
+            while (camera, self.next_result_sequence[camera]) in self.reorder_buffer:
+                sequence = self.next_result_sequence[camera]
+                faces_data, capture_time = self.reorder_buffer.pop((camera, sequence))
+                self.next_result_sequence[camera] += 1
+                self.result_latency = self.camera_latency[camera] = time.perf_counter() - capture_time
+
+                if faces_data is not None:
+                    results.append((camera, sequence, faces_data) if sequences else faces_data)
+
+        return results
+
+    '''
+        utilisation :
+        Returns how busy each worker has been since we started (0.0 to 1.0) and how many jobs each one handled.
+    '''  
+    def utilisation(self):
+        elapsed = max(time.perf_counter() - self.app_timer, 1e-9)
+        return [busy / elapsed for busy in self.worker_busy_time[:]], self.worker_jobs[:]
+
     '''
         app_loop :
-        The main loop of the multiprocess.
+        The main loop of each worker process. Gets a batch of jobs from our in queue (up to batch_size, waiting at most
+        batch_wait for it to fill), encodes all their faces together and sends back (sequence, faces data) for each job.
+        Faces data is None if the job was skipped, so the reorder buffer knows the job is done.
     '''  
-    def app_loop(self):
+    def app_loop(self, worker = 0):
         #run while app active
         while self.run_app:
-            #go through data for in queue if any available
-            while not self.data_in_queue.empty():
+            #add or remove any known people that changed
+            self.update_gallery(worker)
+
+            #wait a little for a job, so we can still check for gallery changes
+            jobs = self.get_batch()
+            if not jobs:
+                continue
+
+            starttime = time.perf_counter()
+
+            #get our frames (or crops) from shared memory (None if their slot was reused) and let the slots go when done
+            frames = [self.frame_rings[job[7]].read(job[2]) if job[2] is not None else None for job in jobs]
+            try:
+                batch_faces_data = self.check_faces_batch([(locations, frame, track_ids, crops, crop_locations) for (sequence, locations, reference, track_ids, crops, crop_locations, capture_time, camera), frame in zip(jobs, frames)])
+            except Exception as e:
+                #a bad crop (or a dlib error) only loses this batch. Its jobs are still sent back as skipped, so the reorder
+                #buffer does not wait on them and this worker keeps running
+                print('Error checking faces (worker ' + str(worker) + ') : ' + repr(e))
+                batch_faces_data = [None] * len(jobs)
+            finally:
+                frames = None
+                for job in jobs:
+                    if job[2] is not None:
+                        self.frame_rings[job[7]].release(job[2])
+
+            #send out our new face data
+            for job, faces_data in zip(jobs, batch_faces_data):
+                for face in faces_data or []:
+                    face.capture_time = job[6]
+                    face.camera = job[7]
+                self.job_done(job, faces_data, release=False)
+
+            #update our utilisation counters
+            self.worker_busy_time[worker] += time.perf_counter() - starttime
+            self.worker_jobs[worker] += len(jobs)
+            self.worker_batches[worker] += 1
 
-                starttime = time.perf_counter()
+    '''
+        get_batch :
+        Returns up to batch_size jobs from our in queue. Waits up to 0.05 seconds for the first one, then up to
+        batch_wait for the rest (jobs already waiting are always taken). Returns an empty list if no job came.
+        With more than one camera, jobs are taken from the camera mailboxes in turn (see get_fair_jobs).
+    '''  
+    def get_batch(self):
+        if self.camera_count > 1:
+            jobs = self.get_fair_jobs(self.batch_size, 0.05)
+            if jobs:
+                jobs.extend(self.get_fair_jobs(self.batch_size - len(jobs), self.batch_wait))
+            return jobs
+
+        try:
+            jobs = [self.data_in_queue.get(timeout=0.05)]
+        except queue.Empty:
+            return []
+
+        deadline = time.perf_counter() + self.batch_wait
+
+        while len(jobs) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                jobs.append(self.data_in_queue.get(timeout=remaining) if remaining > 0 else self.data_in_queue.get_nowait())
+            except queue.Empty:
+                break
 
-                #get our tuple data of (locations, small_frame)
-                locations, small_frame = self.data_in_queue.get()
+        return jobs
 
-                #make sure we have locations to use, else skip to next iteration of the while queue loop
-                if(len(locations) == 0):
-                    self.current_face_locations = len(locations)
-                    continue
+    '''
+        get_fair_jobs :
+        Returns up to count jobs from our camera mailboxes, taking one from each camera in turn (starting after the camera
+        we took from last), so a busy camera can not starve the others. Waits up to timeout for the first one.
+    '''  
+    def get_fair_jobs(self, count, timeout):
+        jobs = []
+        deadline = time.perf_counter() + timeout
+
+        while count > 0:
+            empty = 0
+
+            #go around the cameras until we have enough, or every mailbox was empty
+            while len(jobs) < count and empty < self.camera_count:
+                self.next_camera = (self.next_camera + 1) % self.camera_count
+                try:
+                    jobs.append(self.camera_mailboxes[self.next_camera].get_nowait())
+                    empty = 0
+                except queue.Empty:
+                    empty += 1
+
+            if jobs or time.perf_counter() >= deadline:
+                break
 
-                #if we have no face encodings, just continue to next loop
-                if len(self.face_encodings) == 0:
-                    continue
-                
-                find = lambda searchList, elem: [i for i, x in enumerate(searchList) if x in elem]
+            time.sleep(FAIR_POLL_WAIT)
 
-                #if we have the same locations and our current face names are all known
-                #and we havent exceeded our check time variable, then skip this loop with continue
-                #if(len(locations) == self.current_face_locations and len(find(self.current_face_names, 'Unknown'))  == 0 and abs(time.perf_counter() - self.last_time_check) < self.LAST_TIME_CHECK_RECHECK):
-                if(len(locations) == self.current_face_locations and self.find_faces_data_name('Unknown') and abs(time.perf_counter() - self.last_time_check) < self.LAST_TIME_CHECK_RECHECK):
-                    #if we have same face count, all names are known and we arent over our time check amount, then just continue in loop
-                    continue
+        return jobs
 
-                
-                #print('app_loop checking faces')
-                #update variables
-                self.current_face_locations = len(locations)
-                self.last_time_check = time.perf_counter()
+    '''
+        mailbox_stats :
+        Returns the stats of each camera mailbox (see JobMailbox.stats).
+    '''  
+    def mailbox_stats(self):
+        return [mailbox.stats() for mailbox in self.camera_mailboxes]
 
-                encodings = face_recognition.face_encodings(cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB), locations)
+    '''
+        frames_dropped :
+        Returns the frames dropped because every slot of their camera's frame ring was in use.
+    '''  
+    def frames_dropped(self):
+        return sum(ring.dropped.value for ring in self.frame_rings)
 
-                #encodings = face_recognition.face_encodings(cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB), face_locations)
+    '''
+        check_faces :
+        Encodes the faces at these locations and matches them against our known people. Returns a list of FaceData,
+        or None if we skipped this frame. If crops are sent, small_frame is the packed crops buffer (see pack_face_crops).
+    '''  
+    def check_faces(self, locations, small_frame, track_ids = None, crops = None, crop_locations = None):
+        return self.check_faces_batch([(locations, small_frame, track_ids, crops, crop_locations)])[0]
 
-                ##face_encodings = copy.deepcopy(encodings)
+    '''
+        check_faces_batch :
+        check_faces for a list of jobs (locations, small_frame, track_ids, crops, crop_locations). Every face in every
+        job is encoded in one batch and matched in one call. Returns the faces data (or None) for each job.
+    '''  
+    def check_faces_batch(self, jobs):
+        batch_faces_data = [None] * len(jobs)
 
-                #names = []
-                #confidences = []
-                new_faces_data = []
+        #if we have no face encodings, just skip these frames
+        if len(self.gallery_matcher) == 0:
+            return batch_faces_data
 
-                #go through each face encoding to see if we have a match
-                for encoding in encodings:
-                    results = face_recognition.compare_faces(self.face_encodings, encoding)
-                    #results = face_recognition.compare_faces(self.face_encodings, encoding, tolerance=0.4)
-                    name = "Unknown"
-                    confidence = 'Not Known'
-                    image = None
-                    description = ''
+        #we do not skip faces here. Face detection only sends the faces whose identity needs checking (see IdentityCache)
+        #make sure we have locations to use (and the frame), else skip that frame
+        checked = [i for i, (locations, small_frame, track_ids, crops, crop_locations) in enumerate(jobs) if len(locations) > 0 and small_frame is not None]
 
-                    #best_match_index = np.argmin(results)
+        images = []
+        image_locations = []
+        for i in checked:
+            for image, locations in self.job_face_images(*jobs[i][:2], *jobs[i][3:]):
+                images.append(image)
+                image_locations.append(locations)
 
-                    face_distances = face_recognition.face_distance(self.face_encodings, encoding)
-                    best_match_index = np.argmin(face_distances)
+        encodings = [encoding for image_encodings in batch_face_encodings(images, image_locations) for encoding in image_encodings]
 
-                    #if best_match_index >=0 and best_match_index < len(self.face_names):
-                    if results[best_match_index]:
-                        name = self.face_names[best_match_index]
-                        #name + ' ' + self.face_confidence(face_distances[best_match_index])
-                        confidence = self.face_confidence(face_distances[best_match_index])
-                        image = self.face_images[best_match_index]
-                        description = self.face_descriptions[best_match_index]
+        if not encodings:
+            return batch_faces_data
 
-                    #lets get our unique ID
-                    id = self.get_unique_id(name)
+        #match every face encoding against every known face in one call, the 2 best people so we know how sure we are
+        match_keys, match_distances = self.gallery_matcher.query(encodings, 2)
+        margins = match_distances[:, 1] - match_distances[:, 0]
+        matches = match_distances[:, 0] <= self.gallery_matcher.tolerance
 
-                    #get datetime
-                    current_time = datetime.datetime.now()                   
+        #split our results back up by job
+        start = 0
+        for i in checked:
+            locations, small_frame, track_ids, crops, crop_locations = jobs[i]
+            end = start + len(locations)
+            if track_ids is None:
+                track_ids = [None] * len(locations)
 
-                    #create our FaceData
-                    fd = FaceData(id=id, name=name, description=description, date_time = current_time, image=image, confidence=confidence, encoder=encoding, frame=small_frame)                    
+            batch_faces_data[i] = self.create_faces_data(locations, track_ids, encodings[start:end], match_keys[start:end, 0], match_distances[start:end, 0], margins[start:end], matches[start:end])
+            start = end
 
-                    new_faces_data.append(fd)
-                    #names.append(name)
-                    #confidences.append(confidence)
-                    
-                    #names.append(f'{name} ({confidence})')
+        #set our new faces_data
+        self.current_faces_data.clear()
+        self.current_faces_data = [face for faces_data in batch_faces_data if faces_data for face in faces_data]
+
+        return batch_faces_data
+
+    '''
+        create_faces_data :
+        Creates the FaceData for each face of a job, from its matches.
+    '''  
+    def create_faces_data(self, locations, track_ids, encodings, best_match_keys, best_distances, margins, matches):
+        new_faces_data = []
+
+        #go through each face encoding to see if we have a match
+        for location, track_id, encoding, best_match_key, best_distance, margin, match in zip(locations, track_ids, encodings, best_match_keys, best_distances, margins, matches):
+            name = "Unknown"
+            confidence = 'Not Known'
+            image = None
+            description = ''
+
+            if match:
+                name, image, description = self.known_people[best_match_key]
+                confidence = self.face_confidence(best_distance)
+
+            #lets get our unique ID (the best match key is the UUID of who we found)
+            id = best_match_key if match else self.create_unique_uuid4(name)
 
-                #send out our new face data
-                self.data_out_queue.put(new_faces_data)
-                #send our list of names to out queue
-                #self.data_out_queue.put((names, confidences))
+            #get datetime
+            current_time = datetime.datetime.now()                   
 
-                #set our new faces_data
-                self.current_faces_data.clear()
-                self.current_faces_data = new_faces_data.copy()
+            #create our FaceData (no frame, it is in shared memory and would be pickled back through the queue)
+            fd = FaceData(id=id, name=name, description=description, date_time = current_time, image=image, confidence=confidence, encoder=encoding, location=location, track_id=track_id, distance=float(best_distance), margin=float(margin))                    
 
-                #set our new names
-                #self.current_face_names.clear()
-                #self.current_face_names = names.copy()
+            new_faces_data.append(fd)
 
-                #starttime = abs(time.perf_counter() - starttime)
-                #print('app_loop Time : ' + str(starttime))
+        return new_faces_data
+
+    '''
+        job_face_images :
+        Returns a list of (RGB image, locations in it) to encode for a job. From crops, only the pixels of each crop are converted to RGB.
+    '''  
+    def job_face_images(self, locations, small_frame, crops = None, crop_locations = None):
+        if crops is None:
+            return [(cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB), locations)]
+
+        images = []
+        for (offset, shape), crop_location in zip(crops, crop_locations):
+            size = shape[0] * shape[1] * shape[2]
+            crop = small_frame[offset:offset + size].reshape(shape)
+            images.append((cv2.cvtColor(crop, cv2.COLOR_BGR2RGB), [crop_location]))
+
+        return images
 
     # https://www.youtube.com/watch?v=tl2eEBFEHqM
     '''
@@ -271,10 +683,13 @@ class AppLoopFaceCheck:
 
     '''
         start :
-        Starts main loop.
+        Starts main loop of each worker.
     '''  
     def start(self):
-        self.app_loop_process.start()
+        self.app_timer = time.perf_counter()
+
+        for app_loop_process in self.app_loop_processes:
+            app_loop_process.start()
 
     '''
         stop :
@@ -284,9 +699,21 @@ class AppLoopFaceCheck:
         #end our app loop and close it.
         #need to terminate, join (waits for it to end) and then close
         self.run_app = False
-        self.app_loop_process.terminate()
-        self.app_loop_process.join()
-        self.app_loop_process.close()
+
+        for app_loop_process in self.app_loop_processes:
+            app_loop_process.terminate()
+            app_loop_process.join()
+            app_loop_process.close()
+
+        for gallery_queue in self.gallery_queues:
+            gallery_queue.close()
+
+        #our first mailbox was sent in, the others are ours
+        for mailbox in self.camera_mailboxes[1:]:
+            mailbox.close()
+
+        for ring in self.frame_rings:
+            ring.close()
 
 '''
     check_face_data :
@@ -426,7 +853,7 @@ def create_unique_id(ids):
 
 '''
     load_face_data :
-    Load all of our data and return it (see top and end of function)
+    Load all of our data and return it (see top and end of function). Paths are the image file paths, in the same order as images.
 ''' 
 def load_face_data(data_dir):
 
@@ -438,6 +865,7 @@ def load_face_data(data_dir):
     labels = []
     descriptions = []
     ids = []
+    paths = []
 
     print('LOADING FACE DATA FILES : ')
 
@@ -448,79 +876,213 @@ def load_face_data(data_dir):
             directories.append(os.path.join(data_dir, filename))
 
     for directory in directories:
-        #get our first directory
-        #directory = os.path.join(data_dir, str(i))
-        print(directory)
-        temp_images = []
+        #load this persons images and name file
+        temp_images, label, description, uid, temp_paths = load_person_data(directory)
 
-        #now open the files in this directory
-        for filename in os.listdir(directory):
-            if not os.path.isdir(os.path.join(directory, filename)):
-                #temp_image = face_recognition.load_image_file(os.path.join(directory, filename))
-                #temp_images.append(temp_image)
+        #only add what we found
+        if label is not None:
+            labels.append(label)
+        if description is not None:
+            descriptions.append(description)
+        if uid is not None:
+            ids.append(uid)
 
-                temp_image = cv2.imread(os.path.join(directory, filename))
+        images.append(temp_images)    
+        paths.append(temp_paths)
 
-                #resize our image
-                scale_percent = 50
-                w = int(temp_image.shape[1] * scale_percent / 100)
-                h = int(temp_image.shape[0] * scale_percent / 100)
-                dim = (w,h)
-                temp_image = cv2.resize(temp_image, dim, interpolation = cv2.INTER_AREA)
+    #print('images ' + str(len(images)) + ', labels ' + str(len(labels)))
 
-                temp_images.append(temp_image)
-                #image = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-                
+    for label in labels:
+        index = labels.index(label)
+        labels[index] = label.rstrip()
 
-                #print(os.path.join(directory, filename))
-            elif os.path.join(directory, filename) == os.path.join(directory, 'Name'):
-                #print('NAME DIRECT')
-                #print(os.path.join(directory, filename))
+    return images, labels, descriptions, ids, paths
 
-                #get our directory and then get our text file (will always be name.txt)
-                name_direct = os.path.join(directory, filename)
-                name_exists = False
+'''
+    load_encode_face_data :
+    Same as load_face_data and encode_known_people together, but each persons directory is loaded (image decode) and encoded
+    (face detection and encoding) on a pool of processes. Results stream back in directory order, so everything lines up
+    like load_face_data. Images our EncodingCache has are not encoded again. Prints the throughput when done.
+    Returns images, labels, descriptions, ids, paths, encodings (templates of each person) and names.
+''' 
+def load_encode_face_data(data_dir, processes = None, max_templates = MAX_FACE_TEMPLATES):
 
-                #make sure txt file is there
-                for nameDirectFile in os.listdir(name_direct):
-                    
-                    #get the name of the file we are looking for and see if it exists
-                    file_direct = os.path.join(name_direct, 'name.txt')
-                    if os.path.join(name_direct, nameDirectFile) == file_direct:
+    #first check our face data and make sure there are no UUIDs to update (only once, before the pool starts)
+    check_face_data(data_dir)
 
-                        #open the file and read in the name
-                        with open(file_direct) as name_file:
-                            data = [line for line in name_file.readlines()]                            
+    #return data
+    images = []
+    labels = []
+    descriptions = []
+    ids = []
+    paths = []
+    face_encodings = []
+    face_names = []
 
-                            #name
-                            labels.append(data[0])
-                            name_exists = True
-                            print('label added : ' + data[0])
+    print('LOADING FACE DATA FILES : ')
 
-                            #description
-                            descriptions.append(data[1])
+    starttime = time.perf_counter()
 
-                            #UUID
-                            ids.append(data[2])
+    #get all of our directories to be used
+    directories = []
+    for filename in os.listdir(data_dir):
+        if os.path.isdir(os.path.join(data_dir, filename)):
+            directories.append(os.path.join(data_dir, filename))
+
+    #no point starting more processes than people
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, len(directories)))
 
-                        break
+    cache = EncodingCache(data_dir)
+    encoded = 0
+    image_count = 0
+
+    #with 1 process, just do it here. Else use a pool, imap gives us the results in order as they finish
+    if processes == 1:
+        init_enrolment_worker(data_dir, max_templates)
+        results = map(load_encode_person, directories)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=init_enrolment_worker, initargs=(data_dir, max_templates))
+        results = pool.imap(load_encode_person, directories, chunksize=max(1, len(directories) // (processes * 8)))
+
+    try:
+        for temp_images, label, description, uid, temp_paths, templates, image_encodings, was_encoded in results:
+            #only add what we found
+            if label is not None:
+                labels.append(label.rstrip())
+            if description is not None:
+                descriptions.append(description)
+            if uid is not None:
+                ids.append(uid)
+
+            images.append(temp_images)
+            paths.append(temp_paths)
+            image_count += len(temp_images)
+
+            if templates is not None:
+                face_encodings.append(templates)
+                face_names.append(label.rstrip())
+
+                #keep them in our cache
+                if uid is not None:
+                    for path, encoding in zip(temp_paths, image_encodings):
+                        cache.put(uid, path, encoding)
+
+                encoded += was_encoded
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    cache.save()
+
+    #report our throughput
+    totaltime = max(time.perf_counter() - starttime, 1e-9)
+    print('Enrolment : ' + str(len(directories)) + ' people, ' + str(image_count) + ' images, ' + str(encoded) + ' encoded, ' + 
+          str(sum(len(templates) for templates in face_encodings)) + ' templates, ' + str(processes) + ' processes, ' + format(totaltime, '.2f') + ' s (' + 
+          format(len(directories) / totaltime, '.1f') + ' people/s, ' + format(image_count / totaltime, '.1f') + ' images/s)')
+
+    return images, labels, descriptions, ids, paths, face_encodings, face_names
+
+'''
+    init_enrolment_worker :
+    Runs once in each enrolment process. Loads our encoding cache, so workers can skip images we already encoded.
+''' 
+def init_enrolment_worker(data_dir, max_templates = MAX_FACE_TEMPLATES):
+    global enrolment_cache, enrolment_max_templates
+    enrolment_cache = EncodingCache(data_dir)
+    enrolment_max_templates = max_templates
+
+'''
+    load_encode_person :
+    Runs in an enrolment process. Loads one persons directory and encodes their images that are not in our cache.
+    Returns what load_person_data does, plus their templates (None if they have no name), the encoding of each image
+    and how many images we had to encode.
+''' 
+def load_encode_person(directory):
+    temp_images, label, description, uid, temp_paths = load_person_data(directory)
+    templates = None
+    image_encodings = []
+    was_encoded = 0
+
+    if label is not None:
+        templates, image_encodings, was_encoded = encode_person_images(temp_images, uid, temp_paths, enrolment_cache, enrolment_max_templates)
+
+    return temp_images, label, description, uid, temp_paths, templates, image_encodings, was_encoded
+
+'''
+    load_person_data :
+    Loads one persons directory. Returns their images, name, description, UUID and image paths.
+    Name is None if they have no Name directory and 'unknown person' if it has no name.txt. Description and UUID are None if not found.
+''' 
+def load_person_data(directory):
+    print(directory)
+    temp_images = []
+    temp_paths = []
+    label = None
+    description = None
+    uid = None
+
+    #now open the files in this directory
+    for filename in os.listdir(directory):
+        if not os.path.isdir(os.path.join(directory, filename)):
+            #temp_image = face_recognition.load_image_file(os.path.join(directory, filename))
+            #temp_images.append(temp_image)
+
+            temp_image = cv2.imread(os.path.join(directory, filename))
+
+            #resize our image
+            scale_percent = 50
+            w = int(temp_image.shape[1] * scale_percent / 100)
+            h = int(temp_image.shape[0] * scale_percent / 100)
+            dim = (w,h)
+            temp_image = cv2.resize(temp_image, dim, interpolation = cv2.INTER_AREA)
+
+            temp_images.append(temp_image)
+            temp_paths.append(os.path.join(directory, filename))
+            #image = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+            
+
+            #print(os.path.join(directory, filename))
+        elif os.path.join(directory, filename) == os.path.join(directory, 'Name'):
+            #print('NAME DIRECT')
+            #print(os.path.join(directory, filename))
+
+            #get our directory and then get our text file (will always be name.txt)
+            name_direct = os.path.join(directory, filename)
+            name_exists = False
+
+            #make sure txt file is there
+            for nameDirectFile in os.listdir(name_direct):
                 
-                #if their name file doesnt exist, they are an unknown person
-                if not name_exists:
-                    labels.append('unknown person')
+                #get the name of the file we are looking for and see if it exists
+                file_direct = os.path.join(name_direct, 'name.txt')
+                if os.path.join(name_direct, nameDirectFile) == file_direct:
 
-        #directory = os.path.join(directory, 'Name')
-        #print(directory)
+                    #open the file and read in the name
+                    with open(file_direct) as name_file:
+                        data = [line for line in name_file.readlines()]                            
 
-        images.append(temp_images)    
+                        #name
+                        label = data[0]
+                        name_exists = True
+                        print('label added : ' + data[0])
 
-    #print('images ' + str(len(images)) + ', labels ' + str(len(labels)))
+                        #description
+                        description = data[1]
 
-    for label in labels:
-        index = labels.index(label)
-        labels[index] = label.rstrip()
+                        #UUID
+                        uid = data[2]
 
-    return images, labels, descriptions, ids
+                    break
+            
+            #if their name file doesnt exist, they are an unknown person
+            if not name_exists:
+                label = 'unknown person'
+
+    return temp_images, label, description, uid, temp_paths
 
 '''
     load_update_pandas_db :
@@ -550,6 +1112,21 @@ def load_update_pandas_db(filename1, filename2, labels, descriptions, ids, creat
 
         return df, df2
 
+'''
+    load_update_pandas_people :
+    Loads (or creates) and updates only our people database (file1), for when our sightings are saved somewhere else
+    (see sighting_archive.py).
+'''
+def load_update_pandas_people(filename1, labels, descriptions, ids) -> pd.DataFrame:
+    if not file_exists(filename1):
+        df, df2 = create_pandas_db(filename1, None, labels, descriptions, ids, True, False)
+        return df
+
+    df = pd.read_csv(filename1)
+    df.set_index(['UUID'], inplace=True)
+
+    return update_pandas_db(df, labels, descriptions, ids, filename1, None)
+
 '''
     create_pandas_db :
     Creates a pandas db if needed.
@@ -580,8 +1157,7 @@ def create_pandas_db(filename1, filename2, labels, descriptions, ids, createFile
 
     #if we need to create file 2
     if createFile2:
-        df2 = pd.DataFrame(list(zip([], [], [], [])), columns=['UUID', 'Arrival Time', 'Departure Time', 'Total Time'] ) 
-        df2.set_index(['UUID'], inplace=True)
+        df2 = sighting_log.rows_to_frame([])
         df2.to_csv(filename2)
     else:
         df2 = None
@@ -595,8 +1171,9 @@ def create_pandas_db(filename1, filename2, labels, descriptions, ids, createFile
 def load_pandas_db(filename1, filename2) -> tuple:
     df = pd.read_csv(filename1)
     df.set_index(['UUID'], inplace=True)
-    df2 = pd.read_csv(filename2)
-    df2.set_index(['UUID'], inplace=True)
+    #times are read as datetime64, total time and camera as int64. Sightings saved since our last compaction are in the
+    #log, people removed since then are left out (see sighting_log.py)
+    df2 = sighting_log.load_sightings(filename2)
 
     return df, df2
 
@@ -631,19 +1208,448 @@ def update_pandas_db(df1, labels, descriptions, ids, filename1, filename2) -> pd
 
     return df1
 
+'''
+    add_pandas_db_person :
+    Adds one person to our people database and appends their row to file1, without rewriting the file.
+''' 
+def add_pandas_db_person(df1, label, description, id, filename1) -> pd.DataFrame:
+    #create a dataframe with just this person
+    n_df1 = pd.DataFrame([[id.rstrip(), label.rstrip(), description.rstrip()]], columns=['UUID', 'Name', 'Description'])
+    n_df1.set_index(['UUID'], inplace=True)
+
+    #append the row to our file (write the header if the file is new)
+    n_df1.to_csv(filename1, mode='a', header=not file_exists(filename1))
+
+    return pd.concat([df1, n_df1])
+
+'''
+    add_pandas_db_sighting :
+    Adds one sighting (when a person arrived and left, on which camera) to our sightings database and appends it to the
+    log of file2. Programs saving many sightings should keep a sighting_log.SightingLog instead.
+'''
+def add_pandas_db_sighting(df2, id, start_time, end_time, camera, filename2) -> pd.DataFrame:
+    return add_pandas_db_sightings(df2, [(id, start_time, end_time, camera)], filename2)
+
+'''
+    add_pandas_db_sightings :
+    Adds a list of sightings, (id, arrival, departure, camera) each, to our sightings database and appends them to the
+    log of file2 (file2 is not rewritten, see sighting_log.py).
+'''
+def add_pandas_db_sightings(df2, sightings, filename2) -> pd.DataFrame:
+    if not sightings:
+        return df2
+
+    #append to our log (Total time stored in seconds. Will be convertable later)
+    rows = sighting_log.append_sightings(filename2, sightings)
+
+    return pd.concat([df2, sighting_log.rows_to_frame(rows)])
+
+'''
+    class EncodingCache :
+    Stores the encodings of our known people on disk, so we do not run face_recognition on every image each time we start.
+    The encodings are one .npy array we load memory mapped and the manifest has the row for each UUID and image, with the
+    images modified time and size. If an image changes, its entry no longer matches and it gets encoded again.
+    Entries we did not use since loading (deleted people or images) are dropped when we save. append adds new encodings
+    to the end of the .npy array and their entries to a manifest log, so adding one person does not rewrite either.
+'''
+class EncodingCache:
+    def __init__(self, data_dir):
+        self.cache_file = os.path.join(data_dir, ENCODING_CACHE_FILE)
+        self.manifest_file = os.path.join(data_dir, ENCODING_MANIFEST_FILE)
+        self.manifest_log_file = self.manifest_file + ENCODING_MANIFEST_LOG_SUFFIX
+        self.data_dir = data_dir
+        self.entries = {} #UUID -> {image file : {'mtime', 'size', 'row'}}
+        self.generation = 0 #changes each save, so a manifest log left from before a save (its rows are gone) is not replayed
+        self.encodings = np.zeros((0, face_gallery.ENCODING_SIZE)) #rows from our cache file
+        self.used = {} #UUID -> {image file : encoding} for everything we used or encoded since loading
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    '''
+        load :
+        Loads our manifest and cache file. If they are missing or do not match, we just start with an empty cache.
+    '''
+    def load(self):
+        if not file_exists(self.cache_file) or not file_exists(self.manifest_file):
+            return
+
+        try:
+            with open(self.manifest_file) as manifest_file:
+                manifest = json.load(manifest_file)
+
+            encodings = np.load(self.cache_file, mmap_mode='r')
+
+            if manifest.get('version') != ENCODING_CACHE_VERSION or encodings.ndim != 2 or encodings.shape[1] != face_gallery.ENCODING_SIZE:
+                print('Encoding cache is out of date. Rebuilding it.')
+                return
+
+            self.entries = manifest['entries']
+            self.generation = manifest.get('generation', 0)
+            self.encodings = encodings
+        except (OSError, ValueError, KeyError) as e:
+            print('Error loading encoding cache : ' + str(e))
+            return
+
+        self.load_manifest_log()
+
+    '''
+        load_manifest_log :
+        Adds the entries append saved since our manifest was (one JSON line each). Lines from before our last save, or
+        cut short by a crash, are skipped.
+    '''
+    def load_manifest_log(self):
+        if not file_exists(self.manifest_log_file):
+            return
+
+        with open(self.manifest_log_file) as log_file:
+            for line in log_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+
+                if entry.get('generation') != self.generation:
+                    continue
+
+                self.entries.setdefault(entry['uid'], {})[entry['key']] = {'mtime': entry['mtime'], 'size': entry['size'], 'row': entry['row']}
+
+    '''
+        file_key :
+        Returns the image path relative to our data directory, so the cache still works if the directory is moved.
+    '''
+    def file_key(self, path):
+        return os.path.relpath(path, self.data_dir).replace(os.sep, '/')
+
+    '''
+        file_stamp :
+        Returns the modified time and size of an image. If either changes, the image gets encoded again.
+    '''
+    def file_stamp(self, path):
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    '''
+        get :
+        Returns the cached encoding for this UUID and image, or None if we do not have one or the image changed.
+        If the image had no face, the encoding is all NaN.
+    '''
+    def get(self, uid, path):
+        uid = str(uid).rstrip()
+        entry = self.entries.get(uid, {}).get(self.file_key(path))
+
+        if not self.entry_matches(entry, path):
+            self.misses += 1
+            return None
+
+        #copy it out of the memory mapped file
+        encoding = np.array(self.encodings[entry['row']])
+        self.used.setdefault(uid, {})[self.file_key(path)] = encoding
+        self.hits += 1
+
+        return encoding
+
+    '''
+        entry_matches :
+        Returns True if a manifest entry is for this image as it is now and its row is in our cache file.
+    '''
+    def entry_matches(self, entry, path):
+        return entry is not None and (entry['mtime'], entry['size']) == self.file_stamp(path) and entry['row'] < self.encodings.shape[0]
+
+    '''
+        put :
+        Stores a new encoding for this UUID and image. Send in None if the image has no face, so we remember that too
+        (it is stored as a row of NaN, which get returns).
+    '''
+    def put(self, uid, path, encoding):
+        uid = str(uid).rstrip()
+
+        if encoding is None:
+            encoding = np.full(face_gallery.ENCODING_SIZE, np.nan)
+
+        self.used.setdefault(uid, {})[self.file_key(path)] = np.asarray(encoding)
+
+    '''
+        save :
+        Rewrites the cache with only the encodings we used or added. Writes to temp files first, so a crash can not leave
+        a half written cache. Send in prune as False when we only encoded some people (ex: adding one person), so the
+        entries we did not use are kept.
+    '''
+    def save(self, prune = True):
+        #keep the entries we did not use, if we are not pruning
+        if not prune:
+            for uid, files in self.entries.items():
+                for key, entry in files.items():
+                    if key not in self.used.get(uid, {}) and entry['row'] < self.encodings.shape[0]:
+                        self.used.setdefault(uid, {})[key] = np.array(self.encodings[entry['row']])
+
+        entries = {}
+        rows = []
+        for uid, files in self.used.items():
+            for key, encoding in files.items():
+                path = os.path.join(self.data_dir, key)
+                if not file_exists(path):
+                    continue
+
+                entries.setdefault(uid, {})[key] = dict(zip(('mtime', 'size'), self.file_stamp(path)), row=len(rows))
+                rows.append(encoding)
+
+        encodings = np.array(rows, dtype=np.float64).reshape(-1, face_gallery.ENCODING_SIZE)
+
+        #let go of the memory mapped file before we replace it
+        self.encodings = encodings
+
+        try:
+            with open(self.cache_file + '.tmp', 'wb') as cache_file:
+                np.save(cache_file, encodings)
+            with open(self.manifest_file + '.tmp', 'w') as manifest_file:
+                json.dump({'version': ENCODING_CACHE_VERSION, 'generation': self.generation + 1, 'entries': entries}, manifest_file)
+
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+            os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+            #its entries are in the manifest now (and a log left by a crash here is skipped, it is for the last generation)
+            if file_exists(self.manifest_log_file):
+                os.remove(self.manifest_log_file)
+        except OSError as e:
+            print("Error: %s - %s." % (e.filename, e.strerror))
+            return
+
+        self.entries = entries
+        self.generation += 1
+
+    '''
+        append :
+        Saves only the encodings we added since loading (ex: one new person, or their changed images) : they go on the
+        end of our cache file (only its header is rewritten, for the new row count) and their entries are appended to
+        our manifest log. Nothing is dropped, so this is for when we only encoded some people. If we have no cache file
+        yet, or its header has no room for the new row count, we save instead.
+    '''
+    def append(self):
+        added = []
+        for uid, files in self.used.items():
+            for key, encoding in files.items():
+                path = os.path.join(self.data_dir, key)
+                if file_exists(path) and not self.entry_matches(self.entries.get(uid, {}).get(key), path):
+                    added.append((uid, key, path, encoding))
+
+        if not added:
+            return
+
+        rows = np.array([encoding for uid, key, path, encoding in added], dtype=np.float64).reshape(-1, face_gallery.ENCODING_SIZE)
+
+        if not file_exists(self.cache_file) or not file_exists(self.manifest_file) or not self.append_rows(rows, self.encodings.shape[0]):
+            self.save(False)
+            return
+
+        start = self.encodings.shape[0]
+
+        try:
+            self.encodings = np.load(self.cache_file, mmap_mode='r')
+
+            with open(self.manifest_log_file, 'a') as log_file:
+                for row, (uid, key, path, encoding) in enumerate(added, start):
+                    mtime, size = self.file_stamp(path)
+                    log_file.write(json.dumps({'generation': self.generation, 'uid': uid, 'key': key, 'mtime': mtime, 'size': size, 'row': row}) + '\n')
+                    self.entries.setdefault(uid, {})[key] = {'mtime': mtime, 'size': size, 'row': row}
+        except OSError as e:
+            print("Error: %s - %s." % (e.filename, e.strerror))
+
+    '''
+        append_rows :
+        Writes rows to the end of our cache file, which has start rows, then its header with the new row count. Returns
+        False (writing nothing) if the file is not what our manifest expects or the new header would not fit in the old one.
+        A crash before the header is written leaves the extra rows past the end of the array, where they are never read.
+    '''
+    def append_rows(self, rows, start):
+        try:
+            with open(self.cache_file, 'r+b') as cache_file:
+                if np.lib.format.read_magic(cache_file) != (1, 0):
+                    return False
+
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(cache_file)
+                data_offset = cache_file.tell()
+
+                if shape != (start, face_gallery.ENCODING_SIZE) or fortran_order or dtype != np.float64 or \
+                   os.path.getsize(self.cache_file) != data_offset + rows.itemsize * start * face_gallery.ENCODING_SIZE:
+                    return False
+
+                header = io.BytesIO()
+                np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 
+                                                              'shape': (start + len(rows), face_gallery.ENCODING_SIZE)})
+                if header.tell() != data_offset:
+                    return False
+
+                cache_file.seek(data_offset + rows.itemsize * start * face_gallery.ENCODING_SIZE)
+                cache_file.write(rows.tobytes())
+                cache_file.flush()
+                os.fsync(cache_file.fileno())
+
+                cache_file.seek(0)
+                cache_file.write(header.getvalue())
+        except (OSError, ValueError) as e:
+            print('Error appending to encoding cache : ' + str(e))
+            return False
+
+        return True
+
 '''
     encode_known_people :
     This will send in our data and encode them with face_recognition. It will return encodings and labels.
+    Each persons encodings are an array of templates, one for every image with a face (reduced to max_templates).
+    If ids, paths and a cache directory are sent in, encodings are loaded from (and saved to) our EncodingCache, so only
+    new or changed images are encoded. Send in prune_cache as False, when these are not all of our known people.
 ''' 
-def encode_known_people(images, labels):
+def encode_known_people(images, labels, ids = None, paths = None, cache_dir = None, prune_cache = True, max_templates = MAX_FACE_TEMPLATES):
     face_encodings = []
     face_names = []
 
+    #only use the cache, if we know what images these are
+    cache = None
+    if cache_dir is not None and ids is not None and paths is not None:
+        cache = EncodingCache(cache_dir)
+
     #loop through our images list    
-    for image, label in zip(images, labels):
-        encoding = face_recognition.face_encodings(cv2.cvtColor(image[0], cv2.COLOR_BGR2RGB))[0]
-        face_encodings.append(encoding)
+    for i, (image, label) in enumerate(zip(images, labels)):
+        templates, image_encodings, encoded = encode_person_images(image, 
+                                                                   ids[i] if cache is not None else None, 
+                                                                   paths[i] if cache is not None else None, 
+                                                                   cache, max_templates)
+
+        #keep what we encoded in our cache
+        if cache is not None:
+            for path, encoding in zip(paths[i], image_encodings):
+                cache.put(ids[i], path, encoding)
+
+        face_encodings.append(templates)
         face_names.append(label)
 
+    #save our cache, to drop anything stale and store the new ones. If these are not all our people, only add the new ones
+    if cache is not None:
+        print('Encoding cache : ' + str(cache.hits) + ' loaded, ' + str(cache.misses) + ' encoded')
+        if prune_cache:
+            cache.save()
+        else:
+            cache.append()
+
     return face_encodings, face_names
-    
\ No newline at end of file
+
+'''
+    encode_person_images :
+    Encodes every image of one person, using the cache (if sent in) for images it already has. Returns their templates
+    (reduced to max_templates), the encoding of each image (None if it has no face) and how many images we had to encode.
+''' 
+def encode_person_images(images, uid, paths, cache, max_templates = MAX_FACE_TEMPLATES):
+    image_encodings = []
+    encoded = 0
+
+    for i, image in enumerate(images):
+        encoding = None
+        if cache is not None and uid is not None:
+            encoding = cache.get(uid, paths[i])
+
+        #not in our cache, so encode it. Use the first face found in the image
+        if encoding is None:
+            faces = face_recognition.face_encodings(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            encoding = faces[0] if len(faces) > 0 else None
+            encoded += 1
+        #cached, but the image had no face
+        elif np.isnan(encoding).any():
+            encoding = None
+
+        image_encodings.append(encoding)
+
+    templates = reduce_templates([encoding for encoding in image_encodings if encoding is not None], max_templates)
+
+    return templates, image_encodings, encoded
+
+'''
+    reduce_templates :
+    If a person has more encodings than max_templates, reduce them to max_templates k-means centroids.
+''' 
+def reduce_templates(encodings, max_templates = MAX_FACE_TEMPLATES):
+    encodings = np.asarray(encodings, dtype=np.float64).reshape(-1, face_gallery.ENCODING_SIZE)
+
+    if max_templates is None or encodings.shape[0] <= max_templates:
+        return encodings
+
+    return face_gallery.kmeans(encodings, max_templates).astype(np.float64)
+
+'''
+    batch_throughput_report :
+    Runs the same frame through AppLoopFaceCheck for each batch size and batch wait (batch size 1 is the per frame path).
+    Returns a list of dicts with jobs per second and the mean and 95th percentile latency from submit to result.
+'''
+def batch_throughput_report(frame, locations, jobs = 200, batch_sizes = (1, 2, 4, 8), batch_waits = (0.0, 0.005, 0.02), workers = None, gallery_size = 1000):
+    encodings = face_gallery.synthetic_gallery(gallery_size)
+    uids = [str(uuid.uuid4()) for _ in range(gallery_size)]
+    names = ['Person ' + str(i) for i in range(gallery_size)]
+    reports = []
+
+    for batch_size in batch_sizes:
+        for batch_wait in (batch_waits if batch_size > 1 else (0.0,)):
+            #wait for room instead of dropping, so every job gets a result
+            app_loop_face = AppLoopFaceCheck(job_mailbox.JobMailbox(policy=job_mailbox.BLOCK, timeout=60), multiprocessing.Queue(), [encoding[None, :] for encoding in encodings], names,
+                                             [None] * gallery_size, [''] * gallery_size, uids, workers=workers, frame_slot_size=frame.nbytes,
+                                             batch_size=batch_size, batch_wait=batch_wait)
+            app_loop_face.start()
+
+            submit_times = {} #sequence -> when we submitted it (jobs a policy drops never get a result, so match by sequence)
+            submitted = 0
+            latencies = []
+            starttime = time.perf_counter()
+
+            #keep the workers busy, if every slot is in use wait for results to free one. Done when every job we
+            #submitted has a result or was dropped
+            while submitted < jobs or app_loop_face.next_result_sequence[0] < app_loop_face.next_sequence[0]:
+                sequence = app_loop_face.next_sequence[0]
+                submit_time = time.perf_counter()
+
+                if submitted < jobs and app_loop_face.submit(locations, frame):
+                    submit_times[sequence] = submit_time
+                    submitted += 1
+                else:
+                    time.sleep(0.001)
+
+                for camera, sequence, faces_data in app_loop_face.get_results(sequences=True):
+                    latencies.append(time.perf_counter() - submit_times.pop(sequence))
+
+            elapsed = time.perf_counter() - starttime
+            app_loop_face.stop()
+
+            reports.append({'batch_size': batch_size,
+                            'batch_wait_ms': batch_wait * 1000,
+                            'jobs_per_second': len(latencies) / elapsed,
+                            'faces_per_second': len(latencies) * len(locations) / elapsed,
+                            'mean_latency_ms': float(np.mean(latencies)) * 1000,
+                            'p95_latency_ms': float(np.percentile(latencies, 95)) * 1000})
+
+    return reports
+
+'''
+    print_batch_throughput_report :
+    Prints batch_throughput_report, compared to the per frame path (batch size 1).
+'''
+def print_batch_throughput_report(frame, locations, jobs = 200, batch_sizes = (1, 2, 4, 8), batch_waits = (0.0, 0.005, 0.02), workers = None):
+    reports = batch_throughput_report(frame, locations, jobs, batch_sizes, batch_waits, workers)
+    per_frame = reports[0]['jobs_per_second'] if reports[0]['batch_size'] == 1 else None
+    print('Frame : ' + str(frame.shape) + ', faces per frame : ' + str(len(locations)) + ', jobs : ' + str(jobs))
+
+    for report in reports:
+        print('batch ' + str(report['batch_size']).rjust(2) +
+              ', wait ' + format(report['batch_wait_ms'], '.0f').rjust(2) + ' ms' +
+              ' : ' + format(report['jobs_per_second'], '.1f') + ' frames/s' +
+              ', ' + format(report['faces_per_second'], '.1f') + ' faces/s' +
+              ', latency ' + format(report['mean_latency_ms'], '.1f') + ' ms (p95 ' + format(report['p95_latency_ms'], '.1f') + ' ms)' +
+              (', ' + format(report['jobs_per_second'] / per_frame, '.2f') + 'x per frame' if per_frame else ''))
+
+if __name__ == "__main__":
+    #an image with faces can be sent in, ex: python face_data.py people.jpg. Without one a blank frame with 2 boxes is used
+    if len(sys.argv) > 1:
+        frame = cv2.imread(sys.argv[1])
+        locations = face_recognition.face_locations(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    else:
+        frame = np.full((540, 960, 3), 128, dtype=np.uint8)
+        locations = [(100, 300, 200, 200), (150, 700, 250, 600)]
+
+    print_batch_throughput_report(frame, locations)
@@ -0,0 +1,919 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Runs face detection as its own stage, in a background process. The GUI hands it frames from capture, it finds
+the faces and sends the locations to facial recognition (AppLoopFaceCheck) and back to the GUI to draw.
+Follow the class below for flow.
+
+'''
+import time
+import queue
+import threading
+import collections
+import multiprocessing
+import cv2
+import numpy as np
+import face_recognition
+import frame_ring
+
+DETECTION_SLOT_COUNT = 3 #full frames the detection ring can hold at once
+DETECTION_SCALE = 0.5 #size we shrink frames to before detecting faces
+DEFAULT_FRAME_SLOT_SIZE = 1920 * 1080 * 3 #bytes per slot, big enough for a 1080p frame (used when we do not know the frame size)
+FIRST_FRAME_TIMEOUT = 2.0 #seconds we wait for a source's first frame, so our slots are sized from it
+KEYFRAME_INTERVAL = 5 #run the full face detector every this many frames, track the faces in between (1 detects every frame)
+MIN_TRACK_CONFIDENCE = 0.5 #if less than this part of a face's points were tracked, detect again on the next frame
+MIN_TRACK_POINTS = 4 #a face needs at least this many tracked points to keep tracking it
+MAX_TRACK_POINTS = 20 #points we follow in each face
+IOU_MATCH_THRESHOLD = 0.3 #a detection takes over a track when their boxes overlap at least this much (intersection over union)
+MOTION_WIDTH = 240 #width we shrink frames to before background subtraction (the same for any detection scale)
+MIN_MOTION_AREA = 0.002 #part of the frame that has to be moving before we run the face detector
+MOTION_DILATE_ITERATIONS = 4 #grow the moving pixels this many times, so a moving face is one region
+MOTION_MARGIN = 0.25 #grow each region by this part of its size, so the whole face fits
+MIN_REGION_SIZE = 80 #smallest region (pixels of the small frame) we run the face detector on
+MAX_REGION_AREA = 0.6 #if our regions cover more than this part of the frame, detect in the whole frame
+RECHECK_SECONDS = 10 #check the identity of a known face on its track again this often
+UNKNOWN_RECHECK_SECONDS = 1 #unknown faces (and known faces with a thin margin) are checked again this often
+PENDING_TIMEOUT = 2 #if recognition has not answered for a face in this long, send it again
+BOX_JUMP_IOU = 0.3 #if a track's box overlaps its last box less than this, it jumped and its identity is checked again
+MIN_MATCH_MARGIN = 0.05 #if the second best person is closer than this (in distance) to the best one, the margin is thin
+DETECTION_SCALES = (0.25, 0.375, 0.5, 0.75, 1.0) #scales our scale controller can shrink frames to before detecting faces
+DETECTION_UPSAMPLES = (0, 1, 2) #times the face detector can upsample the frame (each doubles the size it searches)
+DEFAULT_UPSAMPLE = 1 #face_recognition.face_locations default
+DETECTION_LATENCY_BUDGET = 0.05 #seconds the face detector may take on a keyframe
+MIN_DETECT_FACE = 80 #smallest face (pixels tall) the HOG face detector finds without upsampling
+FACE_SIZE_PERCENTILE = 10 #plan for faces as small as this percentile of the faces we have seen
+FACE_SIZE_MARGIN = 0.75 #and this much smaller again
+FACE_SIZE_HISTORY = 200 #face heights we remember
+MIN_FACE_SAMPLES = 10 #faces we need to see before we move off our default scale
+LATENCY_SMOOTHING = 0.2 #how fast our detector speed estimate follows new keyframes
+
+'''
+    class DetectionResult :
+    The face locations found in one captured frame. Locations are in the scaled down frame, divide by scale to draw them
+    on the full frame. box_age is set when the GUI draws it (seconds from capture to draw).
+'''
+class DetectionResult:
+    def __init__(self, frame_id, capture_time, locations, scale, detect_time, track_ids = None, keyframe = True, camera = 0):
+        self.frame_id = frame_id #id of the frame we detected in
+        self.camera = camera #id of the camera the frame came from
+        self.capture_time = capture_time #time.perf_counter() when the frame was captured
+        self.locations = locations #(top, right, bottom, left) for each face
+        self.track_ids = track_ids if track_ids is not None else [] #track id of each face, stays the same while we follow it
+        self.ids = [None] * len(self.locations) #id (UUID) recognition found on each track, None if we do not know yet
+        self.names = [None] * len(self.locations) #name recognition found on each track, None if we do not know yet
+        self.keyframe = keyframe #True if the face detector ran on this frame, False if the faces were tracked
+        self.scale = scale #scale of the frame we detected in
+        self.detect_time = detect_time #seconds it took to detect
+        self.box_age = None #seconds from capture to when these boxes were drawn
+
+    '''
+        age :
+        Returns how old these boxes are, in seconds, from when their frame was captured.
+    '''
+    def age(self, now = None):
+        return (time.perf_counter() if now is None else now) - self.capture_time
+
+    '''
+        full_frame_locations :
+        Returns our locations scaled back up to the full frame.
+    '''
+    def full_frame_locations(self):
+        return [(int(top / self.scale), int(right / self.scale), int(bottom / self.scale), int(left / self.scale)) for (top, right, bottom, left) in self.locations]
+
+'''
+    iou_matrix :
+    Returns the intersection over union of every box in boxes_a with every box in boxes_b, as a (len(a), len(b)) array.
+    Boxes are (top, right, bottom, left).
+'''
+def iou_matrix(boxes_a, boxes_b):
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+
+    top = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    right = np.minimum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    bottom = np.minimum(boxes_a[:, None, 2], boxes_b[None, :, 2])
+    left = np.maximum(boxes_a[:, None, 3], boxes_b[None, :, 3])
+    intersection = np.clip(bottom - top, 0, None) * np.clip(right - left, 0, None)
+
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 1] - boxes_a[:, 3])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 1] - boxes_b[:, 3])
+    union = area_a[:, None] + area_b[None, :] - intersection
+
+    return intersection / np.maximum(union, 1e-9)
+
+'''
+    assign_boxes :
+    Greedy matching of boxes by intersection over union (best overlap first). Returns a list of (a index, b index)
+    for each pair that overlaps at least threshold. Each box is used once.
+'''
+def assign_boxes(boxes_a, boxes_b, threshold = IOU_MATCH_THRESHOLD):
+    ious = iou_matrix(boxes_a, boxes_b)
+    pairs = []
+
+    if ious.size == 0:
+        return pairs
+
+    used_a = np.zeros(ious.shape[0], dtype=bool)
+    used_b = np.zeros(ious.shape[1], dtype=bool)
+
+    #go through the overlaps from best to worst, only the ones over our threshold
+    order = np.argsort(ious, axis=None)[::-1]
+    order = order[ious.flat[order] >= threshold]
+
+    for a, b in zip(*np.unravel_index(order, ious.shape)):
+        if not used_a[a] and not used_b[b]:
+            used_a[a] = used_b[b] = True
+            pairs.append((int(a), int(b)))
+
+    return pairs
+
+'''
+    class FaceTracker :
+    Follows faces between keyframes. On a keyframe update matches the new detections to our tracks (so a face keeps its
+    track id), between keyframes track moves each box with sparse optical flow. needs_keyframe tells us when to run the
+    face detector again (every keyframe_interval frames, or sooner if we lost the points in a face).
+'''
+class FaceTracker:
+    def __init__(self, keyframe_interval = KEYFRAME_INTERVAL, min_confidence = MIN_TRACK_CONFIDENCE, iou_threshold = IOU_MATCH_THRESHOLD):
+        self.keyframe_interval = max(1, keyframe_interval)
+        self.min_confidence = min_confidence
+        self.iou_threshold = iou_threshold
+        self.boxes = np.empty((0, 4), dtype=np.float64) #(top, right, bottom, left) of each track
+        self.track_ids = [] #id of each track
+        self.next_track_id = 0 #id we give the next new face
+        self.previous_gray = None #last frame we saw, to track from
+        self.frames_since_keyframe = 0
+        self.confidence = 1.0 #part of the points we tracked in the face we tracked worst
+
+    '''
+        needs_keyframe :
+        Returns True if we should run the face detector on the next frame.
+    '''
+    def needs_keyframe(self):
+        return self.previous_gray is None or self.frames_since_keyframe + 1 >= self.keyframe_interval or self.confidence < self.min_confidence
+
+    '''
+        update :
+        Call on a keyframe with the faces the detector found. Detections that overlap a track take over its id,
+        the rest get new ids and tracks that were not found end. Returns (locations, track ids).
+    '''
+    def update(self, gray, locations):
+        boxes = np.asarray(locations, dtype=np.float64).reshape(-1, 4)
+        track_ids = [None] * len(boxes)
+
+        for detection, track in assign_boxes(boxes, self.boxes, self.iou_threshold):
+            track_ids[detection] = self.track_ids[track]
+
+        for i in range(len(track_ids)):
+            if track_ids[i] is None:
+                track_ids[i] = self.next_track_id
+                self.next_track_id += 1
+
+        self.boxes = boxes
+        self.track_ids = track_ids
+        self.previous_gray = gray
+        self.frames_since_keyframe = 0
+        self.confidence = 1.0
+
+        return list(locations), list(track_ids)
+
+    '''
+        rescale :
+        Call when the frames we get change size by ratio. Our boxes are moved to the new size and the next frame is a keyframe.
+    '''
+    def rescale(self, ratio):
+        self.boxes = self.boxes * ratio
+        self.previous_gray = None
+
+    '''
+        track :
+        Call between keyframes. Moves (and scales) each box by the median motion of the points inside it.
+        Tracks that lose too many points end, and lower our confidence so the next frame is a keyframe.
+        Returns (locations, track ids).
+    '''
+    def track(self, gray):
+        self.frames_since_keyframe += 1
+
+        #nothing to track from, keep our boxes where they are
+        if len(self.boxes) == 0 or self.previous_gray is None:
+            self.previous_gray = gray
+            self.confidence = 1.0
+            return [tuple(int(round(value)) for value in box) for box in self.boxes], list(self.track_ids)
+
+        #find good points inside each box, and track all of them in one call
+        points = []
+        owners = []
+        for i, (top, right, bottom, left) in enumerate(self.boxes.astype(int)):
+            mask = np.zeros(self.previous_gray.shape, dtype=np.uint8)
+            mask[max(top, 0):max(bottom, 0), max(left, 0):max(right, 0)] = 255
+            box_points = cv2.goodFeaturesToTrack(self.previous_gray, MAX_TRACK_POINTS, 0.01, 3, mask=mask)
+
+            if box_points is not None:
+                points.append(box_points.reshape(-1, 2))
+                owners.append(np.full(len(box_points), i))
+
+        if points:
+            points = np.concatenate(points).astype(np.float32)
+            owners = np.concatenate(owners)
+            new_points, status, error = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, points.reshape(-1, 1, 2), None)
+            new_points = new_points.reshape(-1, 2)
+            status = status.reshape(-1).astype(bool)
+        else:
+            owners = np.empty(0, dtype=int)
+
+        height, width = gray.shape[:2]
+        keep = []
+        confidences = []
+
+        for i in range(len(self.boxes)):
+            owned = owners == i
+            tracked = owned & status if len(owners) else owned
+            found = int(np.count_nonzero(owned))
+            good = int(np.count_nonzero(tracked))
+
+            confidences.append(good / found if found else 0.0)
+
+            #lost this face
+            if good < MIN_TRACK_POINTS:
+                continue
+
+            old = points[tracked]
+            new = new_points[tracked]
+            dy, dx = np.median(new[:, 1] - old[:, 1]), np.median(new[:, 0] - old[:, 0])
+
+            #scale by how far the points spread from their center, before and after
+            old_spread = np.median(np.linalg.norm(old - np.median(old, axis=0), axis=1))
+            new_spread = np.median(np.linalg.norm(new - np.median(new, axis=0), axis=1))
+            scale = new_spread / old_spread if old_spread > 1e-6 else 1.0
+
+            top, right, bottom, left = self.boxes[i]
+            center_y, center_x = (top + bottom) / 2 + dy, (left + right) / 2 + dx
+            half_height, half_width = (bottom - top) / 2 * scale, (right - left) / 2 * scale
+
+            self.boxes[i] = (max(center_y - half_height, 0), min(center_x + half_width, width), min(center_y + half_height, height), max(center_x - half_width, 0))
+            keep.append(i)
+
+        self.confidence = min(confidences) if confidences else 1.0
+        self.boxes = self.boxes[keep]
+        self.track_ids = [self.track_ids[i] for i in keep]
+        self.previous_gray = gray
+
+        return [tuple(int(round(value)) for value in box) for box in self.boxes], list(self.track_ids)
+
+'''
+    grow_box :
+    Grows a box (top, right, bottom, left) by margin of its size each way, to at least min_size, and keeps it in the frame.
+'''
+def grow_box(box, margin, min_size, height, width):
+    top, right, bottom, left = box
+    grow_y = max((bottom - top) * margin, (min_size - (bottom - top)) / 2, 0)
+    grow_x = max((right - left) * margin, (min_size - (right - left)) / 2, 0)
+
+    return (int(max(top - grow_y, 0)), int(min(right + grow_x, width)), int(min(bottom + grow_y, height)), int(max(left - grow_x, 0)))
+
+'''
+    merge_boxes :
+    Joins boxes (top, right, bottom, left) that overlap, until none do. Returns the list of joined boxes.
+'''
+def merge_boxes(boxes):
+    boxes = [tuple(box) for box in boxes]
+    merged = True
+
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[3] < b[1] and b[3] < a[1]:
+                    boxes[i] = (min(a[0], b[0]), max(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return boxes
+
+'''
+    class MotionGate :
+    Background subtraction (MOG2) in front of the face detector. apply is called on every frame, so the background stays
+    up to date, and returns how much of the frame is moving and the boxes around the moving parts. If too little moves,
+    we skip the face detector.
+'''
+class MotionGate:
+    def __init__(self, min_area = MIN_MOTION_AREA, width = MOTION_WIDTH, dilate_iterations = MOTION_DILATE_ITERATIONS):
+        self.min_area = min_area
+        self.width = width
+        self.dilate_iterations = dilate_iterations
+        self.back_sub = None #created in the process that uses it (it can not be pickled)
+        self.kernel = np.ones((3, 3), dtype=np.uint8)
+
+    '''
+        __getstate__ :
+        Do not send our background subtractor, it is created again on the first frame.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['back_sub'] = None
+        return state
+
+    '''
+        apply :
+        Updates the background with a (gray) frame. Returns (part of the frame moving, boxes around the motion).
+        No boxes are returned when the moving part is under min_area.
+    '''
+    def apply(self, gray):
+        if self.back_sub is None:
+            self.back_sub = cv2.createBackgroundSubtractorMOG2()
+
+        #always the same size, so the background stays the same when our detection scale changes
+        scale = self.width / gray.shape[1]
+        small = cv2.resize(gray, (self.width, max(1, int(round(gray.shape[0] * scale)))), interpolation=cv2.INTER_AREA)
+        mask = self.back_sub.apply(small)
+
+        #shadows are marked 127, only keep the real foreground
+        _, mask = cv2.threshold(mask, 200, 255, cv2.THRESH_BINARY)
+        area = cv2.countNonZero(mask) / mask.size
+
+        if area < self.min_area:
+            return area, []
+
+        mask = cv2.dilate(mask, self.kernel, iterations=self.dilate_iterations)
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+
+        #stats are (x, y, width, height, area), label 0 is the background
+        boxes = [(y / scale, (x + w) / scale, (y + h) / scale, x / scale) for x, y, w, h, pixels in stats[1:]]
+
+        return area, boxes
+
+'''
+    class TrackIdentity :
+    Who recognition found on a track, and how sure it was.
+'''
+class TrackIdentity:
+    def __init__(self, id, name, distance, margin, verified_time):
+        self.id = id #UUID of the person (a new one each time for Unknown)
+        self.name = name
+        self.distance = distance #distance to the best match
+        self.margin = margin #distance from the best match to the second best
+        self.verified_time = verified_time #time.perf_counter() when recognition answered
+
+    '''
+        is_known :
+        Returns True if this is someone we know and the second best person was not close.
+    '''
+    def is_known(self, min_margin = MIN_MATCH_MARGIN):
+        return self.name != 'Unknown' and self.margin is not None and self.margin >= min_margin
+
+'''
+    class IdentityCache :
+    Remembers who is on each track, so a face we already know is not encoded again every frame. needs_verify tells us
+    when a face on a track has to go to recognition : a new track, the schedule ran out (recheck_seconds for known faces,
+    unknown_recheck_seconds for unknown faces or a thin margin) or the box jumped. Only one check per track is sent at
+    a time (until recognition answers, or pending_timeout passes).
+'''
+class IdentityCache:
+    def __init__(self, recheck_seconds = RECHECK_SECONDS, unknown_recheck_seconds = UNKNOWN_RECHECK_SECONDS, pending_timeout = PENDING_TIMEOUT, box_jump_iou = BOX_JUMP_IOU, min_margin = MIN_MATCH_MARGIN):
+        self.recheck_seconds = recheck_seconds
+        self.unknown_recheck_seconds = unknown_recheck_seconds
+        self.pending_timeout = pending_timeout
+        self.box_jump_iou = box_jump_iou
+        self.min_margin = min_margin
+        self.identities = {} #track id -> TrackIdentity
+        self.pending = {} #track id -> time we sent it to recognition
+        self.boxes = {} #track id -> box in the last frame
+        self.jumped = set() #tracks whose box jumped since they were last sent
+
+    '''
+        needs_verify :
+        Call once a frame for each face. Returns True if this face should go to recognition.
+    '''
+    def needs_verify(self, track_id, box, now):
+        last_box = self.boxes.get(track_id)
+        self.boxes[track_id] = box
+
+        if last_box is not None and iou_matrix([last_box], [box])[0, 0] < self.box_jump_iou:
+            self.jumped.add(track_id)
+
+        #still waiting for recognition to answer
+        sent = self.pending.get(track_id)
+        if sent is not None and now - sent < self.pending_timeout:
+            return False
+
+        identity = self.identities.get(track_id)
+        if identity is None or track_id in self.jumped:
+            return True
+
+        recheck = self.recheck_seconds if identity.is_known(self.min_margin) else self.unknown_recheck_seconds
+
+        return now - identity.verified_time >= recheck
+
+    '''
+        sent :
+        Call when faces were sent to recognition.
+    '''
+    def sent(self, track_ids, now):
+        for track_id in track_ids:
+            self.pending[track_id] = now
+            self.jumped.discard(track_id)
+
+    '''
+        confirm :
+        Call when recognition answers for a track.
+    '''
+    def confirm(self, track_id, id, name, distance, margin, now):
+        #track already ended
+        if track_id not in self.boxes:
+            return
+
+        self.identities[track_id] = TrackIdentity(id, name, distance, margin, now)
+        self.pending.pop(track_id, None)
+
+    '''
+        get :
+        Returns the TrackIdentity for a track, or None if we do not know it yet.
+    '''
+    def get(self, track_id):
+        return self.identities.get(track_id)
+
+    '''
+        prune :
+        Forgets every track not in track_ids (they ended).
+    '''
+    def prune(self, track_ids):
+        track_ids = set(track_ids)
+
+        for table in (self.identities, self.pending, self.boxes):
+            for track_id in [track_id for track_id in table if track_id not in track_ids]:
+                del table[track_id]
+
+        self.jumped &= track_ids
+
+'''
+    class ScaleController :
+    Picks the scale we shrink frames to, and how many times the face detector upsamples, for one camera. The detector
+    finds faces of about MIN_DETECT_FACE pixels, so the effective size (scale x 2 ^ upsample) has to make the small faces
+    we see (a low percentile of the face heights we found) that big. The cheapest choice that does is used, unless the
+    detector would go over our latency budget. Then (and when keyframes run late) we back off to a smaller size.
+'''
+class ScaleController:
+    def __init__(self, latency_budget = DETECTION_LATENCY_BUDGET, scales = DETECTION_SCALES, upsamples = DETECTION_UPSAMPLES, scale = DETECTION_SCALE, upsample = DEFAULT_UPSAMPLE):
+        self.latency_budget = latency_budget
+        #(effective size, scale, upsample), cheapest first. For the same size, upsample less (bigger frames are better for recognition)
+        self.options = sorted(((s * 2 ** u, s, u) for s in scales for u in upsamples), key=lambda option: (option[0], option[2]))
+        self.default = (scale * 2 ** upsample, scale, upsample)
+        self.scale = scale #scale we use now
+        self.upsample = upsample #upsample we use now
+        self.face_heights = collections.deque(maxlen=FACE_SIZE_HISTORY) #heights of faces we found, in full frame pixels
+        self.seconds_per_pixel = None #how long the detector takes per pixel it searches (after upsampling)
+        self.late = False #last keyframe went over our latency budget
+
+    '''
+        observe :
+        Call after each keyframe, with the heights of the faces found (full frame pixels), the seconds the face detector
+        took and the pixels it searched (before upsampling).
+    '''
+    def observe(self, face_heights, detect_seconds, searched_pixels):
+        self.face_heights.extend(face_heights)
+
+        if searched_pixels > 0:
+            seconds_per_pixel = detect_seconds / (searched_pixels * 4 ** self.upsample)
+            if self.seconds_per_pixel is None:
+                self.seconds_per_pixel = seconds_per_pixel
+            else:
+                self.seconds_per_pixel += LATENCY_SMOOTHING * (seconds_per_pixel - self.seconds_per_pixel)
+
+        self.late = detect_seconds > self.latency_budget
+
+    '''
+        required_size :
+        Returns the effective size (scale x 2 ^ upsample) that makes the small faces we see big enough to find.
+    '''
+    def required_size(self):
+        if len(self.face_heights) < MIN_FACE_SAMPLES:
+            return self.default[0]
+
+        small_face = np.percentile(self.face_heights, FACE_SIZE_PERCENTILE) * FACE_SIZE_MARGIN
+
+        return MIN_DETECT_FACE / max(small_face, 1.0)
+
+    '''
+        choose :
+        Picks our scale and upsample for the next keyframe of a frame_pixels (full frame) frame. Returns (scale, upsample).
+    '''
+    def choose(self, frame_pixels):
+        required = self.required_size()
+        current = self.scale * 2 ** self.upsample
+
+        #cheapest choice big enough for our faces (or the biggest we have). Until we have seen enough faces, our default
+        if len(self.face_heights) < MIN_FACE_SAMPLES:
+            pick = self.default
+        else:
+            pick = next((option for option in self.options if option[0] >= required), self.options[-1])
+
+        #back off if the detector would go over our budget, or the last keyframe ran late
+        affordable = self.options
+        if self.seconds_per_pixel is not None:
+            affordable = [option for option in self.options if self.seconds_per_pixel * frame_pixels * option[0] ** 2 <= self.latency_budget]
+        if self.late:
+            affordable = [option for option in affordable if option[0] < current]
+
+        if pick not in affordable:
+            pick = affordable[-1] if affordable else self.options[0]
+
+        self.scale, self.upsample = pick[1], pick[2]
+
+        return self.scale, self.upsample
+
+'''
+    class DetectionStage :
+    Finds faces in a background process. submit_frame copies a frame into shared memory, but only when the stage is free,
+    so it always works on the newest frame and never builds up a backlog. The locations found go to facial recognition
+    (through recognizer.submit) and back to the GUI through latest_result.
+'''
+class DetectionStage:
+    def __init__(self, recognizer, frame_slot_size = None, recheck_seconds = RECHECK_SECONDS, keyframe_interval = KEYFRAME_INTERVAL, motion_gate = True, latency_budget = DETECTION_LATENCY_BUDGET, adaptive_scale = True, camera = 0):
+        self.recognizer = recognizer #our AppLoopFaceCheck, we send it the frames with faces
+        self.camera = camera #id of our camera, sent with our jobs so recognition results say which camera saw them
+        self.run_stage = True #lets us know to run main loop
+        #full frames go to our stage through shared memory, only the slot reference goes through the queue
+        self.frame_ring = frame_ring.FrameRing(DETECTION_SLOT_COUNT, frame_slot_size if frame_slot_size else DEFAULT_FRAME_SLOT_SIZE)
+        self.frame_queue = multiprocessing.Queue() #(frame id, capture time, reference) for frames to detect in
+        self.result_queue = multiprocessing.Queue() #DetectionResult for each frame we detected in
+        self.pending = multiprocessing.Value('i', 0) #frames sent that the stage has not picked up yet
+        self.frames_detected = multiprocessing.Value('i', 0) #frames we found faces in (or found none)
+        self.detect_busy_time = multiprocessing.Value('d', 0.0) #seconds the stage spent detecting
+        self.keyframes = multiprocessing.Value('i', 0) #frames we ran the face detector on (the rest were tracked)
+        self.tracker = FaceTracker(keyframe_interval) #follows faces between keyframes
+        self.motion_gate = MotionGate() if motion_gate else None #skips the face detector when nothing is moving
+        self.motion_skipped_frames = multiprocessing.Value('i', 0) #keyframes we did not run the face detector on (nothing moving)
+        self.motion_skipped_pixels = multiprocessing.Value('q', 0) #pixels we did not run the face detector on
+        self.keyframe_pixels = multiprocessing.Value('q', 0) #pixels in all our keyframes
+        self.scale_controller = ScaleController(latency_budget) if adaptive_scale else None #picks our scale and upsample
+        self.scale = DETECTION_SCALE #scale we shrink frames to before detecting faces
+        self.upsample = DEFAULT_UPSAMPLE #times the face detector upsamples
+        self.detector_seconds = 0.0 #seconds the face detector took on this keyframe
+        self.detector_pixels = 0 #pixels the face detector searched on this keyframe (before upsampling)
+        self.current_scale = multiprocessing.Value('d', self.scale) #scale the stage is using, for reports
+        self.current_upsample = multiprocessing.Value('i', self.upsample) #upsample the stage is using, for reports
+        self.scale_changes = multiprocessing.Value('i', 0) #times the stage changed scale or upsample
+        self.frames_skipped = 0 #frames not sent, because the stage was busy
+        self.frames_too_big = 0 #frames not sent, because they did not fit in our frame ring slots
+        self.next_frame_id = 0 #id of the next frame we submit
+        self.latest = None #newest DetectionResult we have
+        self.stage_timer = time.perf_counter() #checks our time
+        self.identity_cache = IdentityCache(recheck_seconds) #who is on each track, so known faces are not encoded every frame
+        self.identity_queue = multiprocessing.Queue() #identities recognition found, sent back to us by confirm_identities
+        self.faces_sent = multiprocessing.Value('i', 0) #faces we sent to recognition
+        self.faces_cached = multiprocessing.Value('i', 0) #faces we knew from our identity cache (not sent)
+        self.capture = None #CaptureThread we take frames from (see feed_from)
+        self.feed_thread = None #thread in our main process sending the newest frames to our stage
+        #main loop of our detection stage
+        self.stage_process = multiprocessing.Process(target=self.stage_loop)
+
+    '''
+        __getstate__ :
+        Our stage process gets a copy of this class. Do not send the process handle, capture or feed thread with it.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('stage_process', None)
+        state.pop('capture', None)
+        state.pop('feed_thread', None)
+        return state
+
+    '''
+        submit_frame :
+        Sends a captured frame to our stage, if it is not still waiting on the last one. Returns False if it was skipped.
+    '''
+    def submit_frame(self, frame, capture_time = None):
+        #stage still has a frame waiting, it would be old by the time it got to this one
+        if self.pending.value > 0:
+            self.frames_skipped += 1
+            return False
+
+        #bigger than we were sized for (ex: the source changed size, or an image directory has bigger images). Our stage
+        #has the ring already, so these frames are skipped, say so once
+        if frame.nbytes > self.frame_ring.slot_size:
+            if self.frames_too_big == 0:
+                print('Detection (camera ' + str(self.camera) + ') : frame of ' + str(frame.shape) + ' does not fit in a ' + str(self.frame_ring.slot_size) + ' byte slot. Frames this big are skipped.')
+            self.frames_too_big += 1
+            self.frames_skipped += 1
+            return False
+
+        reference = self.frame_ring.write(frame)
+
+        if reference is None:
+            self.frames_skipped += 1
+            return False
+
+        with self.pending.get_lock():
+            self.pending.value += 1
+
+        self.frame_queue.put((self.next_frame_id, time.perf_counter() if capture_time is None else capture_time, reference))
+        self.next_frame_id += 1
+
+        return True
+
+    '''
+        feed_from :
+        Takes frames straight from a CaptureThread (frame_capture.py), at our stage's own rate. A thread waits for the stage
+        to be free, then sends it the newest frame, so the GUI does not have to call submit_frame.
+    '''
+    def feed_from(self, capture):
+        self.capture = capture
+        self.feed_thread = threading.Thread(target=self.feed_loop, name='detection feed', daemon=True)
+        self.feed_thread.start()
+
+    '''
+        feed_loop :
+        Our feed thread. Each frame is copied into shared memory straight from the capture ring.
+    '''
+    def feed_loop(self):
+        sequence = -1
+
+        while self.run_stage:
+            #stage still has a frame waiting
+            if self.pending.value > 0:
+                time.sleep(0.002)
+                continue
+
+            used = self.capture.use_latest(self.submit_frame, after=sequence, timeout=0.1)
+
+            if used is not None:
+                sequence = used
+            elif not self.capture.is_running():
+                break
+
+    '''
+        latest_result :
+        Returns the newest DetectionResult our stage sent back (or None if we do not have one yet).
+    '''
+    def latest_result(self):
+        while not self.result_queue.empty():
+            result = self.result_queue.get()
+
+            if self.latest is None or result.frame_id > self.latest.frame_id:
+                self.latest = result
+
+        return self.latest
+
+    '''
+        utilisation :
+        Returns how busy our stage has been since we started (0.0 to 1.0), how many frames it handled, how many of those
+        were keyframes (the rest were tracked) and how many were skipped.
+    '''
+    def utilisation(self):
+        elapsed = max(time.perf_counter() - self.stage_timer, 1e-9)
+        return self.detect_busy_time.value / elapsed, self.frames_detected.value, self.keyframes.value, self.frames_skipped
+
+    '''
+        stage_loop :
+        The main loop of our stage process. Gets frames, finds faces and sends out the results.
+    '''
+    def stage_loop(self):
+        #run while app active
+        while self.run_stage:
+            try:
+                frame_id, capture_time, reference = self.frame_queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+
+            with self.pending.get_lock():
+                self.pending.value -= 1
+
+            starttime = time.perf_counter()
+
+            #run the face detector on keyframes, track the faces we have in between
+            keyframe = self.tracker.needs_keyframe()
+
+            #get our frame from shared memory and let the slot go, once we have our small frame
+            frame = self.frame_ring.read(reference)
+            try:
+                if frame is None:
+                    continue
+
+                #our scale only changes on keyframes, so tracking always works on frames of the same size
+                if keyframe:
+                    self.choose_scale(frame.shape[0] * frame.shape[1])
+
+                small_frame = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale)
+            finally:
+                frame = None
+                self.frame_ring.release(reference)
+
+            gray = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
+
+            #keep our background up to date on every frame
+            motion_area, motion_boxes = self.motion_gate.apply(gray) if self.motion_gate is not None else (1.0, None)
+
+            if keyframe and self.motion_gate is not None and motion_area < self.motion_gate.min_area:
+                #nothing is moving, keep what we have (a still face stays where it is)
+                keyframe = False
+                locations, track_ids = self.tracker.track(gray)
+                self.count_skipped_pixels(gray.size, gray.size)
+                with self.motion_skipped_frames.get_lock():
+                    self.motion_skipped_frames.value += 1
+            elif keyframe:
+                locations, track_ids = self.tracker.update(gray, self.detect_faces(gray, motion_boxes))
+                with self.keyframes.get_lock():
+                    self.keyframes.value += 1
+
+                #tell our scale controller how big the faces were (in the full frame) and how long the detector took
+                if self.scale_controller is not None:
+                    self.scale_controller.observe([(bottom - top) / self.scale for (top, right, bottom, left) in locations], self.detector_seconds, self.detector_pixels)
+            else:
+                locations, track_ids = self.tracker.track(gray)
+
+            #send the faces we need to know about on to facial recognition
+            self.update_identities()
+            ids, names = self.send_to_recognizer(locations, small_frame, track_ids, capture_time)
+
+            detect_time = time.perf_counter() - starttime
+            result = DetectionResult(frame_id, capture_time, locations, self.scale, detect_time, track_ids, keyframe, self.camera)
+            result.ids, result.names = ids, names
+            self.result_queue.put(result)
+
+            #update our utilisation counters
+            with self.detect_busy_time.get_lock():
+                self.detect_busy_time.value += detect_time
+            with self.frames_detected.get_lock():
+                self.frames_detected.value += 1
+
+    '''
+        detect_faces :
+        Returns the face locations in a small (gray) frame. If we have motion boxes, only the parts of the frame that
+        moved (and the faces we are already tracking) are searched.
+    '''
+    def detect_faces(self, gray, motion_boxes = None):
+        self.detector_seconds = 0.0
+        self.detector_pixels = 0
+
+        if motion_boxes is None:
+            self.count_skipped_pixels(gray.size, 0)
+            return self.find_face_locations(gray)
+
+        height, width = gray.shape[:2]
+
+        #regions around what moved and around the faces we have (they may be sitting still)
+        regions = [grow_box(box, MOTION_MARGIN, MIN_REGION_SIZE, height, width) for box in list(motion_boxes) + list(self.tracker.boxes)]
+        regions = merge_boxes(regions)
+        region_pixels = sum((bottom - top) * (right - left) for top, right, bottom, left in regions)
+
+        #most of the frame moved, just search all of it
+        if region_pixels > MAX_REGION_AREA * gray.size:
+            self.count_skipped_pixels(gray.size, 0)
+            return self.find_face_locations(gray)
+
+        self.count_skipped_pixels(gray.size, gray.size - region_pixels)
+
+        locations = []
+        for top, right, bottom, left in regions:
+            for (face_top, face_right, face_bottom, face_left) in self.find_face_locations(np.ascontiguousarray(gray[top:bottom, left:right])):
+                locations.append((face_top + top, face_right + left, face_bottom + top, face_left + left))
+
+        return locations
+
+    '''
+        find_face_locations :
+        Runs the face detector on a (gray) image, with our upsample. Adds up how long it took and the pixels it searched.
+    '''
+    def find_face_locations(self, gray):
+        starttime = time.perf_counter()
+
+        #get our face locations
+        #cnn or hog
+        #model="hog"
+        locations = face_recognition.face_locations(gray, number_of_times_to_upsample=self.upsample)
+
+        self.detector_seconds += time.perf_counter() - starttime
+        self.detector_pixels += gray.size
+
+        return locations
+
+    '''
+        choose_scale :
+        Asks our scale controller for the scale and upsample of this keyframe. If the scale changed, our tracks are moved to it.
+    '''
+    def choose_scale(self, frame_pixels):
+        if self.scale_controller is None:
+            return
+
+        scale, upsample = self.scale_controller.choose(frame_pixels)
+
+        if scale != self.scale:
+            self.tracker.rescale(scale / self.scale)
+
+        if (scale, upsample) != (self.scale, self.upsample):
+            self.scale, self.upsample = scale, upsample
+            self.current_scale.value = scale
+            self.current_upsample.value = upsample
+            with self.scale_changes.get_lock():
+                self.scale_changes.value += 1
+
+    '''
+        scale_stats :
+        Returns the scale and upsample our stage is using and how many times it changed them.
+    '''
+    def scale_stats(self):
+        return self.current_scale.value, self.current_upsample.value, self.scale_changes.value
+
+    '''
+        count_skipped_pixels :
+        Adds a keyframe to our motion counters.
+    '''
+    def count_skipped_pixels(self, pixels, skipped):
+        with self.keyframe_pixels.get_lock():
+            self.keyframe_pixels.value += pixels
+        with self.motion_skipped_pixels.get_lock():
+            self.motion_skipped_pixels.value += skipped
+
+    '''
+        motion_stats :
+        Returns how many keyframes the motion gate skipped, how many pixels it skipped and what part of all keyframe pixels that was.
+    '''
+    def motion_stats(self):
+        return self.motion_skipped_frames.value, self.motion_skipped_pixels.value, self.motion_skipped_pixels.value / max(self.keyframe_pixels.value, 1)
+
+    '''
+        send_to_recognizer :
+        Sends the faces whose identity needs checking (see IdentityCache) to facial recognition, all in one job.
+        Returns the DetectionResult ids and names of each face, from our identity cache.
+    '''
+    def send_to_recognizer(self, locations, small_frame, track_ids, capture_time = None):
+        now = time.perf_counter()
+        self.identity_cache.prune(track_ids)
+        #boxes in the full frame, so a change in our scale does not look like a jump
+        verify = [i for i, (location, track_id) in enumerate(zip(locations, track_ids)) if self.identity_cache.needs_verify(track_id, tuple(value / self.scale for value in location), now)]
+
+        if verify and self.recognizer.submit([locations[i] for i in verify], small_frame, [track_ids[i] for i in verify], capture_time, self.camera):
+            self.identity_cache.sent([track_ids[i] for i in verify], now)
+
+            with self.faces_sent.get_lock():
+                self.faces_sent.value += len(verify)
+
+        with self.faces_cached.get_lock():
+            self.faces_cached.value += len(locations) - len(verify)
+
+        identities = [self.identity_cache.get(track_id) for track_id in track_ids]
+
+        return [identity.id if identity else None for identity in identities], [identity.name if identity else None for identity in identities]
+
+    '''
+        update_identities :
+        Runs in our stage. Adds the identities sent back by confirm_identities to our identity cache.
+    '''
+    def update_identities(self):
+        now = time.perf_counter()
+
+        while not self.identity_queue.empty():
+            for track_id, id, name, distance, margin in self.identity_queue.get():
+                self.identity_cache.confirm(track_id, id, name, distance, margin, now)
+
+    '''
+        confirm_identities :
+        Call with the faces data recognition sent back, so our stage knows who is on each track.
+    '''
+    def confirm_identities(self, faces_data):
+        identities = [(face.track_id, face.id, face.name, face.distance, face.margin) for face in faces_data if face.track_id is not None]
+
+        if identities:
+            self.identity_queue.put(identities)
+
+    '''
+        identity_stats :
+        Returns how many faces we sent to recognition and how many we knew from our identity cache.
+    '''
+    def identity_stats(self):
+        return self.faces_sent.value, self.faces_cached.value
+
+    '''
+        start :
+        Starts main loop of our stage.
+    '''
+    def start(self):
+        self.stage_timer = time.perf_counter()
+        self.stage_process.start()
+
+    '''
+        stop :
+        Terminates our stage process.
+    '''
+    def stop(self):
+        #need to terminate, join (waits for it to end) and then close
+        self.run_stage = False
+
+        if self.feed_thread is not None:
+            self.feed_thread.join(timeout=1)
+            self.feed_thread = None
+
+        self.stage_process.terminate()
+        self.stage_process.join()
+        self.stage_process.close()
+
+        self.frame_queue.close()
+        self.result_queue.close()
+        self.identity_queue.close()
+        self.frame_ring.close()
@@ -0,0 +1,574 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Used to match face encodings against our known people (the gallery). The known encodings are kept as one contiguous
+float32 matrix, so every face in a frame can be checked against every person with one numpy call.
+For very large galleries there is an inverted file index (IVFGalleryIndex), that only checks the closest clusters.
+Follow the classes below for flow.
+
+Run this file on its own to get a recall/latency report of the index against exact search.
+
+'''
+import sys
+import time
+import numpy as np
+
+ENCODING_SIZE = 128 #size of a face_recognition encoding
+FACE_MATCH_TOLERANCE = 0.6 #same default tolerance face_recognition.compare_faces uses
+MIN_CAPACITY = 64 #smallest number of rows we allocate for a gallery
+EXACT_SEARCH_THRESHOLD = 20000 #galleries smaller than this just use exact search
+DEFAULT_NPROBE = 4 #how many clusters an IVFGalleryIndex checks per face (more = better recall, slower)
+
+'''
+    squared_distances :
+    Returns the squared euclidean distance of every query (rows) to every gallery row (columns). Uses |q|^2 + |g|^2 - 2q.g,
+    so the whole thing is one matrix multiply.
+'''
+def squared_distances(queries, matrix, norms):
+    distances = queries @ matrix.T
+    distances *= -2.0
+    distances += np.einsum('ij,ij->i', queries, queries)[:, None]
+    distances += norms[None, :]
+
+    #rounding can make tiny negatives, so clip them to 0
+    np.maximum(distances, 0.0, out=distances)
+
+    return distances
+
+'''
+    to_encoding_matrix :
+    Turns a list of encodings (or a single encoding) into a contiguous float32 matrix.
+'''
+def to_encoding_matrix(encodings):
+    return np.ascontiguousarray(np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE))
+
+'''
+    top_k_rows :
+    Returns the row indexes of the k smallest distances for each query (sorted smallest first).
+'''
+def top_k_rows(distances, k):
+    if k == 1:
+        return np.argmin(distances, axis=1)[:, None]
+
+    rows = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(distances, rows, axis=1), axis=1)
+
+    return np.take_along_axis(rows, order, axis=1)
+
+'''
+    kmeans :
+    Simple k-means. Returns k centroids for the rows of matrix. Trains on a sample if the matrix is large.
+'''
+def kmeans(matrix, k, iterations = 10, seed = 0, sample_size = None):
+    matrix = to_encoding_matrix(matrix)
+    k = min(k, matrix.shape[0])
+
+    if k == 0:
+        return np.zeros((0, ENCODING_SIZE), dtype=np.float32)
+
+    random = np.random.default_rng(seed)
+
+    #train on a sample, more than enough to place the centroids
+    sample = matrix
+    if sample_size is not None and matrix.shape[0] > sample_size:
+        sample = matrix[random.choice(matrix.shape[0], sample_size, replace=False)]
+
+    centroids = sample[random.choice(sample.shape[0], k, replace=False)].copy()
+
+    for _ in range(iterations):
+        norms = np.einsum('ij,ij->i', centroids, centroids)
+        assigned = np.argmin(squared_distances(sample, centroids, norms), axis=1)
+
+        #new centroid is the mean of its rows. Empty clusters keep their old centroid
+        counts = np.bincount(assigned, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assigned, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+    return np.ascontiguousarray(centroids)
+
+'''
+    flatten_templates :
+    Our known people can each have a few encodings (templates). This turns a list of template lists (one per person) into
+    one flat list of encodings and the key of the person for each one, ready for a gallery.
+'''
+def flatten_templates(templates, keys):
+    encodings = []
+    row_keys = []
+    for person_templates, key in zip(templates, keys):
+        for template in to_encoding_matrix(person_templates):
+            encodings.append(template)
+            row_keys.append(key)
+
+    return encodings, row_keys
+
+'''
+    class GalleryMatcher :
+    Keeps our known encodings as one float32 matrix with precomputed norms. Use match to check all faces at once.
+    This is the exact (brute force) gallery index. Each row is a template with the key of the person it belongs to (gallery
+    position by default) and a person can have more than one template. Results are per person, using their closest template.
+    People can be added and removed without rebuilding and query returns the top k people for each face.
+'''
+class GalleryMatcher:
+    def __init__(self, encodings = None, keys = None, tolerance = FACE_MATCH_TOLERANCE):
+        self.tolerance = tolerance #distance at or under this is a match
+        self.build([] if encodings is None else encodings, keys)
+
+    '''
+        build :
+        Rebuilds our gallery matrix and norms. Keys are the person key for each row (the same key can be used for more than
+        one row). If no keys are sent in, the keys are the gallery positions.
+    '''
+    def build(self, encodings, keys = None):
+        matrix = to_encoding_matrix(encodings)
+
+        if keys is None:
+            keys = range(matrix.shape[0])
+
+        #allocate new storage (count of 0 so nothing old is copied) and fill it
+        self.count = 0
+        self.resize(max(matrix.shape[0], MIN_CAPACITY))
+        self.count = matrix.shape[0]
+        self.matrix_storage[:self.count] = matrix
+        self.norm_storage[:self.count] = np.einsum('ij,ij->i', matrix, matrix)
+
+        #our people. Each row points to its person and each person has a list of their rows
+        self.person_keys = [] #person -> key
+        self.positions = {} #key -> person
+        self.person_rows = [] #person -> rows
+        for row, key in enumerate(keys):
+            if key not in self.positions:
+                self.positions[key] = len(self.person_keys)
+                self.person_keys.append(key)
+                self.person_rows.append([])
+
+            self.owner_storage[row] = self.positions[key]
+            self.person_rows[self.positions[key]].append(row)
+
+        self.person_order = None #rows sorted by person, made when a query needs it
+        self.person_key_array = None #person keys as a numpy array, made when a query needs it
+
+    '''
+        resize :
+        Sets how many rows we have room for. Keeps the rows we already have.
+    '''
+    def resize(self, capacity):
+        count = getattr(self, 'count', 0)
+        matrix_storage = np.zeros((capacity, ENCODING_SIZE), dtype=np.float32)
+        norm_storage = np.zeros(capacity, dtype=np.float32)
+        owner_storage = np.zeros(capacity, dtype=np.intp)
+
+        if 'matrix_storage' in self.__dict__:
+            matrix_storage[:count] = self.matrix_storage[:count]
+            norm_storage[:count] = self.norm_storage[:count]
+            owner_storage[:count] = self.owner_storage[:count]
+
+        self.matrix_storage = matrix_storage
+        self.norm_storage = norm_storage
+        self.owner_storage = owner_storage #row -> person
+
+    @property
+    def matrix(self):
+        return self.matrix_storage[:self.count]
+
+    @property
+    def norms(self):
+        return self.norm_storage[:self.count]
+
+    @property
+    def owners(self):
+        return self.owner_storage[:self.count]
+
+    '''
+        keys :
+        The person key of every row.
+    '''
+    @property
+    def keys(self):
+        return [self.person_keys[owner] for owner in self.owners]
+
+    '''
+        __len__ :
+        Number of people in the gallery (count is the number of rows).
+    '''
+    def __len__(self):
+        return len(self.person_keys)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    '''
+        add :
+        Adds one encoding (template) for this key. If the key is new, it adds the person too. Doubles our storage when full,
+        so adding is O(1) on average. Returns the row used.
+    '''
+    def add(self, encoding, key):
+        if self.count == self.matrix_storage.shape[0]:
+            self.resize(self.count * 2)
+
+        if key not in self.positions:
+            self.positions[key] = len(self.person_keys)
+            self.person_keys.append(key)
+            self.person_rows.append([])
+
+        row = self.count
+        self.matrix_storage[row] = to_encoding_matrix(encoding)[0]
+        self.norm_storage[row] = np.dot(self.matrix_storage[row], self.matrix_storage[row])
+        self.owner_storage[row] = self.positions[key]
+        self.person_rows[self.positions[key]].append(row)
+        self.count += 1
+        self.person_order = None
+        self.person_key_array = None
+
+        return row
+
+    '''
+        remove :
+        Removes the person for this key and all their rows. The last rows are moved into their places, so removing is
+        O(number of templates).
+    '''
+    def remove(self, key):
+        person = self.positions.pop(key)
+
+        #remove rows from the end first, so a row we still need to remove is never the one moved
+        for row in sorted(self.person_rows[person], reverse=True):
+            last = self.count - 1
+
+            if row != last:
+                self.move_row(last, row)
+
+            self.count -= 1
+
+        #move the last person into this persons spot
+        last_person = len(self.person_keys) - 1
+        if person != last_person:
+            self.person_keys[person] = self.person_keys[last_person]
+            self.person_rows[person] = self.person_rows[last_person]
+            self.positions[self.person_keys[person]] = person
+            self.owner_storage[self.person_rows[person]] = person
+
+        self.person_keys.pop()
+        self.person_rows.pop()
+        self.person_order = None
+        self.person_key_array = None
+
+    '''
+        move_row :
+        Moves a row from one position to another (used by remove).
+    '''
+    def move_row(self, from_row, to_row):
+        self.matrix_storage[to_row] = self.matrix_storage[from_row]
+        self.norm_storage[to_row] = self.norm_storage[from_row]
+        self.owner_storage[to_row] = self.owner_storage[from_row]
+
+        rows = self.person_rows[self.owner_storage[to_row]]
+        rows[rows.index(from_row)] = to_row
+
+    '''
+        distances :
+        Returns a (faces x gallery rows) matrix of euclidean distances. Same values as face_recognition.face_distance, for every face.
+    '''
+    def distances(self, encodings):
+        return np.sqrt(squared_distances(to_encoding_matrix(encodings), self.matrix, self.norms))
+
+    '''
+        person_distances :
+        Reduces (faces x rows) distances to (faces x people), using the closest template of each person. Rows are sorted
+        by person once (until the gallery changes) so this is one np.minimum.reduceat call.
+    '''
+    def person_distances(self, distances):
+        #everyone has one template, so rows are already people
+        if self.count == len(self.person_keys):
+            people = np.empty_like(distances)
+            people[:, self.owners] = distances
+            return people
+
+        if self.person_order is None:
+            self.person_order = np.argsort(self.owners, kind='stable')
+            self.person_starts = np.searchsorted(self.owners[self.person_order], np.arange(len(self.person_keys)))
+
+        return np.minimum.reduceat(distances[:, self.person_order], self.person_starts, axis=1)
+
+    '''
+        query :
+        Returns the top k people keys and distances for each encoding, as 2 (faces x k) arrays. If the gallery has less than
+        k people, the extra spots have a key of None and a distance of inf.
+    '''
+    def query(self, encodings, k = 1):
+        queries = to_encoding_matrix(encodings)
+        keys = np.full((queries.shape[0], k), None, dtype=object)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        found = min(k, len(self.person_keys))
+
+        #nothing to check
+        if queries.shape[0] == 0 or found == 0:
+            return keys, distances
+
+        squared = self.person_distances(squared_distances(queries, self.matrix, self.norms))
+        people = top_k_rows(squared, found)
+        if self.person_key_array is None:
+            self.person_key_array = np.empty(len(self.person_keys), dtype=object)
+            self.person_key_array[:] = self.person_keys
+
+        keys[:, :found] = self.person_key_array[people]
+        distances[:, :found] = np.sqrt(np.take_along_axis(squared, people, axis=1))
+
+        return keys, distances
+
+    '''
+        match :
+        Scores all encodings against the gallery in one call. Returns 3 arrays (one entry per encoding) :
+        best key, distance to it and if that distance is within our tolerance.
+    '''
+    def match(self, encodings):
+        keys, distances = self.query(encodings, 1)
+
+        return keys[:, 0], distances[:, 0], distances[:, 0] <= self.tolerance
+
+'''
+    class IVFGalleryIndex :
+    Approximate gallery index for very large galleries (an inverted file). The encodings are split into nlist clusters with k-means,
+    and a query only checks the nprobe clusters closest to it. Raise nprobe for better recall, lower it for speed.
+    Adds go into the closest cluster. If a lot of people are added after building, call build again to retrain the clusters.
+'''
+class IVFGalleryIndex(GalleryMatcher):
+    def __init__(self, encodings = None, keys = None, tolerance = FACE_MATCH_TOLERANCE, nlist = None, nprobe = DEFAULT_NPROBE, train_iterations = 10, seed = 0):
+        self.nlist = nlist #number of clusters, None lets build pick one from the gallery size
+        self.nprobe = nprobe #number of clusters checked per query
+        self.train_iterations = train_iterations #k-means iterations when building
+        self.seed = seed
+        super().__init__(encodings, keys, tolerance)
+
+    '''
+        build :
+        Builds the gallery, trains the clusters and puts every row in its cluster list.
+    '''
+    def build(self, encodings, keys = None):
+        super().build(encodings, keys)
+
+        #pick our number of clusters, about the square root of the gallery size
+        nlist = self.nlist if self.nlist else int(np.sqrt(self.count))
+        nlist = max(1, min(nlist, self.count))
+
+        self.centroids = kmeans(self.matrix, nlist, self.train_iterations, self.seed, nlist * 256)
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+        #put rows into their cluster lists
+        self.lists = [[] for _ in range(self.centroids.shape[0])]
+        self.list_arrays = [None] * self.centroids.shape[0] #numpy copy of each list, made when a query needs it
+        assigned = self.nearest_centroids(self.matrix, 1)[:, 0] if self.count > 0 else []
+        for row, cluster in enumerate(assigned):
+            self.list_storage[row] = cluster
+            self.slot_storage[row] = len(self.lists[cluster])
+            self.lists[cluster].append(row)
+
+    '''
+        resize :
+        Same as GalleryMatcher, but also keeps the cluster of each row and its slot in that clusters list.
+    '''
+    def resize(self, capacity):
+        count = getattr(self, 'count', 0)
+        list_storage = np.zeros(capacity, dtype=np.intp)
+        slot_storage = np.zeros(capacity, dtype=np.intp)
+
+        if 'list_storage' in self.__dict__:
+            list_storage[:count] = self.list_storage[:count]
+            slot_storage[:count] = self.slot_storage[:count]
+
+        super().resize(capacity)
+        self.list_storage = list_storage #row -> cluster
+        self.slot_storage = slot_storage #row -> position in its clusters list
+
+    '''
+        nearest_centroids :
+        Returns the n closest clusters for each query.
+    '''
+    def nearest_centroids(self, queries, n):
+        return top_k_rows(squared_distances(queries, self.centroids, self.centroid_norms), min(n, self.centroids.shape[0]))
+
+    '''
+        add :
+        Adds the encoding and puts it into its closest cluster.
+    '''
+    def add(self, encoding, key):
+        row = super().add(encoding, key)
+
+        if self.centroids.shape[0] == 0:
+            #first row in an empty gallery becomes our only cluster
+            self.centroids = self.matrix[:1].copy()
+            self.centroid_norms = self.norms[:1].copy()
+            self.lists = [[]]
+            self.list_arrays = [None]
+
+        cluster = self.nearest_centroids(self.matrix[row:row + 1], 1)[0, 0]
+        self.list_storage[row] = cluster
+        self.slot_storage[row] = len(self.lists[cluster])
+        self.lists[cluster].append(row)
+        self.list_arrays[cluster] = None
+
+        return row
+
+    '''
+        remove :
+        Takes the persons rows out of their cluster lists first, then removes them from the gallery.
+    '''
+    def remove(self, key):
+        for row in self.person_rows[self.positions[key]]:
+            cluster_list = self.lists[self.list_storage[row]]
+            slot = self.slot_storage[row]
+            self.list_arrays[self.list_storage[row]] = None
+
+            #move the last row in this cluster list into our slot
+            moved = cluster_list.pop()
+            if moved != row:
+                cluster_list[slot] = moved
+                self.slot_storage[moved] = slot
+
+        super().remove(key)
+
+    '''
+        move_row :
+        Moves the row and points its cluster list at the new row.
+    '''
+    def move_row(self, from_row, to_row):
+        super().move_row(from_row, to_row)
+        self.list_storage[to_row] = self.list_storage[from_row]
+        self.slot_storage[to_row] = self.slot_storage[from_row]
+        self.lists[self.list_storage[to_row]][self.slot_storage[to_row]] = to_row
+        self.list_arrays[self.list_storage[to_row]] = None
+
+    '''
+        cluster_rows :
+        Returns the rows in this cluster as a numpy array. Kept until the cluster changes.
+    '''
+    def cluster_rows(self, cluster):
+        if self.list_arrays[cluster] is None:
+            self.list_arrays[cluster] = np.array(self.lists[cluster], dtype=np.intp)
+
+        return self.list_arrays[cluster]
+
+    '''
+        query :
+        Same as GalleryMatcher.query, but only checks the rows in the nprobe closest clusters of each encoding.
+    '''
+    def query(self, encodings, k = 1):
+        queries = to_encoding_matrix(encodings)
+
+        #if we check every cluster anyway, exact search is faster
+        if self.count == 0 or self.nprobe >= self.centroids.shape[0]:
+            return super().query(queries, k)
+
+        keys = np.full((queries.shape[0], k), None, dtype=object)
+        distances = np.full((queries.shape[0], k), np.inf, dtype=np.float32)
+        probes = self.nearest_centroids(queries, self.nprobe)
+
+        #check each face against the rows in its closest clusters
+        for i in range(queries.shape[0]):
+            rows = np.concatenate([self.cluster_rows(cluster) for cluster in probes[i]])
+
+            if rows.shape[0] == 0:
+                continue
+
+            squared = squared_distances(queries[i:i + 1], self.matrix_storage[rows], self.norm_storage[rows])[0]
+
+            #closest template of each person we found
+            people, inverse = np.unique(self.owner_storage[rows], return_inverse=True)
+            person_squared = np.full(people.shape[0], np.inf, dtype=squared.dtype)
+            np.minimum.at(person_squared, inverse, squared)
+
+            found = min(k, people.shape[0])
+            best = top_k_rows(person_squared[None, :], found)[0]
+            keys[i, :found] = [self.person_keys[person] for person in people[best]]
+            distances[i, :found] = np.sqrt(person_squared[best])
+
+        return keys, distances
+
+'''
+    create_gallery_index :
+    Creates our gallery index. Small galleries use exact search (GalleryMatcher), large ones use an IVFGalleryIndex.
+'''
+def create_gallery_index(encodings, keys = None, tolerance = FACE_MATCH_TOLERANCE, exact_threshold = EXACT_SEARCH_THRESHOLD, **ivf_options):
+    if len(encodings) < exact_threshold:
+        return GalleryMatcher(encodings, keys, tolerance)
+
+    return IVFGalleryIndex(encodings, keys, tolerance, **ivf_options)
+
+'''
+    recall_latency_report :
+    Checks an index against exact search. Returns a dict with recall@k (how many of the exact top k the index also found)
+    and the average query time in milliseconds for both.
+'''
+def recall_latency_report(index, queries, k = 1, batch_size = 4):
+    queries = to_encoding_matrix(queries)
+    exact = GalleryMatcher(index.matrix, index.keys, index.tolerance)
+
+    #query in small batches, like the faces in a frame
+    exact_keys = []
+    index_keys = []
+    exact_time = 0.0
+    index_time = 0.0
+    for start in range(0, queries.shape[0], batch_size):
+        batch = queries[start:start + batch_size]
+
+        timer = time.perf_counter()
+        exact_keys.extend(exact.query(batch, k)[0])
+        exact_time += time.perf_counter() - timer
+
+        timer = time.perf_counter()
+        index_keys.extend(index.query(batch, k)[0])
+        index_time += time.perf_counter() - timer
+
+    #recall is how many of the exact keys the index also returned
+    hits = sum(len(set(e) & set(i)) for e, i in zip(exact_keys, index_keys))
+    batches = max(1, -(-queries.shape[0] // batch_size))
+
+    return {'gallery': len(index),
+            'queries': queries.shape[0],
+            'k': k,
+            'recall': hits / max(1, queries.shape[0] * min(k, len(index))),
+            'exact_ms': exact_time * 1000 / batches,
+            'index_ms': index_time * 1000 / batches,
+            'speedup': exact_time / index_time if index_time > 0 else float('inf')}
+
+'''
+    print_recall_latency_report :
+    Prints our recall/latency report for a few nprobe values, so we can pick the one that fits our frame budget.
+'''
+def print_recall_latency_report(index, queries, k = 1, nprobes = (1, 2, 4, 8, 16, 32)):
+    print('Gallery : ' + str(len(index)) + ', clusters : ' + str(index.centroids.shape[0]) + ', queries : ' + str(len(queries)) + ', k : ' + str(k))
+
+    for nprobe in nprobes:
+        index.nprobe = nprobe
+        report = recall_latency_report(index, queries, k)
+        print('nprobe ' + str(nprobe).rjust(3) +
+              ' : recall ' + format(report['recall'], '.3f') +
+              ', exact ' + format(report['exact_ms'], '.2f') + ' ms' +
+              ', index ' + format(report['index_ms'], '.2f') + ' ms' +
+              ', speedup ' + format(report['speedup'], '.1f') + 'x')
+
+'''
+    synthetic_gallery :
+    Makes a fake gallery of encodings, grouped around people like real face encodings are. Used for our report.
+'''
+def synthetic_gallery(size, seed = 0):
+    random = np.random.default_rng(seed)
+    centers = random.normal(0.0, 0.1, (max(1, size // 50), ENCODING_SIZE))
+    encodings = centers[random.integers(0, centers.shape[0], size)] + random.normal(0.0, 0.03, (size, ENCODING_SIZE))
+
+    return encodings.astype(np.float32)
+
+if __name__ == "__main__":
+    #gallery size can be sent in, ex: python face_gallery.py 100000
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    encodings = synthetic_gallery(size)
+    queries = encodings[np.random.default_rng(1).choice(size, 200, replace=False)] + np.random.default_rng(2).normal(0.0, 0.02, (200, ENCODING_SIZE)).astype(np.float32)
+
+    timer = time.perf_counter()
+    index = IVFGalleryIndex(encodings, range(size))
+    print('Build time : ' + format(time.perf_counter() - timer, '.2f') + ' s')
+
+    print_recall_latency_report(index, queries, 1)
+    print_recall_latency_report(index, queries, 5)
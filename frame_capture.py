@@ -0,0 +1,270 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Reads a video device on its own thread, into a small ring of frames made once. The GUI and face detection
+take the latest frame whenever they are ready, so a slow consumer never leaves stale frames sitting in the driver.
+Follow the class below for flow.
+
+'''
+import os
+import time
+import threading
+import numpy as np
+import cv2
+
+DEFAULT_CAPTURE_SLOTS = 3 #frames our ring holds (the latest one, and room to write the next ones)
+MAX_READ_FAILURES = 30 #failed reads in a row before we decide the device is gone
+IMAGE_FRAME_RATE = 2.0 #images per second an image directory source gives
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp') #files an image directory source reads
+
+'''
+    class CaptureThread :
+    Reads frames from a cv2.VideoCapture as fast as it gives them, into a ring of slot_count frames (made on the first
+    frame). Each frame gets a sequence number and a time.perf_counter() timestamp. latest returns the newest frame,
+    use_latest lends it to a function without copying. Frames nobody took before the next one came are counted as dropped.
+'''
+class CaptureThread:
+    def __init__(self, capture, slot_count = DEFAULT_CAPTURE_SLOTS, name = 'capture', max_failures = MAX_READ_FAILURES, frame_rate = None):
+        self.capture = capture #our opened cv2.VideoCapture
+        self.frame_rate = frame_rate #most frames per second we read (for video files, so they play in real time). None reads as fast as we can
+        self.slot_count = max(2, slot_count)
+        self.name = name
+        self.max_failures = max_failures
+        self.slots = [None] * self.slot_count #our frames, made on the first read
+        self.timestamps = [0.0] * self.slot_count #when each slot was captured
+        self.latest_slot = -1 #slot of the newest frame
+        self.sequence = -1 #sequence number of the newest frame
+        self.condition = threading.Condition() #guards the newest frame, and lets readers wait for the next one
+        self.frames_captured = 0 #frames read from the device
+        self.frames_read = 0 #frames taken by a consumer (each frame counted once)
+        self.last_read_sequence = -1
+        self.read_failures = 0 #reads that failed
+        self.frame_shape = None #shape of our frames, once we have one
+        self.running = False
+        self.failed = False #True if the device stopped giving frames
+        self.thread = None
+
+        #ask the driver not to keep old frames for us (not every backend can)
+        self.capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    '''
+        start :
+        Starts reading frames.
+    '''
+    def start(self):
+        self.running = True
+        self.failed = False
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    '''
+        stop :
+        Stops reading frames and waits for our thread to end. Does not release the capture device.
+    '''
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+    '''
+        run :
+        Our thread. Reads each frame straight into the slot after the newest one, then makes it the newest.
+    '''
+    def run(self):
+        slot = 0
+        failures = 0
+        next_read = time.perf_counter()
+
+        while self.running:
+            #video files give frames as fast as we ask, wait until this frame is due
+            if self.frame_rate:
+                time.sleep(max(0.0, next_read - time.perf_counter()))
+
+            buffer = self.slots[slot]
+            ret, frame = self.capture.read(buffer) if buffer is not None else self.capture.read()
+            timestamp = time.perf_counter()
+
+            if not ret or frame is None:
+                failures += 1
+                self.read_failures += 1
+
+                #device is gone
+                if failures >= self.max_failures:
+                    self.failed = True
+                    break
+
+                time.sleep(0.01)
+                continue
+
+            failures = 0
+
+            #next frame is due one frame later (failed reads do not wait, so the end of a file is found fast)
+            if self.frame_rate:
+                next_read = max(next_read + 1.0 / self.frame_rate, time.perf_counter() - 1.0 / self.frame_rate)
+
+            #first frame, make our ring. If the device changed size, the read made a new frame for this slot
+            if buffer is None:
+                self.slots = [np.empty_like(frame) for _ in range(self.slot_count)]
+                self.slots[slot][...] = frame
+            elif frame is not buffer:
+                self.slots[slot] = frame
+
+            with self.condition:
+                self.latest_slot = slot
+                self.sequence += 1
+                self.timestamps[slot] = timestamp
+                self.frames_captured += 1
+                self.frame_shape = frame.shape
+                self.condition.notify_all()
+
+            slot = (slot + 1) % self.slot_count
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    '''
+        wait_newer :
+        Call holding our condition. Waits up to timeout for a frame newer than after. Returns True if we have one.
+    '''
+    def wait_newer(self, after, timeout):
+        if after is not None and timeout > 0:
+            self.condition.wait_for(lambda: self.sequence > after or not self.running, timeout)
+
+        return self.latest_slot >= 0 and (after is None or self.sequence > after)
+
+    '''
+        mark_read :
+        Call holding our condition. Counts the newest frame as taken.
+    '''
+    def mark_read(self):
+        if self.sequence != self.last_read_sequence:
+            self.frames_read += 1
+            self.last_read_sequence = self.sequence
+
+    '''
+        latest :
+        Returns (copy of the newest frame, its sequence number, its timestamp). If after is sent, only a frame newer than
+        that sequence number is returned, waiting up to timeout for one. (None, sequence, None) if there is none.
+    '''
+    def latest(self, after = None, timeout = 0):
+        with self.condition:
+            if not self.wait_newer(after, timeout):
+                return None, self.sequence, None
+
+            self.mark_read()
+
+            return self.slots[self.latest_slot].copy(), self.sequence, self.timestamps[self.latest_slot]
+
+    '''
+        use_latest :
+        Calls function(frame, timestamp) with the newest frame, without copying it (the frame is only good inside function).
+        Same after and timeout as latest. Returns the sequence number of the frame used, or None if there was none.
+    '''
+    def use_latest(self, function, after = None, timeout = 0):
+        with self.condition:
+            if not self.wait_newer(after, timeout):
+                return None
+
+            self.mark_read()
+            function(self.slots[self.latest_slot], self.timestamps[self.latest_slot])
+
+            return self.sequence
+
+    '''
+        wait_for_frame :
+        Waits up to timeout seconds for our first frame. Returns True if we have one.
+    '''
+    def wait_for_frame(self, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence >= 0 or not self.running, timeout)
+            return self.sequence >= 0
+
+    '''
+        is_running :
+        Returns True while our thread is reading frames.
+    '''
+    def is_running(self):
+        return self.running
+
+    '''
+        stats :
+        Returns frames captured, frames taken by a consumer, frames dropped (nobody took them) and failed reads.
+    '''
+    def stats(self):
+        with self.condition:
+            return {'captured': self.frames_captured,
+                    'read': self.frames_read,
+                    'dropped': self.frames_captured - self.frames_read,
+                    'read_failures': self.read_failures}
+
+'''
+    class ImageDirectoryCapture :
+    Reads the images in a directory (in name order) like a cv2.VideoCapture reads frames, so an image directory can be
+    a source for CaptureThread. read returns False once every image was read.
+'''
+class ImageDirectoryCapture:
+    def __init__(self, directory):
+        self.directory = directory
+        self.paths = sorted(os.path.join(directory, filename) for filename in os.listdir(directory) if filename.lower().endswith(IMAGE_EXTENSIONS)) if os.path.isdir(directory) else []
+        self.position = 0 #next image we read
+
+    def isOpened(self):
+        return len(self.paths) > 0
+
+    def set(self, property, value):
+        return False
+
+    def get(self, property):
+        if property == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.paths)
+        return 0
+
+    '''
+        read :
+        Returns (True, next image) or (False, None) when there are none left. The image is read into frame if it is the
+        same shape, like cv2.VideoCapture.read.
+    '''
+    def read(self, frame = None):
+        while self.position < len(self.paths):
+            image = cv2.imread(self.paths[self.position])
+            self.position += 1
+
+            #not an image we can read, try the next one
+            if image is None:
+                continue
+
+            if frame is not None and frame.shape == image.shape:
+                frame[...] = image
+                return True, frame
+
+            return True, image
+
+        return False, None
+
+    def release(self):
+        self.paths = []
+
+'''
+    open_source :
+    Opens a source for CaptureThread : a device index (int, or a string of digits), an image directory or a video file.
+    Returns (capture, frame rate to read it at). The capture is not opened if isOpened is False.
+'''
+def open_source(source, image_frame_rate = IMAGE_FRAME_RATE):
+    if isinstance(source, int) or (isinstance(source, str) and source.isdigit()):
+        return cv2.VideoCapture(int(source)), None
+
+    if os.path.isdir(source):
+        return ImageDirectoryCapture(source), image_frame_rate
+
+    #video files play at their own frame rate
+    capture = cv2.VideoCapture(source)
+    frame_rate = capture.get(cv2.CAP_PROP_FPS) if capture.isOpened() else 0
+
+    return capture, frame_rate if frame_rate > 0 else None
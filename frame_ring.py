@@ -0,0 +1,124 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : A ring of frame slots in shared memory, so frames can go from one process to another without being pickled
+through a pipe. Only a small reference (slot, generation, shape) goes through the queue.
+Follow the class below for flow.
+
+'''
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+DEFAULT_SLOT_COUNT = 8 #number of frames the ring can hold at once
+DEFAULT_SLOT_SIZE = 960 * 540 * 3 #bytes per slot, big enough for half of a 1080p frame
+
+'''
+    class FrameRing :
+    A fixed number of frame slots in one block of shared memory. write copies a frame into a free slot and returns a
+    reference to it. Each slot has a generation counter (bumped every write) and a reference count (readers still using it).
+    A slot is only reused when its reference count is 0, and a reference with an old generation is never read.
+    Send the FrameRing to other processes (it is pickled by the name of its shared memory).
+'''
+class FrameRing:
+    def __init__(self, slot_count = DEFAULT_SLOT_COUNT, slot_size = DEFAULT_SLOT_SIZE):
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.memory = shared_memory.SharedMemory(create=True, size=slot_count * slot_size)
+        self.owner = True #only the process that created the memory unlinks it
+        self.generations = multiprocessing.Array('q', slot_count) #generation of the frame in each slot
+        self.references = multiprocessing.Array('i', slot_count, lock=False) #readers still using each slot
+        self.lock = multiprocessing.Lock() #guards generations and references
+        self.dropped = multiprocessing.Value('i', 0) #frames we could not write, because every slot was in use
+        self.next_slot = 0 #where the writer looks for a free slot first
+
+    '''
+        __getstate__ :
+        Send everything but our shared memory handle, other processes open it again by name.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory'] = self.memory.name
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memory = shared_memory.SharedMemory(name=state['memory'])
+
+    '''
+        write :
+        Copies a frame into the next free slot. readers is how many release calls the slot needs before it can be reused.
+        Returns a reference (slot, generation, shape, dtype), or None if every slot is in use (the frame is dropped,
+        and counted unless count_dropped is False).
+    '''
+    def write(self, frame, readers = 1, count_dropped = True):
+        frame = np.ascontiguousarray(frame)
+
+        if frame.nbytes > self.slot_size:
+            raise ValueError('Frame of ' + str(frame.nbytes) + ' bytes does not fit in a ' + str(self.slot_size) + ' byte slot')
+
+        with self.lock:
+            #find a free slot, starting after the last one we used
+            for i in range(self.slot_count):
+                slot = (self.next_slot + i) % self.slot_count
+                if self.references[slot] == 0:
+                    break
+            else:
+                if count_dropped:
+                    self.dropped.value += 1
+                return None
+
+            self.references[slot] = readers
+            self.generations[slot] += 1
+            generation = self.generations[slot]
+
+        self.next_slot = (slot + 1) % self.slot_count
+        self.view(slot, frame.shape, frame.dtype)[...] = frame
+
+        return (slot, generation, frame.shape, frame.dtype.str)
+
+    '''
+        view :
+        Returns a numpy array on top of a slot (no copy).
+    '''
+    def view(self, slot, shape, dtype):
+        return np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=slot * self.slot_size)
+
+    '''
+        read :
+        Returns the frame for a reference, as a view of the slot (or a copy, if copy is True).
+        Returns None if the slot was already reused for a newer frame.
+    '''
+    def read(self, reference, copy = False):
+        slot, generation, shape, dtype = reference
+
+        if self.generations[slot] != generation:
+            return None
+
+        frame = self.view(slot, shape, dtype)
+
+        return frame.copy() if copy else frame
+
+    '''
+        release :
+        Call when done with a reference. When every reader released it, the slot can be written again.
+    '''
+    def release(self, reference):
+        slot, generation = reference[0], reference[1]
+
+        with self.lock:
+            if self.generations[slot] == generation and self.references[slot] > 0:
+                self.references[slot] -= 1
+
+    '''
+        close :
+        Closes our shared memory. The process that created the ring also frees it.
+    '''
+    def close(self):
+        self.memory.close()
+
+        if self.owner:
+            self.memory.unlink()
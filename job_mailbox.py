@@ -0,0 +1,190 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : A bounded mailbox for sending jobs from one process to others. When it is full it drops jobs (or waits) by
+a policy, so jobs can not pile up when the workers fall behind.
+Follow the class below for flow.
+
+'''
+import time
+import queue
+import multiprocessing
+
+DROP_OLDEST = 'drop_oldest' #when full, drop the oldest job waiting to make room
+KEEP_LATEST = 'keep_latest' #drop every job waiting, only the newest one is kept
+BLOCK = 'block' #when full, wait up to timeout for room, then drop the new job
+MAILBOX_POLICIES = (DROP_OLDEST, KEEP_LATEST, BLOCK)
+
+DEFAULT_CAPACITY = 8 #most jobs waiting at once
+DEFAULT_BLOCK_TIMEOUT = 0.05 #seconds put waits for room with the block policy
+TAKE_TIMEOUT = 0.01 #seconds we wait to take out a job we know is waiting (it may still be on its way through the queue's pipe)
+DRAIN_TIMEOUT = 0.1 #most seconds drain waits for a job it counts as waiting, before it gives up on it (ex: a worker was stopped while taking it)
+
+'''
+    class JobMailbox :
+    A multiprocessing queue that holds at most capacity jobs. put follows our policy when it is full and returns the jobs
+    it dropped, so the sender can clean up after them. get works like queue.get and adds up how long each job waited.
+    We count the jobs waiting ourselves, since the queue can look empty while a job is still on its way through its pipe.
+    Send the JobMailbox to other processes, the counters are shared.
+'''
+class JobMailbox:
+    def __init__(self, capacity = DEFAULT_CAPACITY, policy = DROP_OLDEST, timeout = DEFAULT_BLOCK_TIMEOUT):
+        if policy not in MAILBOX_POLICIES:
+            raise ValueError('Unknown mailbox policy ' + str(policy) + ', use one of ' + ', '.join(MAILBOX_POLICIES))
+
+        self.capacity = max(1, capacity)
+        self.policy = policy
+        self.timeout = timeout
+        self.queue = multiprocessing.Queue(self.capacity) #(time put, job)
+        self.put_count = multiprocessing.Value('i', 0) #jobs sent
+        self.dropped = multiprocessing.Value('i', 0) #jobs dropped by our policy
+        self.received = multiprocessing.Value('i', 0) #jobs taken out
+        self.wait_time = multiprocessing.Value('d', 0.0) #seconds the jobs taken out waited
+        self.max_wait_time = multiprocessing.Value('d', 0.0) #longest a job waited
+        self.waiting = multiprocessing.Value('i', 0) #jobs put and not taken out yet
+
+    '''
+        put :
+        Sends a job. Returns (True if the job was accepted, list of jobs dropped to make room or the job itself if it was not).
+    '''
+    def put(self, job):
+        dropped = []
+        item = (time.perf_counter(), job)
+
+        if self.policy == KEEP_LATEST:
+            #take out everything waiting, only our new job stays
+            dropped = self.drain()
+            accepted = self.put_dropping_oldest(item, dropped)
+        elif self.policy == DROP_OLDEST:
+            accepted = self.put_dropping_oldest(item, dropped)
+        else:
+            self.add_waiting(1)
+            try:
+                self.queue.put(item, timeout=self.timeout)
+                accepted = True
+            except queue.Full:
+                self.add_waiting(-1)
+                dropped.append(job)
+                accepted = False
+
+        with self.put_count.get_lock():
+            self.put_count.value += 1
+        if dropped:
+            with self.dropped.get_lock():
+                self.dropped.value += len(dropped)
+
+        return accepted, dropped
+
+    '''
+        put_dropping_oldest :
+        Puts our item, taking out the oldest jobs (added to dropped) until there is room.
+    '''
+    def put_dropping_oldest(self, item, dropped):
+        while True:
+            self.add_waiting(1)
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except queue.Full:
+                self.add_waiting(-1)
+
+            #a worker may take it first, then there is room on the next try
+            try:
+                dropped.append(self.take(TAKE_TIMEOUT)[1])
+            except queue.Empty:
+                pass
+
+    '''
+        add_waiting :
+        Adds count (1 or -1) to the jobs waiting.
+    '''
+    def add_waiting(self, count):
+        with self.waiting.get_lock():
+            self.waiting.value += count
+
+    '''
+        take :
+        Takes the next (time put, job) out of our queue, like queue.get, and counts it as no longer waiting.
+    '''
+    def take(self, timeout = None, block = True):
+        item = self.queue.get(block, timeout)
+        self.add_waiting(-1)
+
+        return item
+
+    '''
+        drop_oldest :
+        Takes out the oldest job waiting and counts it as dropped. Returns a list with it (empty if nothing was waiting).
+    '''
+    def drop_oldest(self):
+        try:
+            dropped = [self.take(TAKE_TIMEOUT)[1]]
+        except queue.Empty:
+            return []
+
+        with self.dropped.get_lock():
+            self.dropped.value += 1
+
+        return dropped
+
+    '''
+        drain :
+        Takes out every job waiting (without counting them as received). Returns them. Uses our count of jobs waiting,
+        not queue.empty, so a job still on its way through the queue's pipe is taken out too. A job a worker takes while
+        we wait for it is left to them.
+    '''
+    def drain(self):
+        jobs = []
+        deadline = time.perf_counter() + DRAIN_TIMEOUT
+
+        while self.waiting.value > 0:
+            try:
+                jobs.append(self.take(TAKE_TIMEOUT)[1])
+                deadline = time.perf_counter() + DRAIN_TIMEOUT
+            except queue.Empty:
+                if time.perf_counter() >= deadline:
+                    break
+
+        return jobs
+
+    '''
+        get :
+        Returns the next job, like queue.get (raises queue.Empty if none came in time).
+    '''
+    def get(self, block = True, timeout = None):
+        put_time, job = self.take(timeout, block)
+        wait = time.perf_counter() - put_time
+
+        with self.received.get_lock():
+            self.received.value += 1
+        with self.wait_time.get_lock():
+            self.wait_time.value += wait
+            self.max_wait_time.value = max(self.max_wait_time.value, wait)
+
+        return job
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def empty(self):
+        return self.queue.empty()
+
+    def close(self):
+        self.queue.close()
+
+    '''
+        stats :
+        Returns our policy and counters : jobs sent, dropped, received and the mean and longest wait in seconds.
+    '''
+    def stats(self):
+        received = self.received.value
+
+        return {'policy': self.policy,
+                'capacity': self.capacity,
+                'put': self.put_count.value,
+                'dropped': self.dropped.value,
+                'received': received,
+                'mean_wait': self.wait_time.value / received if received else 0.0,
+                'max_wait': self.max_wait_time.value}
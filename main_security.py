@@ -13,6 +13,17 @@ no slowdown, while it detects faces. A separate core will be send the face infor
 Files Needed :
 
 face_data.py
+face_gallery.py
+frame_ring.py
+face_detection.py
+job_mailbox.py
+frame_capture.py
+camera_pipeline.py
+sightings.py
+sighting_log.py
+sighting_db.py
+visit_index.py
+sighting_archive.py
 
 '''
 import face_recognition
@@ -31,6 +42,16 @@ import multiprocessing
 import tkinter.ttk as ttk
 from pygrabber.dshow_graph import FilterGraph
 import face_data
+import face_gallery
+import face_detection
+import job_mailbox
+import frame_capture
+import camera_pipeline
+import sightings
+import sighting_log
+import sighting_db
+import visit_index
+import sighting_archive
 from datetime import datetime
 import datetime
 import pandas as pd
@@ -39,6 +60,8 @@ import gc
 #Globals
 ENCODING_DIRECTORY = "Face Data" #directory used for data on people and their faces
 REMOVE_FACE_TIME = 1 * 60 # minutes x 60 seconds (mins in seconds)
+RECOGNITION_MAILBOX_POLICY = job_mailbox.DROP_OLDEST #what to do when recognition falls behind (see job_mailbox.py)
+STALE_RECOGNITION_TIME = 1.0 #seconds behind the camera before we show recognition is stale
 
 #use directory like this, because saving to cvs with pandas has issues when i used os
 PANDAS_FILENAME1 = "db_data/data1.cvs" #stores details on people
@@ -49,6 +72,12 @@ PANDAS_REAL_FILE1 = "data1.cvs" #stores details on people
 PANDAS_REAL_FILE2 = "data2.cvs" #stores the ID of person and date/times they were seen
 PANDAS_DIRECT = "db_data" #directory for these files
 
+STORAGE_BACKEND = 'csv' #'csv' saves to the pandas files above, 'sqlite' to DATABASE_FILENAME, 'archive' sightings to ARCHIVE_DIRECTORY (our CSV files are imported the first time)
+DATABASE_FILENAME = "db_data/security.db" #SQLite database of people and sightings (see sighting_db.py)
+ARCHIVE_DIRECTORY = "db_data/sightings" #sightings split by time (see sighting_archive.py), people stay in PANDAS_FILENAME1
+ARCHIVE_PARTITION_DAYS = 1 #days each archive partition holds
+ARCHIVE_RETENTION_DAYS = None #days of sightings the archive keeps (older ones are rolled up and dropped). None keeps them all
+
 #apps background color
 BACKGROUND_COLOR = "FloralWhite"
 
@@ -80,6 +109,9 @@ class VideoRecorder:
         #init to -1, so we know no device to use yet (0 and up good)
         self.device_num = -1
 
+        #more cameras (CameraPipeline) watched at the same time as our video device, each in its own window
+        self.extra_cameras = []
+
         #init our known facial data
         self.init_Known_Facial_Data(ENCODING_DIRECTORY, True)
 
@@ -207,7 +239,6 @@ class VideoRecorder:
 
             #load capture device and set initialized to true
             self.cap = cv2.VideoCapture(self.device_num)            
-            self.backSub = cv2.createBackgroundSubtractorMOG2()
 
             #lets us know if webcam is processing
             self.webcam_processing = False
@@ -275,6 +306,11 @@ class VideoRecorder:
             self.valid_init = False
             return
         
+        #read our device on its own thread, the GUI and face detection take its newest frame at their own rates
+        if 'capture_thread' not in self.__dict__:
+            self.capture_thread = frame_capture.CaptureThread(self.cap)
+            self.capture_thread.start()
+            self.frame_sequence = -1 #sequence number of the last frame we drew
 
         self.process_Webcam_Device()
     
@@ -292,18 +328,28 @@ class VideoRecorder:
         #turn on webcam process flag
         self.webcam_processing = True
 
-        ret, frame = self.cap.read()
+        #newest frame from our capture thread (None if there is no new one since we last drew)
+        frame, sequence, capture_time = self.capture_thread.latest(after=self.frame_sequence)
+        ret = not self.capture_thread.failed
 
         #found video device
         if ret:
 
+            #nothing new to draw, check again soon
+            if frame is None:
+                self._label.after(5, self.process_Webcam_Device)
+                self.webcam_processing = False
+                return
+
+            self.frame_sequence = sequence
+
             #make sure we are doing multithread
             if 'app_loop_face' in self.__dict__ :
                 #turn on face check run
                 self.face_check_run = True
 
-                #check for faces and return the locations and names for each face
-                locations = self.face_check(frame)
+                #get the newest boxes face detection found (it takes frames from our capture thread itself)
+                detection = self.face_check(frame)
 
                 #update current face listbox
                 self.check_names_listbox_remove(REMOVE_FACE_TIME)
@@ -312,19 +358,15 @@ class VideoRecorder:
                 self.face_check_run = False
 
 
-                if len(locations) == 0:
+                if detection is None or len(detection.locations) == 0:
                     #self.name_label.config(text='No one detected.')
                     pass
                 else:
-                    for (top, right, bottom, left) in locations:
-                    # Scale back up face locations since the frame we detected in was scaled to 1/4 size
-                        top *= 2
-                        right *= 2
-                        bottom *= 2
-                        left *= 2
+                    self.draw_detection(frame, detection)
 
-                        # Draw a box around the face
-                        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+                #show when recognition results are behind the camera (from when their frame was captured)
+                if 'app_loop_face' in self.__dict__ and self.app_loop_face.result_latency is not None and self.app_loop_face.result_latency > STALE_RECOGNITION_TIME:
+                    cv2.putText(frame, 'Recognition ' + format(self.app_loop_face.result_latency, '.1f') + ' s behind', (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 255), 2)
 
             self.most_recent_capture_arr = frame
             img_ = cv2.cvtColor(self.most_recent_capture_arr, cv2.COLOR_BGR2RGB)
@@ -351,6 +393,103 @@ class VideoRecorder:
         #turn off webcam process flag
         self.webcam_processing = False
 
+    '''
+        draw_detection :
+        Draws the face boxes (and names recognition found) of a DetectionResult on its camera's frame.
+    '''
+    def draw_detection(self, frame, detection):
+        #record how old the boxes we draw are (from when their frame was captured)
+        detection.box_age = detection.age()
+
+        #locations are scaled back up to our full frame
+        for (top, right, bottom, left), name in zip(detection.full_frame_locations(), detection.names):
+            # Draw a box around the face
+            cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+
+            #name who recognition found on this track, if we know
+            if name is not None:
+                cv2.putText(frame, name, (left, bottom + 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+
+    '''
+        add_extra_camera :
+        Opens another video device, as one more camera shown in its own window. Its faces go to the same facial
+        recognition as our video device, the next time face detection starts.
+    '''
+    def add_extra_camera(self, device_num) -> None:
+        #reset device num
+        self.device_num = -1
+
+        #lowest camera id not in use (our video device is camera 0)
+        used = [pipeline.camera for pipeline in self.extra_cameras]
+        camera = 1
+        while camera in used:
+            camera += 1
+
+        pipeline = camera_pipeline.CameraPipeline(camera, device_num, self.check_Input_Devices()[device_num])
+
+        if not pipeline.open():
+            messagebox.showerror('No Capture Device', 'Error : Could not open ' + pipeline.name + '. Make sure it is plugged in and enabled.')
+            return
+
+        self.extra_cameras.append(pipeline)
+
+        #each camera gets its own window
+        window = tk.Toplevel()
+        window.title(pipeline.name + ' (Camera ' + str(camera) + ')')
+        window.configure(bg=BACKGROUND_COLOR)
+        label = ttk.Label(window, background=BACKGROUND_COLOR)
+        label.pack(fill='both', expand=True)
+
+        #capture close event
+        window.protocol("WM_DELETE_WINDOW", lambda: self.remove_extra_camera(pipeline, window))
+
+        self.process_extra_camera(pipeline, label)
+
+    '''
+        process_extra_camera :
+        Draws the newest frame of one of our extra cameras, with the faces its detection stage found, to its window.
+    '''
+    def process_extra_camera(self, pipeline, label) -> None:
+        #camera was closed
+        if pipeline not in self.extra_cameras:
+            return
+
+        #video device error
+        if not pipeline.is_open():
+            messagebox.showerror('No Video Device Found!', pipeline.name + ' cannot be found! Please check connections.')
+            self.remove_extra_camera(pipeline, label.winfo_toplevel())
+            return
+
+        frame, capture_time = pipeline.latest_frame()
+
+        #nothing new to draw if there is no new frame
+        if frame is not None:
+            detection = pipeline.latest_result()
+
+            if detection is not None:
+                #known faces on tracks are not sent to recognition every time, so update when we last saw them here
+                self.update_tracked_faces(detection)
+
+                if len(detection.locations) > 0:
+                    self.draw_detection(frame, detection)
+
+            imgtk = ImageTk.PhotoImage(image=Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
+            label.imgtk = imgtk
+            label.configure(image=imgtk)
+
+        label.after(15, lambda: self.process_extra_camera(pipeline, label))
+
+    '''
+        remove_extra_camera :
+        Closes one of our extra cameras and its window.
+    '''
+    def remove_extra_camera(self, pipeline, window) -> None:
+        if pipeline in self.extra_cameras:
+            self.extra_cameras.remove(pipeline)
+
+        pipeline.close()
+        window.destroy()
+
     '''
         stop_Webcam_Device:
         If we have a current video device, capturing data, this will stop it.
@@ -371,6 +510,7 @@ class VideoRecorder:
             if 'app_loop_face' in self.__dict__ : 
                 self.stop_Facial_Recognition(False)
 
+            self.stop_capture_thread()
             self.cap.release()
             del self.__dict__['cap']
 
@@ -418,6 +558,7 @@ class VideoRecorder:
         self.root_menu.add_cascade(label='Run', menu=self.root_run_menu, underline=0)
         self.root_run_menu.add_command(label='Load Video Device', underline=0, command= lambda: self.init_VideoDevice_Dialog(root, style, False) )
         self.root_run_menu.add_command(label='Stop Video Device', underline=3, command= self.stop_Webcam_Device, state='disabled')
+        self.root_run_menu.add_command(label='Add Video Device', underline=0, command= lambda: self.init_VideoDevice_Dialog(root, style, False, True) )
         self.root_run_menu.add_separator()
         self.root_run_menu.add_command(label='Start Face Detection', command=self.start_Facial_Recognition, underline=0, state='disabled')
         self.root_run_menu.add_command(label='Stop Face Detection', command= lambda: self.stop_Facial_Recognition(True), underline=1, state='disabled')
@@ -1158,8 +1299,9 @@ class VideoRecorder:
         init_VideoDevice_Dialog :
         Creates the dialog that will let you choose the video input option.
     '''
-    def init_VideoDevice_Dialog(self, root, style, addPerson) -> None:
+    def init_VideoDevice_Dialog(self, root, style, addPerson, addCamera = False) -> None:
         self.addPerson_Device = addPerson
+        self.addCamera_Device = addCamera
 
         self.videoDevice_Dialog = tk.Toplevel()
 
@@ -1256,24 +1398,108 @@ class VideoRecorder:
     '''
     def init_Known_Facial_Data(self, data_dir, createFile2) -> None:
         #load facial data here
-        #array that stores current known faces
-        self.current_faces = []
-        self.current_faces_lock = Lock()
+        #stores current known faces (shared with the headless daemon, see sightings.py)
+        self.sightings = sightings.SightingTracker()
+        self.current_faces = self.sightings.faces
+        self.current_faces_lock = self.sightings.lock
         
 
-        # Get known faces image and labels, descriptions and unique ids
-        self.images, self.labels, self.descriptions, self.unique_ids = face_data.load_face_data(data_dir)
+        # Get known faces image and labels, descriptions and unique ids and encode them (on all our cpu cores, only new or
+        # changed images are encoded, the rest come from our encoding cache)
+        self.images, self.labels, self.descriptions, self.unique_ids, self.image_paths, self.face_encodings, self.face_names = face_data.load_encode_face_data(data_dir)
+
+        if STORAGE_BACKEND == 'sqlite':
+            #sightings are read from the database when needed, not loaded here
+            self.df1, self.sighting_store = sighting_db.load_update_database(DATABASE_FILENAME, PANDAS_FILENAME1, PANDAS_FILENAME2, self.labels, self.descriptions, self.unique_ids)
+        elif STORAGE_BACKEND == 'archive':
+            #only the indexes of our partitions are loaded here
+            self.df1 = face_data.load_update_pandas_people(PANDAS_FILENAME1, self.labels, self.descriptions, self.unique_ids)
+            self.sighting_store = sighting_archive.open_archive(ARCHIVE_DIRECTORY, PANDAS_FILENAME2, ARCHIVE_PARTITION_DAYS, ARCHIVE_RETENTION_DAYS)
+        else:
+            self.df1, df2 = face_data.load_update_pandas_db(PANDAS_FILENAME1, PANDAS_FILENAME2, self.labels, self.descriptions, self.unique_ids, createFile2)
 
-        self.df1, self.df2 = face_data.load_update_pandas_db(PANDAS_FILENAME1, PANDAS_FILENAME2, self.labels, self.descriptions, self.unique_ids, createFile2)
+            #sightings are appended to a log, not saved by rewriting file2 (see sighting_log.py)
+            self.sighting_store = sighting_log.SightingLog(PANDAS_FILENAME2, df2)
         
         #update list
         self.update_all_names_listbox()
 
         print(self.df1)
-        print(self.df2)
+        print(str(len(self.sighting_store)) + ' sightings')
 
-        #encode our known people
-        self.face_encodings, self.face_names = face_data.encode_known_people(self.images, self.labels)
+        #index our known encodings (every template of each person) by UUID for matching (exact search, or IVF for very large galleries)
+        self.gallery_index = face_gallery.create_gallery_index(*face_gallery.flatten_templates(self.face_encodings, self.unique_ids))
+
+    '''
+        add_known_person :
+        Adds one person from their directory to our known facial data, without reloading everyone. If facial recognition is
+        running, they are sent to it too, so it keeps running. Returns True if added.
+    '''
+    def add_known_person(self, directory) -> bool:
+        #load and encode just this person
+        images, label, description, uid, paths = face_data.load_person_data(directory)
+
+        if uid is None or len(images) == 0:
+            return False
+
+        label = label.rstrip()
+        encodings, names = face_data.encode_known_people([images], [label], [uid], [paths], ENCODING_DIRECTORY, False)
+
+        #add them to the end of our lists, gallery and people database
+        self.images.append(images)
+        self.labels.append(label)
+        self.descriptions.append(description)
+        self.unique_ids.append(uid)
+        self.image_paths.append(paths)
+        self.face_encodings.append(encodings[0])
+        self.face_names.append(names[0])
+        for template in encodings[0]:
+            self.gallery_index.add(template, uid)
+        if STORAGE_BACKEND == 'sqlite':
+            self.df1 = self.sighting_store.add_person(self.df1, label, description, uid)
+        else:
+            self.df1 = face_data.add_pandas_db_person(self.df1, label, description, uid, PANDAS_FILENAME1)
+
+        #add them to our listbox
+        self.all_names_listbox.insert(tk.END, label)
+
+        #send them to facial recognition, if its running
+        if 'app_loop_face' in self.__dict__ :
+            self.app_loop_face.add_person(uid, encodings[0], label, images, description)
+
+        return True
+
+    '''
+        remove_known_person :
+        Removes one person (by UUID) from our known facial data, without reloading everyone. Listbox_position is their row
+        in the people listbox (the order of df1, which is not the order of our lists). If facial recognition is running,
+        they are removed from it too, so it keeps running.
+    '''
+    def remove_known_person(self, uid, listbox_position) -> None:
+        #our lists are in the order of our data directories, not df1
+        position = self.unique_ids.index(uid)
+
+        #remove them from the gallery and our lists
+        self.gallery_index.remove(uid)
+        del self.images[position]
+        del self.labels[position]
+        del self.descriptions[position]
+        del self.unique_ids[position]
+        del self.image_paths[position]
+        del self.face_encodings[position]
+        del self.face_names[position]
+
+        #remove them from our listbox
+        self.all_names_listbox.delete(listbox_position)
+
+        #remove them from facial recognition, if its running
+        if 'app_loop_face' in self.__dict__ :
+            self.app_loop_face.remove_person(uid)
+
+        #they are no longer a known person, so drop them from current faces without saving the visit
+        with self.current_faces_lock:
+            for face in [face for face in self.current_faces if face.id == uid]:
+                self.remove_facedata_from_listbox(face)
 
     '''
         release_Known_Facial_Data :
@@ -1286,8 +1512,9 @@ class VideoRecorder:
             #clear mem
             gc.collect()
 
-        if 'df2' in self.__dict__:
-            del self.__dict__['df2']
+        if 'sighting_store' in self.__dict__:
+            self.sighting_store.close()
+            del self.__dict__['sighting_store']
             #clear mem
             gc.collect()
 
@@ -1304,26 +1531,29 @@ class VideoRecorder:
         if 'unique_ids' in self.__dict__:
             del self.__dict__['unique_ids']
 
+        if 'image_paths' in self.__dict__:
+            del self.__dict__['image_paths']
+
         #clear listbox
         self.all_names_listbox.delete(0, tk.END)
         self.root_window.update()
 
+    '''
+        df2 :
+        Our sightings database (every sighting, from our sighting log or database). Do not change it, use self.sighting_store.
+    '''
+    @property
+    def df2(self):
+        return self.sighting_store.frame()
+
     '''
         update_panda_dataframe2 :
         Updates our pandas database for the face we have seen. It will calculate the total time they were seen for, by when we first to last saw them.
+        camera is the id of the camera that saw them. dataframe is the SightingLog or SightingDatabase it is saved to (filename is its file).
     '''
-    def update_panda_dataframe2(self, dataframe, id, start_time, end_time, filename) -> None:
+    def update_panda_dataframe2(self, dataframe, id, start_time, end_time, filename, camera = 0) -> None:
         
-        #calculate total time in seconds
-        totaltime = end_time - start_time
-
-        #create dataframe and concat to current (Total time stored in seconds. Will be convertable later)
-        df = pd.DataFrame(list(zip([id], [start_time], [end_time], [totaltime.seconds])), columns=['UUID', 'Arrival Time', 'Departure Time', 'Total Time'] ) 
-        df.set_index(['UUID'], inplace=True)
-        self.df2 = pd.concat([dataframe, df])
-
-        #update file
-        self.df2.to_csv(filename)
+        dataframe.add(id, start_time, end_time, camera)
 
     '''
         update_all_names_listbox :
@@ -1385,32 +1615,51 @@ class VideoRecorder:
 
     '''
         start_Facial_Recognition :
-        Used to start the multiprocessing for detecting faces. Uses multiprocessing, so the video capturing does not slow down and it can detect whose face it is, on the other core.
+        Used to start the multiprocessing for detecting faces. Uses multiprocessing, so the video capturing does not slow down and it can detect whose face it is, on the other cores.
+        AppLoopFaceCheck starts a pool of workers, all fed from the same in queue.
+        Our extra cameras each get a detection stage too, all sending their faces to the same workers.
     '''
     def start_Facial_Recognition(self) -> None:
 
-        #disable menu start
+        #disable menu start. Cameras can not be added while the workers are running (each camera needs its own mailbox)
         self.root_run_menu.entryconfig('Start Face Detection' , state='disabled')
+        self.root_run_menu.entryconfig('Add Video Device' , state='disabled')
         self.start_facedetect_button_main_root['state'] = 'disabled'
         
 
         self.face_check_run = False
 
-        self.last_face_count = 0
-        self.time_check = -1
-        self.time_seconds_check = 1
+
+        #our frame slots (for detection and recognition) are sized from a frame we captured, not what the device says
+        #(it may not know)
+        if 'capture_thread' in self.__dict__:
+            self.capture_thread.wait_for_frame(face_detection.FIRST_FRAME_TIMEOUT)
+
+        #every camera gets its own frame ring, sized for the biggest half size frame of our cameras
+        slot_sizes = [size for size in [self.get_small_frame_size()] + [pipeline.get_small_frame_size() for pipeline in self.extra_cameras] if size]
 
         #create 2 queues for sending data in and out of our class and then init loop facecheck class
-        self.data_in_queue = multiprocessing.Queue()
+        self.data_in_queue = job_mailbox.JobMailbox(policy=RECOGNITION_MAILBOX_POLICY)
         self.data_out_queue = multiprocessing.Queue()
         self.app_loop_face = face_data.AppLoopFaceCheck(self.data_in_queue, self.data_out_queue, 
                                                         self.face_encodings, self.face_names, 
                                                         self.images, self.descriptions, 
-                                                        self.unique_ids)
+                                                        self.unique_ids, self.gallery_index,
+                                                        frame_slot_size=max(slot_sizes) if slot_sizes else None,
+                                                        cameras=1 + max([pipeline.camera for pipeline in self.extra_cameras], default=0))
         
         #now start it
         self.app_loop_face.start()
 
+        #face detection runs in its own process and sends the faces it finds to app_loop_face
+        self.detection_stage = face_detection.DetectionStage(self.app_loop_face, self.get_frame_size())
+        self.detection_stage.start()
+        self.detection_stage.feed_from(self.capture_thread)
+
+        #our extra cameras share app_loop_face (they are fairly taken in turn by the workers)
+        for pipeline in self.extra_cameras:
+            pipeline.start_detection(self.app_loop_face)
+
         #change button to stop
         self.start_facedetect = False
         self.start_facedetect_button_main_root.config(text='Stop Face Detection')
@@ -1420,6 +1669,59 @@ class VideoRecorder:
         #enable menu stop
         self.root_run_menu.entryconfig('Stop Face Detection' , state='normal')
 
+    '''
+        stop_capture_thread :
+        Stops the thread reading our video device and shows how many frames were never used.
+    '''
+    def stop_capture_thread(self):
+        if 'capture_thread' not in self.__dict__:
+            return
+
+        self.capture_thread.stop()
+        stats = self.capture_thread.stats()
+        print('Capture : ' + str(stats['captured']) + ' frames, ' + str(stats['read']) + ' used, ' + str(stats['dropped']) + ' dropped, ' + str(stats['read_failures']) + ' failed reads')
+        del self.__dict__['capture_thread']
+
+    '''
+        get_frame_dimensions :
+        Returns (width, height) of frames from our video device. (0, 0) if we do not know.
+    '''
+    def get_frame_dimensions(self):
+        #our capture thread knows once it has a frame, and the device is busy reading on that thread
+        if 'capture_thread' in self.__dict__ and self.capture_thread.frame_shape is not None:
+            height, width = self.capture_thread.frame_shape[:2]
+            return width, height
+
+        if 'cap' not in self.__dict__:
+            return 0, 0
+
+        return int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    '''
+        get_frame_size :
+        Returns the bytes of a full frame from our video device. None if we do not know.
+    '''
+    def get_frame_size(self):
+        width, height = self.get_frame_dimensions()
+
+        if width <= 0 or height <= 0:
+            return None
+
+        return width * height * 3
+
+    '''
+        get_small_frame_size :
+        Returns the bytes of the half size frame we send to facial recognition, for our video device. None if we do not know.
+    '''
+    def get_small_frame_size(self):
+        width, height = self.get_frame_dimensions()
+
+        if width <= 0 or height <= 0:
+            return None
+
+        #cv2.resize rounds, so leave room for 1 extra pixel each way
+        return (width // 2 + 1) * (height // 2 + 1) * 3
+
     '''
         stop_Facial_Recognition :
         Will stop facial recognition, by making sure we close our multiprocesses as well.
@@ -1434,8 +1736,37 @@ class VideoRecorder:
         while self.face_check_run:
             pass
 
+        #stop detection first, so nothing else is sent to app_loop_face
+        if 'detection_stage' in self.__dict__ :
+            busy, detected, keyframes, skipped = self.detection_stage.utilisation()
+            print('Detection stage : ' + format(busy * 100, '.1f') + '% (' + str(detected) + ' frames, ' + str(keyframes) + ' keyframes, ' + str(skipped) + ' skipped)')
+            motion_frames, motion_pixels, motion_part = self.detection_stage.motion_stats()
+            scale, upsample, changes = self.detection_stage.scale_stats()
+            print('Detection scale : ' + str(scale) + ', upsample ' + str(upsample) + ' (changed ' + str(changes) + ' times)')
+            faces_sent, faces_cached = self.detection_stage.identity_stats()
+            print('Identity cache : ' + str(faces_sent) + ' faces sent to recognition, ' + str(faces_cached) + ' known from their track')
+            print('Motion gate : ' + str(motion_frames) + ' keyframes skipped, ' + str(motion_pixels) + ' pixels skipped (' + format(motion_part * 100, '.1f') + '%)')
+
+            self.detection_stage.stop()
+            del self.__dict__['detection_stage']
+
+        for pipeline in self.extra_cameras:
+            if pipeline.detection_stage is not None:
+                busy, detected, keyframes, skipped = pipeline.detection_stage.utilisation()
+                print(pipeline.name + ' (Camera ' + str(pipeline.camera) + ') detection stage : ' + format(busy * 100, '.1f') + '% (' + str(detected) + ' frames, ' + str(keyframes) + ' keyframes, ' + str(skipped) + ' skipped)')
+                pipeline.stop_detection()
+
         #stop it and remove it
         if 'app_loop_face' in self.__dict__ :            
+            #show how busy our workers were
+            utilisation, jobs = self.app_loop_face.utilisation()
+            print('Recognition workers : ' + ', '.join(format(busy * 100, '.1f') + '% (' + str(count) + ' jobs)' for busy, count in zip(utilisation, jobs)))
+            print('Frames dropped (frame ring full) : ' + str(self.app_loop_face.frames_dropped()))
+            print('Bytes sent to recognition : ' + str(self.app_loop_face.bytes_submitted.value))
+            for camera, mailbox in enumerate(self.app_loop_face.mailbox_stats()):
+                print('Recognition mailbox, camera ' + str(camera) + ' (' + mailbox['policy'] + ') : ' + str(mailbox['dropped']) + ' of ' + str(mailbox['put']) + ' jobs dropped, wait ' + format(mailbox['mean_wait'] * 1000, '.1f') + ' ms mean, ' + format(mailbox['max_wait'] * 1000, '.1f') + ' ms max')
+            print('Recognition batches : ' + str(sum(self.app_loop_face.worker_batches[:])) + ' (' + format(sum(jobs) / max(sum(self.app_loop_face.worker_batches[:]), 1), '.2f') + ' jobs per batch)')
+
             self.app_loop_face.stop()
             del self.__dict__['app_loop_face']
 
@@ -1482,6 +1813,9 @@ class VideoRecorder:
 
 
             self.root_run_menu.entryconfig('Start Face Detection' , state='normal')
+
+        #cameras can be added again
+        self.root_run_menu.entryconfig('Add Video Device' , state='normal')
             
 
     '''
@@ -1599,8 +1933,11 @@ class VideoRecorder:
         #self.root_window.attributes('-topmost', False)
         #self.root_window.update()
 
+        #if we have a device and we are adding a camera, open it in its own window
+        if not self.addPerson_Device and self.addCamera_Device and self.device_num >= 0:
+            self.add_extra_camera(self.device_num)
         #if we have a device, lets load our video
-        if not self.addPerson_Device and self.device_num >= 0:
+        elif not self.addPerson_Device and self.device_num >= 0:
             self.init_WebCam_Device(self.webcam_label)
         #if we have a device and we are adding a person, lets go and load it
         elif self.addPerson_Device and self.device_num_addPerson >= 0:
@@ -1872,14 +2209,12 @@ class VideoRecorder:
             return 2
 
         #make sure we have encodings to check
-        if len(self.face_encodings) > 0:
+        if len(self.gallery_index) > 0:
             #now check to see if face is currently in encoded faces
-            results = face_recognition.compare_faces(self.face_encodings, face[0])
-            face_distances = face_recognition.face_distance(self.face_encodings, face[0])
-            best_match_index = np.argmin(face_distances)
+            best_match_keys, best_distances, matches = self.gallery_index.match(face[:1])
 
             #face found, already in encoded faces
-            if results[best_match_index]:
+            if matches[0]:
                 return 3
         
         #have an encoded face
@@ -2009,11 +2344,19 @@ class VideoRecorder:
     '''
     def exit(self) -> None:
         if 'cap' in self.__dict__ and self.cap.isOpened():
+            self.stop_capture_thread()
             self.cap.release()
 
+        for pipeline in self.extra_cameras:
+            pipeline.close()
+        self.extra_cameras.clear()
+
         #make sure we save anything thats left in listbox for current visitors
         self.check_names_listbox_remove(0)
 
+        if 'sighting_store' in self.__dict__:
+            self.sighting_store.close()
+
         cv2.destroyAllWindows()
         self.root_window.destroy()
 
@@ -2063,15 +2406,7 @@ class VideoRecorder:
         Gets when seen first and last time.
     '''
     def get_first_last_seen(self, id):
-        first = None
-        last = None
-        with self.current_faces_lock:
-            for face in self.current_faces:
-                if face.id == id:
-                    first = face.date_time_first
-                    last = face.date_time_last
-
-        return first, last
+        return self.sightings.first_last_seen(id)
     
     '''
         remove_person_from_facedata :
@@ -2079,19 +2414,6 @@ class VideoRecorder:
     '''
     def remove_person_from_facedata(self, data_dir) -> None:
 
-        if 'app_loop_face' in self.__dict__:
-            if messagebox.askyesno('Facial Recognition Running', 'You need to stop running facial recognition. Do you wish to continue?'):
-                #if we need to stop face detection
-                self.stop_Facial_Recognition(True)
-            #they said no, so exit out
-            else:
-                #set window to top most window and the focus
-                self.root_window.attributes('-topmost', True)
-                self.root_window.update()
-                self.root_window.attributes('-topmost', False)
-                self.root_window.update()
-                return
-
         #get current selected person
         index = self.all_names_listbox.curselection()
 
@@ -2111,31 +2433,18 @@ class VideoRecorder:
             #now use the index of UUID (person.name. DONT BE CONFUSED. the .name is part of pandas for index key) 
             uid = str(person.name)
 
-            #now delete this uid from dataFrames
-            #make sure index is in df2
-            indexes = self.df2.index.to_list()
-            indexes = set(indexes)
-
-            #if id is in df2, then remove it
-            if uid in indexes:
-                self.df2.drop(index=[uid], inplace=True)   
+            #now delete this uid from dataFrames (their sightings file or partitions are rewritten without them, or they are deleted from our database)
+            self.sighting_store.remove_person(uid)
                      
             self.df1.drop(index=[uid], inplace=True)
 
             #update files
-            self.df1.to_csv(PANDAS_FILENAME1)
-            self.df2.to_csv(PANDAS_FILENAME2)            
+            if STORAGE_BACKEND != 'sqlite':
+                self.df1.to_csv(PANDAS_FILENAME1)
 
             if self.delete_person_dir(data_dir, uid):
-                #if we need to stop face detection
-                if 'app_loop_face' in self.__dict__ :
-                    self.stop_Facial_Recognition(True)
-
-                #close facial data
-                self.release_Known_Facial_Data()
-
-                #reload facial data
-                self.init_Known_Facial_Data(ENCODING_DIRECTORY, False)
+                #remove them from our known facial data (facial recognition keeps running)
+                self.remove_known_person(uid, index[0])
 
                 #clear data shown
                 self.clear_data_labels()
@@ -2556,103 +2865,22 @@ class VideoRecorder:
         for i in self.image_datetime_table.get_children():
             self.image_datetime_table.delete(i)
 
-        #find the data for this id
-        df = self.df2.loc[self.df2.index== id]
-
-        last_date1 = None
-        last_string_date1 = None
-        last_date2 = None
-        last_string_date2 = None
-
-        #now fill the table
-        for i in range(df.shape[0]):
-            #get our data
-            arrival_string = str(df.iloc[i]['Arrival Time'])
-            depart_string = str(df.iloc[i]['Departure Time'])
-            total_time = float(df.iloc[i]['Total Time'])
+        #find the visits of this id (from our visit index, only their own visits are looked at)
+        visits = self.sighting_store.person_visits(id)
 
-            #remove microseconds
-            arrival = arrival_string[:arrival_string.index('.')]
-            depart = depart_string[:depart_string.index('.')]
-
-            #format string to datetime
-            arrival = datetime.datetime.strptime(arrival, '%Y-%m-%d %H:%M:%S')
-            depart = datetime.datetime.strptime(depart, '%Y-%m-%d %H:%M:%S')                
-            
-            #format arrival to month and time string
-            arrival_date = str(arrival.month) + '-' + str(arrival.day) + '-' + str(arrival.year)
-            arrival_time = str(arrival.hour) + ':' + str(arrival.minute) + ':' + str(arrival.second)
-
-            #format depart to month and time string
-            depart_date = str(depart.month) + '-' + str(depart.day) + '-' + str(depart.year)
-            depart_time = str(depart.hour) + ':' + str(depart.minute) + ':' + str(depart.second)
-
-            #check to see if we have latest date and time
-            if last_date1 == None:
-                last_date1 = arrival
-                last_date2 = depart
-
-                #check to see if the dates are different.
-                #get our dates as month, day, year
-                arr = datetime.datetime(arrival.year, arrival.month, arrival.day)
-                dep = datetime.datetime(depart.year, depart.month, depart.day)
-                #if first day is less than last day
-                if arr < dep:
-                    last_string_date1 = arrival_string
-                    last_string_date2 = depart_string
-
-                    #dates different, so put both dates in our string
-                    arrival_date = arrival_date + ' & ' + depart_date
-
-                else: 
-                    last_string_date1 = arrival_string
-                    last_string_date2 = depart_string   
-
-            elif last_date1 < arrival:
-                last_date1 = arrival
-                last_date2 = depart
-
-                #check to see if the dates are different.
-                #get our dates as month, day, year
-                arr = datetime.datetime(arrival.year, arrival.month, arrival.day)
-                dep = datetime.datetime(depart.year, depart.month, depart.day)
-                #if first day is less than last day
-                if arr < dep:
-                    last_string_date1 = arrival_string
-                    last_string_date2 = depart_string
-
-                    #dates different, so put both dates in our string
-                    arrival_date = arrival_date + ' & ' + depart_date
-                else:
-                    last_string_date1 = arrival_string
-                    last_string_date2 = depart_string  
-            
-            #format time in minutes
-            total_time = total_time / 60.0
-
-            total_time = str(format(total_time, '.2f')) + ' minutes.'
+        if visits is None or len(visits) == 0:
+            self.image_first_seen_label.config(text="First Seen : ")
+            self.image_last_seen_label.config(text="Last Seen : ")
+            return
 
-            #fill in table data            
-            self.image_datetime_table.insert(parent='', index=i, iid=i, text='', 
-                                             values=(arrival_date, arrival_time, depart_time, total_time))
+        #now fill the table (every row is formatted at once, visits are sorted by arrival)
+        for i, values in enumerate(visit_index.format_visits(visits)):
+            self.image_datetime_table.insert(parent='', index=i, iid=i, text='', values=values)
 
-        #now update the latest date and time
-        #make sure we have dates to use
-        if isinstance(last_string_date1, (type(None))):
-            seen_text = "First Seen : "
-            self.image_first_seen_label.config(text=seen_text)
-        else:
-            seen_text = "First Seen : " + last_string_date1
-            seen_text = seen_text[:seen_text.index('.')]
-            self.image_first_seen_label.config(text=seen_text)
-
-        if isinstance(last_string_date2, (type(None))):
-            seen_text = "Last Seen : "
-            self.image_last_seen_label.config(text=seen_text)
-        else:
-            seen_text = "Last Seen : " + last_string_date2
-            seen_text = seen_text[:seen_text.index('.')]
-            self.image_last_seen_label.config(text=seen_text)
+        #now show their latest visit
+        latest = visits.latest()
+        self.image_first_seen_label.config(text="First Seen : " + str(np.datetime_as_string(visits.arrivals[latest], unit='s')).replace('T', ' '))
+        self.image_last_seen_label.config(text="Last Seen : " + str(np.datetime_as_string(visits.departures[latest], unit='s')).replace('T', ' '))
 
 
         #seen_text = "First Seen : " + last_string_date1
@@ -2740,54 +2968,30 @@ class VideoRecorder:
 
     '''
         face_check :
-        Checks if the camera view has a detectable face.
+        Checks if the camera view has a detectable face. Our detection stage takes frames from the capture thread at its
+        own rate, this returns the newest DetectionResult it has (None if we do not have one yet), so detection never
+        holds up our GUI.
     ''' 
     def face_check(self, frame):
         
         starttime = time.perf_counter()
 
-        locations = []
-
-        small_frame = cv2.resize(frame, (0, 0), fx=0.5, fy=0.5)
-        #get our face locations
-        #cnn or hog
-        #model="hog"
-        #locations = face_recognition.face_locations(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY), number_of_times_to_upsample=1)
-        #locations = face_recognition.face_locations(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY), model='hog')
-        #locations = face_recognition.face_locations(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY), model='cnn')
-        locations = face_recognition.face_locations(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY))
-
-        #check faces if the number on screen has changed or if we have any faces, check every time_seconds_check seconds
-        if len(locations) != self.last_face_count or abs(time.perf_counter() - self.time_check) >= self.time_seconds_check and len(locations) > 0:
-            
-            #set the new face count and update time
-            self.last_face_count = len(locations)
-            self.time_check = time.perf_counter()
-
-            #make sure we are doing multithread
-            if 'app_loop_face' in self.__dict__ :
-                #send tuple of (locations, small_frame)
-                self.data_in_queue.put((locations.copy(), small_frame.copy()))
-
-        elif len(locations) == 0:
-            #set the new face count and update time
-            self.last_face_count = len(locations)
-
-            #make sure we are doing multithread
-            if 'app_loop_face' in self.__dict__ :
-                #send tuple of (locations, small_frame)
-                self.data_in_queue.put((locations.copy(), small_frame.copy()))
+        #make sure we are doing multithread
+        if 'detection_stage' not in self.__dict__ :
+            return None
 
         #make sure we are doing multithread
         if 'app_loop_face' in self.__dict__ :
-            #check the out queue to see if we have any data
-            while not self.data_out_queue.empty():
+            #check for results from our workers (in the order the frames were captured)
+            for faces_data in self.app_loop_face.get_results():
                 #make sure we are doing multithread
                 if 'app_loop_face' not in self.__dict__ :
                     break
                 
-                #get our data and then update current faces
-                faces_data = self.data_out_queue.get()                
+                #tell detection who is on each track, so it does not send known faces again until they need checking
+                self.confirm_camera_identities(faces_data)
+
+                #update current faces
                 self.add_facedata_to_currentfaces(faces_data)
 
                 #tk.Event()
@@ -2795,13 +2999,44 @@ class VideoRecorder:
                 self.names_listbox_select(tk.Event())
         
         #end this now if we are done with face rec
-        if 'app_loop_face' not in self.__dict__ :
-            return locations
+        if 'detection_stage' not in self.__dict__ :
+            return None
 
         starttime = abs(time.perf_counter() - starttime)
         #print('face_check Time : ' + str(starttime))
 
-        return locations
+        #the newest boxes our detection stage found (may be from an earlier frame)
+        detection = self.detection_stage.latest_result()
+
+        #known faces on tracks are not sent to recognition every time, so update when we last saw them here
+        if detection is not None:
+            self.update_tracked_faces(detection)
+
+        return detection
+
+    '''
+        confirm_camera_identities :
+        Sends faces recognition found back to the detection stage of the camera they were seen on.
+    ''' 
+    def confirm_camera_identities(self, faces_data):
+        #every face in a result is from the same camera
+        camera = faces_data[0].camera if faces_data else 0
+
+        if camera == 0:
+            if 'detection_stage' in self.__dict__ :
+                self.detection_stage.confirm_identities(faces_data)
+            return
+
+        for pipeline in self.extra_cameras:
+            if pipeline.camera == camera:
+                pipeline.confirm_identities(faces_data)
+
+    '''
+        update_tracked_faces :
+        Updates the last seen time of the current faces a detection stage is still tracking (on the camera it found them).
+    ''' 
+    def update_tracked_faces(self, detection):
+        self.sightings.seen(detection)
     
     '''
         add_facedata_to_currentfaces :
@@ -2809,37 +3044,13 @@ class VideoRecorder:
     ''' 
     def add_facedata_to_currentfaces(self, faces_data):        
         
-        #lock data and go through to find it
+        #lock data, so our listbox stays in the same order as current faces
         with self.current_faces_lock:
-            new_faces = []
-
-            #go through faces data sent in
-            for face in faces_data:
-                #make sure this face is not unknown
-                if face.name != "Unknown":
-                    #lets us know if face is in our current list
-                    found = False
-
-                    for current_face in self.current_faces:                    
-                        #see if we found it in current
-                        if current_face.id == face.id:
-                            #lets us know we found it
-                            found = True
-                            
-                            #update last time an break loop
-                            current_face.date_time_last = face.date_time_first
-
-                            break
-                    
-                    #not in list, so add to it
-                    if not found:
-                        new_faces.append(face)
+            #add new faces (known people not seen yet on this camera), the rest get their last seen time updated
+            new_faces = self.sightings.add(faces_data)
 
             #add new faces to listbox
             self.add_facedata_to_listbox(new_faces)
-            
-            #add new faces to current faces
-            self.current_faces.extend(new_faces)
 
     '''
         add_facedata_to_listbox :
@@ -3091,17 +3302,11 @@ class VideoRecorder:
 
                 #if we add person successfully
                 if self.add_person_profile_dialog(name, description, self.camera_face_image, uid):
-                    #need to reload data
                     print('Person added')
 
-                    #release all known people
-                    self.release_Known_Facial_Data()
-
-                    #now delete file1
-                    result = self.delete_pandas_file1(os.path.join(PANDAS_DIRECT, PANDAS_REAL_FILE1))                 
-                    
-                    #reload all known people
-                    self.init_Known_Facial_Data(ENCODING_DIRECTORY, False)
+                    #add just this person to our known people
+                    if not self.add_known_person(self.added_person_directory):
+                        print('error loading added person')
 
                     #exit dialog and go back to main
                     self.exit_person_profile_dialog()
@@ -3193,6 +3398,7 @@ class VideoRecorder:
         
         #create directory
         directory = os.path.join(ENCODING_DIRECTORY, str(direct_num))
+        self.added_person_directory = directory
 
         #save image
         filesaved = cv2.imwrite(os.path.join(directory, name + '.png'),image)
@@ -3313,28 +3519,19 @@ class VideoRecorder:
 
         #lock data and go through to find it
         with self.current_faces_lock:
-            #list of faces to remove
-            removed_faces = []
-
-            #go through current faces
-            for current_face in self.current_faces:
-                #check to see if its not less than our removal time
-                if not self.check_time_diff_less(current_face.date_time_last, datetime.datetime.now(), removal_time):
-                    #remove it from the list and update our listbox
-                    removed_faces.append(current_face)
+            #faces not seen for our removal time (removed from current faces with our listbox, below)
+            removed_faces = self.sightings.expired(removal_time, remove=False)
 
-            #go through faces to remove and update pandas df2 and file2
+            #go through faces to remove
             for removed_face in removed_faces:
                 self.remove_facedata_from_listbox(removed_face)
-                self.update_panda_dataframe2(self.df2, 
-                                             removed_face.id, 
-                                             removed_face.date_time_first, 
-                                             removed_face.date_time_last, 
-                                             PANDAS_FILENAME2)
                 
                 #update list
                 self.update_all_names_listbox()
 
+            #save their sightings together (one write to our log, or one database transaction)
+            self.sighting_store.add_many([(removed_face.id, removed_face.date_time_first, removed_face.date_time_last, removed_face.camera) for removed_face in removed_faces])
+
             #if we removed a face, check to see if we have one selected on person list and update table
             if removed_faces:
                 self.all_names_listbox_select(None)
@@ -3354,8 +3551,8 @@ class VideoRecorder:
             selected_face = self.current_faces[index[0]]
 
             #see if selected is one we will delete
-            if selected_face.id != facedata.id:
-                value = selected_face.id
+            if selected_face is not facedata:
+                value = selected_face
             #we will delete it, so clear our labels
             #else:
             #    self.clear_data_labels()
@@ -3363,7 +3560,7 @@ class VideoRecorder:
         #find item and delete it
         for face in self.current_faces:
             #if we found our item, remove it and break loop
-            if face.id == facedata.id:
+            if face.id == facedata.id and face.camera == facedata.camera:
                 self.current_faces.remove(face)
                 break   
 
@@ -3376,7 +3573,7 @@ class VideoRecorder:
             self.names_listbox.insert(tk.END, face.name)
 
             #if we have a value, and we found it in our list, select it
-            if value and face.id == value:
+            if value and face is value:
                 self.names_listbox.select_set(i)
 
             i+=1
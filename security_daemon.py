@@ -0,0 +1,394 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Runs our facial recognition without the GUI, so it can run on a server, in a container or under a load test.
+It loads our known people, watches every source in its config file and saves who was seen (and when) to the same
+pandas files as main_security.py. It never imports tkinter. Logs are one JSON object per line.
+
+Run : python security_daemon.py [config file]
+
+The config file is JSON, any key left out uses DEFAULT_CONFIG. Sources can be a camera index, a video file or an image
+directory, ex:
+{"sources": [0, "entrance.mp4", {"source": "snapshots", "name": "Back door"}], "workers": 3, "log_file": "security.log"}
+
+Files Needed :
+
+face_data.py
+face_gallery.py
+frame_ring.py
+face_detection.py
+job_mailbox.py
+frame_capture.py
+camera_pipeline.py
+sightings.py
+sighting_log.py
+sighting_db.py
+visit_index.py
+sighting_archive.py
+
+'''
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import multiprocessing
+import face_data
+import face_gallery
+import job_mailbox
+import camera_pipeline
+import sightings
+import sighting_log
+import sighting_db
+import sighting_archive
+
+DEFAULT_CONFIG = {
+    'encoding_directory': 'Face Data', #directory used for data on people and their faces
+    'people_file': 'db_data/data1.cvs', #stores details on people
+    'sightings_file': 'db_data/data2.cvs', #stores the ID of person and date/times they were seen
+    'storage': 'csv', #'csv' saves to the files above, 'sqlite' to database_file, 'archive' sightings to archive_directory (the files above are imported the first time)
+    'database_file': 'db_data/security.db', #SQLite database of people and sightings (see sighting_db.py)
+    'archive_directory': 'db_data/sightings', #sightings split by time (see sighting_archive.py), people stay in people_file
+    'partition_days': 1, #days each archive partition holds
+    'retention_days': None, #days of sightings the archive keeps (older ones are rolled up and dropped). None keeps them all
+    'sources': [0], #camera indexes, video files or image directories ({"source": ..., "name": ...} to name one)
+    'remove_face_time': 60, #seconds a person is not seen before their sighting is saved
+    'mailbox_policy': job_mailbox.DROP_OLDEST, #what to do when recognition falls behind (see job_mailbox.py)
+    'workers': None, #recognition worker processes, None picks from our cpu cores
+    'stats_interval': 30, #seconds between stats log lines
+    'poll_interval': 0.02, #seconds between checks for results
+    'log_file': None, #None logs to stderr
+    'log_level': 'INFO',
+}
+SOURCE_END_GRACE = 2.0 #seconds we keep collecting results after every source ended (video files and image directories)
+FIRST_FRAME_TIMEOUT = 5.0 #seconds we wait for each source to give its first frame
+
+'''
+    class JsonLogFormatter :
+    Formats each log record as one JSON object : time, level, event and any fields sent with log_event.
+'''
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+
+        return json.dumps(entry, default=str)
+
+'''
+    log_event :
+    Logs an event with its fields (ex: log_event(logger, 'arrived', name='Chris', camera=0)).
+'''
+def log_event(logger, event, level = logging.INFO, **fields):
+    logger.log(level, event, extra={'fields': fields})
+
+'''
+    load_config :
+    Returns our config : DEFAULT_CONFIG with the keys in our JSON file (if one is sent) on top.
+'''
+def load_config(filename = None):
+    config = dict(DEFAULT_CONFIG)
+
+    if filename:
+        with open(filename) as config_file:
+            loaded = json.load(config_file)
+
+        unknown = set(loaded) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError('Unknown config keys : ' + ', '.join(sorted(unknown)))
+
+        config.update(loaded)
+
+    if config['storage'] not in ('csv', 'sqlite', 'archive'):
+        raise ValueError('Unknown storage : ' + str(config['storage']) + ' (csv, sqlite or archive)')
+
+    return config
+
+'''
+    init_logging :
+    Returns our logger, writing JSON lines to the log file in our config (or stderr).
+'''
+def init_logging(config):
+    logger = logging.getLogger('security_daemon')
+    logger.setLevel(config['log_level'])
+    handler = logging.FileHandler(config['log_file']) if config['log_file'] else logging.StreamHandler()
+    handler.setFormatter(JsonLogFormatter())
+    logger.handlers = [handler]
+    logger.propagate = False
+
+    return logger
+
+'''
+    open_storage :
+    Loads (or creates) our people and opens where our sightings are saved, for the storage in our config. Returns (people
+    DataFrame, SightingLog, SightingDatabase or SightingArchive).
+'''
+def open_storage(config, labels, descriptions, ids):
+    if config['storage'] == 'sqlite':
+        return sighting_db.load_update_database(config['database_file'], config['people_file'], config['sightings_file'], labels, descriptions, ids)
+
+    if config['storage'] == 'archive':
+        df1 = face_data.load_update_pandas_people(config['people_file'], labels, descriptions, ids)
+        return df1, sighting_archive.open_archive(config['archive_directory'], config['sightings_file'], config['partition_days'], config['retention_days'])
+
+    df1, df2 = face_data.load_update_pandas_db(config['people_file'], config['sightings_file'], labels, descriptions, ids, True)
+
+    return df1, sighting_log.SightingLog(config['sightings_file'], df2)
+
+'''
+    class SecurityDaemon :
+    The same pipeline as our GUI : a CameraPipeline (capture and detection stage) for each source, all sending faces to
+    one AppLoopFaceCheck. Results go to a SightingTracker, and sightings are saved when a person leaves (or we stop).
+'''
+class SecurityDaemon:
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.running = False #lets us know to run main loop
+        self.sightings = sightings.SightingTracker() #who is being seen now, on each camera
+        self.pipelines = [] #a CameraPipeline for each source
+        self.app_loop_face = None #our recognition workers
+        self.data_in_queue = None
+        self.data_out_queue = None
+        self.df1 = None
+        self.sighting_store = None #saves our sightings (a sighting_log.SightingLog, sighting_db.SightingDatabase or sighting_archive.SightingArchive)
+        self.sightings_saved = 0 #sightings we saved to our sightings file
+
+    '''
+        load_known_people :
+        Loads and encodes our known people and loads (or creates) our pandas files.
+    '''
+    def load_known_people(self):
+        starttime = time.perf_counter()
+
+        #make sure our pandas files have a directory
+        for filename in (self.config['people_file'], self.config['sightings_file']):
+            if os.path.dirname(filename):
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        self.images, self.labels, self.descriptions, self.unique_ids, self.image_paths, self.face_encodings, self.face_names = face_data.load_encode_face_data(self.config['encoding_directory'])
+        self.df1, self.sighting_store = open_storage(self.config, self.labels, self.descriptions, self.unique_ids)
+        self.gallery_index = face_gallery.create_gallery_index(*face_gallery.flatten_templates(self.face_encodings, self.unique_ids))
+
+        log_event(self.logger, 'known_people_loaded', people=len(self.unique_ids), storage=self.config['storage'], sightings=len(self.sighting_store), seconds=round(time.perf_counter() - starttime, 3))
+
+    '''
+        open_sources :
+        Opens a CameraPipeline for each source in our config (camera ids in config order). Returns False if none opened.
+    '''
+    def open_sources(self):
+        for camera, source in enumerate(self.config['sources']):
+            name = None
+
+            if isinstance(source, dict):
+                name = source.get('name')
+                source = source['source']
+
+            pipeline = camera_pipeline.CameraPipeline(camera, source, name)
+
+            if not pipeline.open():
+                log_event(self.logger, 'source_failed', logging.ERROR, camera=camera, source=source)
+                continue
+
+            pipeline.capture_thread.wait_for_frame(FIRST_FRAME_TIMEOUT)
+            width, height = pipeline.get_frame_dimensions()
+            log_event(self.logger, 'source_opened', camera=camera, source=source, name=pipeline.name, width=width, height=height)
+            self.pipelines.append(pipeline)
+
+        return len(self.pipelines) > 0
+
+    '''
+        start :
+        Loads our known people, opens our sources and starts recognition and a detection stage for each source.
+        Returns False if we have nothing to watch.
+    '''
+    def start(self):
+        self.load_known_people()
+
+        if not self.open_sources():
+            log_event(self.logger, 'no_sources', logging.ERROR)
+
+            #we never start, so stop will not close what we opened
+            for pipeline in self.pipelines:
+                pipeline.close()
+            self.pipelines = []
+            self.sighting_store.close()
+
+            return False
+
+        #every camera gets its own mailbox and frame ring, sized for its half size frames
+        slot_sizes = [size for size in (pipeline.get_small_frame_size() for pipeline in self.pipelines) if size]
+
+        self.data_in_queue = job_mailbox.JobMailbox(policy=self.config['mailbox_policy'])
+        self.data_out_queue = multiprocessing.Queue()
+        self.app_loop_face = face_data.AppLoopFaceCheck(self.data_in_queue, self.data_out_queue,
+                                                        self.face_encodings, self.face_names,
+                                                        self.images, self.descriptions,
+                                                        self.unique_ids, self.gallery_index,
+                                                        workers=self.config['workers'],
+                                                        frame_slot_size=max(slot_sizes) if slot_sizes else None,
+                                                        cameras=1 + max(pipeline.camera for pipeline in self.pipelines))
+        self.app_loop_face.start()
+
+        for pipeline in self.pipelines:
+            pipeline.start_detection(self.app_loop_face)
+
+        self.running = True
+        log_event(self.logger, 'started', cameras=len(self.pipelines), workers=self.app_loop_face.worker_count)
+
+        return True
+
+    '''
+        run :
+        Our main loop. Runs until stop is called (or a signal comes), or every source has ended.
+    '''
+    def run(self):
+        stats_time = time.perf_counter()
+        ended_time = None
+
+        while self.running:
+            self.poll()
+
+            #video files and image directories end, keep collecting the results of their last frames for a little
+            if not any(pipeline.is_open() for pipeline in self.pipelines):
+                if ended_time is None:
+                    ended_time = time.perf_counter()
+                    log_event(self.logger, 'sources_ended')
+                elif time.perf_counter() - ended_time >= SOURCE_END_GRACE:
+                    break
+
+            if time.perf_counter() - stats_time >= self.config['stats_interval']:
+                stats_time = time.perf_counter()
+                self.log_stats()
+
+            time.sleep(self.config['poll_interval'])
+
+        self.stop()
+
+    '''
+        poll :
+        Takes the results our workers finished, updates who is being seen and saves the sightings that ended.
+    '''
+    def poll(self):
+        for faces_data in self.app_loop_face.get_results():
+            #tell detection who is on each track (every face in a result is from the same camera)
+            if faces_data:
+                for pipeline in self.pipelines:
+                    if pipeline.camera == faces_data[0].camera:
+                        pipeline.confirm_identities(faces_data)
+
+            for face in self.sightings.add(faces_data):
+                log_event(self.logger, 'arrived', id=face.id, name=face.name, camera=face.camera, distance=face.distance)
+
+        #known faces on tracks are not sent to recognition every time, so update when we last saw them here
+        for pipeline in self.pipelines:
+            detection = pipeline.latest_result()
+
+            if detection is not None:
+                self.sightings.seen(detection)
+
+        self.save_sightings(self.config['remove_face_time'])
+
+    '''
+        save_sightings :
+        Saves the sightings of the people not seen for removal_time seconds (0 saves them all).
+    '''
+    def save_sightings(self, removal_time):
+        faces = self.sightings.expired(removal_time)
+
+        #one write to our log, or one database transaction
+        self.sighting_store.add_many([(face.id, face.date_time_first, face.date_time_last, face.camera) for face in faces])
+        self.sightings_saved += len(faces)
+
+        for face in faces:
+            log_event(self.logger, 'departed', id=face.id, name=face.name, camera=face.camera,
+                      arrival=face.date_time_first, departure=face.date_time_last,
+                      seconds=(face.date_time_last - face.date_time_first).total_seconds())
+
+    '''
+        log_stats :
+        Logs how our sources, detection stages and workers are doing.
+    '''
+    def log_stats(self):
+        for pipeline in self.pipelines:
+            capture = pipeline.capture_thread.stats() if pipeline.capture_thread else {}
+            fields = {'camera': pipeline.camera, 'open': pipeline.is_open()}
+            fields.update({'capture_' + key: value for key, value in capture.items()})
+
+            if pipeline.detection_stage is not None:
+                busy, detected, keyframes, skipped = pipeline.detection_stage.utilisation()
+                faces_sent, faces_cached = pipeline.detection_stage.identity_stats()
+                fields.update({'detection_busy': round(busy, 3), 'frames_detected': detected, 'keyframes': keyframes,
+                               'faces_sent': faces_sent, 'faces_cached': faces_cached})
+
+            log_event(self.logger, 'camera_stats', **fields)
+
+        utilisation, jobs = self.app_loop_face.utilisation()
+        log_event(self.logger, 'recognition_stats', worker_busy=[round(busy, 3) for busy in utilisation], jobs=jobs,
+                  latency=self.app_loop_face.result_latency, frames_dropped=self.app_loop_face.frames_dropped(),
+                  mailboxes=self.app_loop_face.mailbox_stats(), current_faces=len(self.sightings.faces),
+                  sightings_saved=self.sightings_saved)
+
+    '''
+        stop :
+        Stops our detection stages and workers, saves every sighting still open and closes our sources.
+    '''
+    def stop(self):
+        self.running = False
+
+        if self.app_loop_face is None:
+            return
+
+        self.log_stats()
+
+        for pipeline in self.pipelines:
+            pipeline.stop_detection()
+
+        #results still waiting
+        self.poll()
+
+        self.app_loop_face.stop()
+        self.app_loop_face = None
+        self.data_out_queue.close()
+        self.data_in_queue.close()
+
+        #everyone still here has left now
+        self.save_sightings(0)
+
+        for pipeline in self.pipelines:
+            pipeline.close()
+
+        self.sighting_store.close()
+
+        log_event(self.logger, 'stopped', sightings_saved=self.sightings_saved)
+
+'''
+    main :
+    Runs our daemon with the config file sent in (if any). Ctrl+C (or SIGTERM) stops it and saves open sightings.
+'''
+def main(argv):
+    config = load_config(argv[1] if len(argv) > 1 else None)
+    logger = init_logging(config)
+    daemon = SecurityDaemon(config, logger)
+
+    if not daemon.start():
+        return 1
+
+    #stop our main loop, it saves and closes everything. Set after our processes started, so they do not get it
+    #(they are stopped with SIGTERM)
+    def handle_signal(signum, frame):
+        log_event(logger, 'signal', signal=signum)
+        daemon.running = False
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    daemon.run()
+
+    return 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv))
@@ -0,0 +1,490 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Optional archive of our sightings split by time, in place of one sightings file (data2) that grows forever. Each
+partition (a day by default) is a CSV file named by its first day, with a small JSON index next to it (rows, first
+arrival, last departure and who is in it). Questions like "who was here between 02:00 and 04:00 last Tuesday" only open
+the partitions whose index says they can have an answer. Old partitions can be rolled up (visits and time per person)
+and dropped, the partition being written to now is never touched.
+Follow the class below for flow.
+
+Run : python sighting_archive.py query "2024-01-23 02:00" "2024-01-23 04:00" [--person UUID] [--directory db_data/sightings]
+      python sighting_archive.py retention DAYS [--no-rollup] [--directory db_data/sightings]
+
+'''
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+import sighting_log
+import visit_index
+
+ARCHIVE_DIRECTORY = 'db_data/sightings' #our partitions
+ARCHIVE_VERSION = 1 #version of our manifest
+PARTITION_DAYS = 1 #days each partition holds
+RETENTION_INTERVAL = 60 * 60 #seconds between retention runs, when we have a retention time
+MANIFEST_FILE = 'archive.json' #our version and partition days, and if our sightings file was imported
+ROLLUP_FILE = 'rollup.csv' #visits and time of each person, for each partition we dropped
+INDEX_SUFFIX = '.idx.json' #index file of each partition
+ROLLUP_COLUMNS = ['Partition', 'UUID', 'Visits', 'Total Time', 'First Arrival', 'Last Departure']
+
+'''
+    partition_names :
+    Returns the partition (the name of its first day, YYYY-MM-DD) of each datetime64 time.
+'''
+def partition_names(times, partition_days = PARTITION_DAYS):
+    days = np.asarray(times, dtype=sighting_log.TIME_DTYPE).astype('datetime64[D]').astype(np.int64)
+
+    return np.datetime_as_string((days - days % partition_days).astype('datetime64[D]'), unit='D')
+
+'''
+    frame_index :
+    Returns the index of a partition from its sightings : rows, first and last arrival and last departure (microseconds),
+    the sightings of each person and camera, and the size of its file.
+'''
+def frame_index(df, size):
+    arrivals = df['Arrival Time'].to_numpy().astype(np.int64)
+    departures = df['Departure Time'].to_numpy().astype(np.int64)
+
+    return {'rows': len(df),
+            'first_arrival': int(arrivals.min()),
+            'last_arrival': int(arrivals.max()),
+            'last_departure': int(departures.max()),
+            'people': {str(id): int(count) for id, count in pd.Series(df.index).value_counts().items()},
+            'cameras': {str(camera): int(count) for camera, count in df['Camera'].value_counts().items()},
+            'size': size}
+
+'''
+    class SightingArchive :
+    Our sightings in time partitions under directory. Has the same sighting functions as sighting_log.SightingLog (add,
+    add_many, frame, person_sightings, person_visits, remove_person, close), so our GUI and daemon can save to it, plus
+    query_range and apply_retention. Partition indexes are loaded when we open, sightings only when asked for. With a
+    retention_days, a thread drops older partitions every RETENTION_INTERVAL seconds.
+'''
+class SightingArchive:
+    def __init__(self, directory = ARCHIVE_DIRECTORY, partition_days = PARTITION_DAYS, retention_days = None, rollup = True):
+        self.directory = directory
+        self.retention_days = retention_days #days of sightings we keep (None keeps them all)
+        self.rollup = rollup #True keeps a rollup of the partitions we drop
+        self.lock = threading.RLock() #guards our partitions and indexes (retention runs on its own thread)
+        self.indexes = {} #partition name -> its index (see frame_index)
+        self.visits = visit_index.VisitIndex() #visits of the people we looked up, kept up to date as they are seen again
+        self.stop_event = threading.Event()
+        self.retention_thread = None
+        self.partitions_dropped = 0 #partitions retention dropped since opening
+
+        os.makedirs(directory, exist_ok=True)
+
+        #a new archive uses our partition days, an old one keeps its own
+        self.manifest = self.read_json(os.path.join(directory, MANIFEST_FILE))
+        if self.manifest is None:
+            self.manifest = {'version': ARCHIVE_VERSION, 'partition_days': partition_days, 'imported': False}
+            self.write_json(os.path.join(directory, MANIFEST_FILE), self.manifest)
+        self.partition_days = self.manifest['partition_days']
+
+        self.load_indexes()
+
+        if retention_days is not None:
+            self.retention_thread = threading.Thread(target=self.run_retention, name='sighting retention', daemon=True)
+            self.retention_thread.start()
+
+    '''
+        read_json :
+        Returns a JSON file, or None if it does not exist or can not be read.
+    '''
+    def read_json(self, filename):
+        try:
+            with open(filename) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return None
+
+    '''
+        write_json :
+        Saves a JSON file (to a temporary file first, so a crash never leaves half of one).
+    '''
+    def write_json(self, filename, data):
+        with open(filename + '.tmp', 'w') as json_file:
+            json.dump(data, json_file)
+
+        os.replace(filename + '.tmp', filename)
+
+    '''
+        partition_file :
+        Returns the CSV file of a partition.
+    '''
+    def partition_file(self, name):
+        return os.path.join(self.directory, name + '.csv')
+
+    '''
+        load_indexes :
+        Loads the index of each partition. An index that is missing, or not for the size its partition is now (ex: we
+        stopped between saving sightings and their index), is made again from the partition.
+    '''
+    def load_indexes(self):
+        self.indexes = {}
+
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.csv') or filename == ROLLUP_FILE:
+                continue
+
+            name = filename[:-len('.csv')]
+            index = self.read_json(os.path.join(self.directory, name + INDEX_SUFFIX))
+
+            if index is None or index.get('size') != os.path.getsize(self.partition_file(name)):
+                index = self.rebuild_index(name)
+
+            if index is not None:
+                self.indexes[name] = index
+
+    '''
+        rebuild_index :
+        Makes the index of a partition from its sightings and saves it. Returns None if the partition has no sightings.
+    '''
+    def rebuild_index(self, name):
+        df = sighting_log.read_sightings(self.partition_file(name))
+
+        if len(df) == 0:
+            return None
+
+        index = frame_index(df, os.path.getsize(self.partition_file(name)))
+        self.write_json(os.path.join(self.directory, name + INDEX_SUFFIX), index)
+
+        return index
+
+    '''
+        is_imported :
+        Returns True if a sightings file was imported into this archive.
+    '''
+    def is_imported(self):
+        return self.manifest.get('imported', False)
+
+    '''
+        import_csv :
+        Splits our sightings file (and its log, see sighting_log.py) into partitions. Returns the sightings imported.
+    '''
+    def import_csv(self, sightings_file):
+        df2 = sighting_log.rows_to_frame([])
+
+        if sightings_file:
+            df2 = sighting_log.load_sightings(sightings_file)
+
+        with self.lock:
+            names = partition_names(df2['Arrival Time'].to_numpy(), self.partition_days)
+
+            for name in np.unique(names).tolist():
+                part = df2[names == name].sort_values('Arrival Time', kind='mergesort')
+                filename = self.partition_file(name)
+                part.to_csv(filename, mode='a', header=not os.path.exists(filename), date_format=sighting_log.TIME_FORMAT)
+                self.indexes[name] = self.rebuild_index(name)
+
+            self.manifest['imported'] = True
+            self.write_json(os.path.join(self.directory, MANIFEST_FILE), self.manifest)
+
+        return len(df2)
+
+    '''
+        add :
+        Saves one sighting (when a person arrived and left, on which camera).
+    '''
+    def add(self, id, start_time, end_time, camera = 0):
+        self.add_many([(id, start_time, end_time, camera)])
+
+    '''
+        add_many :
+        Saves a list of sightings, (id, arrival, departure, camera) each. Each one is appended to the partition of its
+        arrival, and that partition's index is updated.
+    '''
+    def add_many(self, sightings):
+        if not sightings:
+            return
+
+        rows = sighting_log.sighting_rows(sightings)
+        names = partition_names([row[1] for row in rows], self.partition_days)
+
+        with self.lock:
+            for name in np.unique(names).tolist():
+                part_rows = [row for row, row_name in zip(rows, names) if row_name == name]
+                filename = self.partition_file(name)
+
+                with open(filename, 'a', newline='') as file_handle:
+                    sighting_log.write_rows(file_handle, part_rows)
+
+                self.update_index(name, part_rows, os.path.getsize(filename))
+
+            for id, start_time, end_time, total_time, camera in rows:
+                if id in self.visits:
+                    self.visits.add(id, start_time, end_time, total_time, camera)
+
+    '''
+        update_index :
+        Call holding our lock. Adds rows just appended to a partition to its index and saves it.
+    '''
+    def update_index(self, name, rows, size):
+        index = self.indexes.get(name)
+
+        if index is None:
+            first = int(rows[0][1].astype(np.int64))
+            index = {'rows': 0, 'first_arrival': first, 'last_arrival': first, 'last_departure': first, 'people': {}, 'cameras': {}}
+            self.indexes[name] = index
+
+        for id, start_time, end_time, total_time, camera in rows:
+            index['rows'] += 1
+            index['first_arrival'] = min(index['first_arrival'], int(start_time.astype(np.int64)))
+            index['last_arrival'] = max(index['last_arrival'], int(start_time.astype(np.int64)))
+            index['last_departure'] = max(index['last_departure'], int(end_time.astype(np.int64)))
+            index['people'][str(id)] = index['people'].get(str(id), 0) + 1
+            index['cameras'][str(camera)] = index['cameras'].get(str(camera), 0) + 1
+
+        index['size'] = size
+        self.write_json(os.path.join(self.directory, name + INDEX_SUFFIX), index)
+
+    '''
+        select_partitions :
+        Returns the names of the partitions that can have sightings between start and end (microseconds, None is open)
+        of any of ids (None is everyone), in time order. Only our indexes are looked at.
+    '''
+    def select_partitions(self, start = None, end = None, ids = None):
+        with self.lock:
+            return [name for name, index in sorted(self.indexes.items())
+                    if (end is None or index['first_arrival'] < end)
+                    and (start is None or index['last_departure'] > start)
+                    and (ids is None or any(str(id) in index['people'] for id in ids))]
+
+    '''
+        read_partitions :
+        Returns the sightings of these partitions as one DataFrame indexed by UUID, sorted by arrival.
+    '''
+    def read_partitions(self, names):
+        frames = [sighting_log.read_sightings(self.partition_file(name)) for name in names]
+
+        if not frames:
+            return sighting_log.rows_to_frame([])
+
+        return pd.concat(frames).sort_values('Arrival Time', kind='mergesort')
+
+    '''
+        query_range :
+        Returns the sightings of people here any time between start and end (datetimes or datetime64, None is open), of
+        ids only if sent (a list of UUIDs). Opens only the partitions our indexes say can have them.
+    '''
+    def query_range(self, start = None, end = None, ids = None):
+        start = None if start is None else int(np.datetime64(start, 'us').astype(np.int64))
+        end = None if end is None else int(np.datetime64(end, 'us').astype(np.int64))
+
+        df = self.read_partitions(self.select_partitions(start, end, ids))
+
+        #here at some time in our range : arrived before it ended and left after it started
+        keep = np.ones(len(df), dtype=bool)
+        if end is not None:
+            keep &= df['Arrival Time'].to_numpy().astype(np.int64) < end
+        if start is not None:
+            keep &= df['Departure Time'].to_numpy().astype(np.int64) > start
+        if ids is not None:
+            keep &= np.isin(np.asarray(df.index, dtype=object).astype(str), [str(id) for id in ids])
+
+        return df[keep]
+
+    '''
+        frame :
+        Returns every sighting as a DataFrame indexed by UUID. This reads every partition, use query_range or
+        person_sightings when you can.
+    '''
+    def frame(self):
+        return self.read_partitions(self.select_partitions())
+
+    '''
+        person_sightings :
+        Returns the sightings of one person by arrival time (only partitions they are in are read).
+    '''
+    def person_sightings(self, id):
+        return self.query_range(ids=[id])
+
+    '''
+        person_visits :
+        Returns the visits of one person (a visit_index.PersonVisits). They are read from our partitions the first time,
+        then kept in memory.
+    '''
+    def person_visits(self, id):
+        with self.lock:
+            if id not in self.visits:
+                self.visits.load(id, self.person_sightings(id))
+
+            return self.visits.get(id)
+
+    '''
+        __len__ :
+        Number of sightings (from our indexes).
+    '''
+    def __len__(self):
+        with self.lock:
+            return sum(index['rows'] for index in self.indexes.values())
+
+    '''
+        remove_person :
+        Removes every sighting of this person. The partitions they are in are written again without them (not often
+        done).
+    '''
+    def remove_person(self, id):
+        with self.lock:
+            for name in self.select_partitions(ids=[id]):
+                df = sighting_log.read_sightings(self.partition_file(name))
+                df = df[np.asarray(df.index, dtype=object).astype(str) != str(id)]
+
+                if len(df) == 0:
+                    self.drop_partition(name)
+                    continue
+
+                df.to_csv(self.partition_file(name) + '.tmp', date_format=sighting_log.TIME_FORMAT)
+                os.replace(self.partition_file(name) + '.tmp', self.partition_file(name))
+                self.indexes[name] = self.rebuild_index(name)
+
+            self.visits.remove(id)
+
+    '''
+        drop_partition :
+        Call holding our lock. Deletes a partition and its index.
+    '''
+    def drop_partition(self, name):
+        for filename in (self.partition_file(name), os.path.join(self.directory, name + INDEX_SUFFIX)):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+        self.indexes.pop(name, None)
+
+    '''
+        rollup_partition :
+        Adds the visits, total time, first arrival and last departure of each person in a partition to our rollup file.
+    '''
+    def rollup_partition(self, name):
+        df = sighting_log.read_sightings(self.partition_file(name))
+        grouped = df.groupby(level='UUID')
+        rollup = pd.DataFrame({'Partition': name,
+                               'Visits': grouped.size(),
+                               'Total Time': grouped['Total Time'].sum(),
+                               'First Arrival': grouped['Arrival Time'].min(),
+                               'Last Departure': grouped['Departure Time'].max()})
+        rollup.index.name = 'UUID'
+
+        filename = os.path.join(self.directory, ROLLUP_FILE)
+        rollup.reset_index()[ROLLUP_COLUMNS].to_csv(filename, mode='a', header=not os.path.exists(filename), index=False, date_format=sighting_log.TIME_FORMAT)
+
+    '''
+        apply_retention :
+        Drops the partitions that ended more than retention_days ago (rolling them up first if rollup is True). The
+        partition now (local time, like our sightings) is in is never dropped. Returns (partitions dropped, sightings dropped).
+    '''
+    def apply_retention(self, retention_days, rollup = True, now = None):
+        #our sightings (and partition names) are local time, like datetime.now() (np.datetime64('now') is UTC)
+        now = np.datetime64(datetime.datetime.now() if now is None else now, 'us')
+        cutoff = now - np.timedelta64(int(retention_days * 24 * 60 * 60 * 1000000), 'us')
+        live = partition_names([now], self.partition_days)[0]
+        dropped = 0
+        rows = 0
+
+        with self.lock:
+            for name in sorted(self.indexes):
+                partition_end = np.datetime64(name, 'D') + np.timedelta64(self.partition_days, 'D')
+
+                if name == live or partition_end > cutoff:
+                    continue
+
+                if rollup:
+                    self.rollup_partition(name)
+
+                rows += self.indexes[name]['rows']
+                self.drop_partition(name)
+                dropped += 1
+
+            #people we dropped visits of are read again when asked for
+            if dropped:
+                self.visits = visit_index.VisitIndex()
+
+        self.partitions_dropped += dropped
+
+        return dropped, rows
+
+    '''
+        run_retention :
+        Our retention thread. Applies our retention every RETENTION_INTERVAL seconds until we close.
+    '''
+    def run_retention(self):
+        while not self.stop_event.is_set():
+            dropped, rows = self.apply_retention(self.retention_days, self.rollup)
+
+            if dropped:
+                print('Sighting retention : dropped ' + str(dropped) + ' partitions (' + str(rows) + ' sightings) older than ' + str(self.retention_days) + ' days')
+
+            self.stop_event.wait(RETENTION_INTERVAL)
+
+    '''
+        close :
+        Stops our retention thread. Our sightings are already saved.
+    '''
+    def close(self):
+        self.stop_event.set()
+
+        if self.retention_thread is not None:
+            self.retention_thread.join()
+            self.retention_thread = None
+
+'''
+    open_archive :
+    Opens (or creates) our archive. A new archive imports sightings_file first (our sightings file is not changed).
+    Returns the archive.
+'''
+def open_archive(directory, sightings_file, partition_days = PARTITION_DAYS, retention_days = None):
+    archive = SightingArchive(directory, partition_days, retention_days)
+
+    if not archive.is_imported():
+        starttime = time.perf_counter()
+        sightings = archive.import_csv(sightings_file)
+        print('Imported ' + str(sightings) + ' sightings into ' + str(len(archive.indexes)) + ' partitions of ' + directory + ' (' + format(time.perf_counter() - starttime, '.2f') + ' s)')
+
+    return archive
+
+'''
+    main :
+    Range queries and retention from the command line.
+'''
+def main(argv):
+    parser = argparse.ArgumentParser(description='Queries our sighting archive, or drops old partitions from it.')
+    parser.add_argument('--directory', default=ARCHIVE_DIRECTORY)
+    commands = parser.add_subparsers(dest='command', required=True)
+    query = commands.add_parser('query', help='sightings of people here between start and end')
+    query.add_argument('start')
+    query.add_argument('end')
+    query.add_argument('--person', action='append', default=None, help='UUID of a person (more than one can be sent)')
+    retention = commands.add_parser('retention', help='drop partitions older than days')
+    retention.add_argument('days', type=float)
+    retention.add_argument('--no-rollup', action='store_true', help='do not keep a rollup of the partitions dropped')
+    args = parser.parse_args(argv[1:])
+
+    archive = SightingArchive(args.directory)
+
+    if args.command == 'query':
+        starttime = time.perf_counter()
+        start = np.datetime64(pd.Timestamp(args.start), 'us')
+        end = np.datetime64(pd.Timestamp(args.end), 'us')
+        partitions = archive.select_partitions(int(start.astype(np.int64)), int(end.astype(np.int64)), args.person)
+        df = archive.query_range(start, end, args.person)
+
+        print(df.to_string())
+        print(str(len(df)) + ' sightings, ' + str(len(partitions)) + ' of ' + str(len(archive.indexes)) + ' partitions read, ' + format(time.perf_counter() - starttime, '.3f') + ' s')
+    else:
+        dropped, rows = archive.apply_retention(args.days, not args.no_rollup)
+        print('Dropped ' + str(dropped) + ' partitions (' + str(rows) + ' sightings)')
+
+    archive.close()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
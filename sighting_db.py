@@ -0,0 +1,298 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Optional SQLite storage for our people (data1) and sightings (data2), in place of the pandas CSV files. Sightings
+are inserted as they happen and read back only when asked for (ex: one person's sightings, by an index on UUID), so
+startup does not load every sighting we ever saved. The first time a database is opened, our CSV files are imported.
+Follow the class below for flow.
+
+Run : python sighting_db.py [database file] [people file] [sightings file]    (imports the CSV files into the database)
+
+'''
+import os
+import sys
+import time
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+import sighting_log
+import visit_index
+
+DATABASE_FILENAME = 'db_data/security.db' #our database, next to the CSV files it replaces
+DATABASE_VERSION = 2 #PRAGMA user_version of a database we made (0 is a new database, not imported yet. 1 saved times as text)
+IMPORT_BATCH_SIZE = 10000 #sightings inserted at a time when we import a CSV file
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS people (uuid TEXT PRIMARY KEY, name TEXT, description TEXT)',
+    #arrival and departure are microseconds since 1970 (the datetime64[us] we use in memory)
+    'CREATE TABLE IF NOT EXISTS sightings (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL, arrival INTEGER NOT NULL, departure INTEGER NOT NULL, total_time INTEGER NOT NULL, camera INTEGER NOT NULL DEFAULT 0)',
+    'CREATE INDEX IF NOT EXISTS sightings_uuid ON sightings (uuid, arrival)',
+    'CREATE INDEX IF NOT EXISTS sightings_arrival ON sightings (arrival)',
+]
+
+SIGHTING_SELECT = 'SELECT uuid AS "UUID", arrival AS "Arrival Time", departure AS "Departure Time", total_time AS "Total Time", camera AS "Camera" FROM sightings'
+
+'''
+    class SightingDatabase :
+    Our people and sightings in one SQLite file (WAL mode, so reading does not block saving). Has the same sighting
+    functions as sighting_log.SightingLog (add, add_many, frame, person_sightings, person_visits, remove_person, close),
+    so our GUI and daemon can save to either. Each add_many is one transaction.
+'''
+class SightingDatabase:
+    def __init__(self, filename):
+        self.filename = filename
+
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.RLock() #guards our connection (the GUI and its threads share it)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        #WAL is safe from corruption with NORMAL, only the last commits can be lost on power loss
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+        self.sightings_added = 0 #sightings we saved since opening
+        self.visits = visit_index.VisitIndex() #visits of the people we looked up, kept up to date as they are seen again
+
+        if self.version() == 1:
+            self.upgrade_times()
+
+    '''
+        version :
+        Returns the version of our database (PRAGMA user_version).
+    '''
+    def version(self):
+        with self.lock:
+            return self.connection.execute('PRAGMA user_version').fetchone()[0]
+
+    '''
+        is_new :
+        Returns True if this database has not been imported into yet.
+    '''
+    def is_new(self):
+        return self.version() == 0
+
+    '''
+        upgrade_times :
+        Version 1 databases saved arrival and departure as text. Rebuilds our sightings table with them as microseconds,
+        in one transaction.
+    '''
+    def upgrade_times(self):
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            rows = self.connection.execute('SELECT id, uuid, arrival, departure, total_time, camera FROM sightings ORDER BY id').fetchall()
+
+            #our indexes would move with the old table, so drop them and make the table again
+            self.connection.execute('DROP INDEX IF EXISTS sightings_uuid')
+            self.connection.execute('DROP INDEX IF EXISTS sightings_arrival')
+            self.connection.execute('ALTER TABLE sightings RENAME TO sightings_text')
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+            if rows:
+                ids, uuids, arrivals, departures, totals, cameras = zip(*rows)
+                arrivals = visit_index.to_datetime64(arrivals).astype(np.int64).tolist()
+                departures = visit_index.to_datetime64(departures).astype(np.int64).tolist()
+                self.connection.executemany('INSERT INTO sightings (id, uuid, arrival, departure, total_time, camera) VALUES (?, ?, ?, ?, ?, ?)', zip(ids, uuids, arrivals, departures, totals, cameras))
+
+            self.connection.execute('DROP TABLE sightings_text')
+            self.connection.execute('PRAGMA user_version=' + str(DATABASE_VERSION))
+
+        print('Upgraded ' + str(len(rows)) + ' sightings in ' + self.filename + ' to version ' + str(DATABASE_VERSION))
+
+    '''
+        import_csv :
+        Imports our pandas CSV files (people_file and sightings_file with its log, see sighting_log.py) into this database,
+        in one transaction. Files that do not exist are skipped. Returns (people, sightings) imported.
+    '''
+    def import_csv(self, people_file, sightings_file):
+        people = 0
+        sightings = 0
+
+        with self.lock, self.connection:
+            if people_file and os.path.exists(people_file):
+                df1 = pd.read_csv(people_file)
+                rows = [(str(uid).rstrip(), str(name).rstrip(), str(description).rstrip()) for uid, name, description in zip(df1['UUID'], df1['Name'], df1['Description'].fillna(''))]
+                people = self.connection.executemany('INSERT OR IGNORE INTO people (uuid, name, description) VALUES (?, ?, ?)', rows).rowcount
+
+            if sightings_file and os.path.exists(sightings_file):
+                df2 = sighting_log.load_sightings(sightings_file)
+                rows = list(zip(df2.index.astype(str), df2['Arrival Time'].to_numpy().astype(np.int64).tolist(), df2['Departure Time'].to_numpy().astype(np.int64).tolist(), df2['Total Time'].tolist(), df2['Camera'].tolist()))
+
+                for start in range(0, len(rows), IMPORT_BATCH_SIZE):
+                    self.connection.executemany('INSERT INTO sightings (uuid, arrival, departure, total_time, camera) VALUES (?, ?, ?, ?, ?)', rows[start:start + IMPORT_BATCH_SIZE])
+
+                sightings = len(rows)
+
+            self.connection.execute('PRAGMA user_version=' + str(DATABASE_VERSION))
+
+        return people, sightings
+
+    '''
+        load_people :
+        Returns our people as a DataFrame indexed by UUID (Name, Description), in the order they were added, like data1.
+    '''
+    def load_people(self):
+        with self.lock:
+            df1 = pd.read_sql_query('SELECT uuid AS "UUID", name AS "Name", description AS "Description" FROM people ORDER BY rowid', self.connection)
+
+        df1.set_index(['UUID'], inplace=True)
+
+        return df1
+
+    '''
+        update_people :
+        Adds the people (labels, descriptions, ids) we do not have yet, like update_pandas_db. Returns our people DataFrame.
+    '''
+    def update_people(self, labels, descriptions, ids):
+        rows = [(id.rstrip(), label.rstrip(), description.rstrip()) for label, description, id in zip(labels, descriptions, ids)]
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO people (uuid, name, description) VALUES (?, ?, ?)', rows)
+
+        return self.load_people()
+
+    '''
+        add_person :
+        Adds one person, like face_data.add_pandas_db_person. Returns df1 with them added.
+    '''
+    def add_person(self, df1, label, description, id):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO people (uuid, name, description) VALUES (?, ?, ?)', (id.rstrip(), label.rstrip(), description.rstrip()))
+
+        n_df1 = pd.DataFrame([[id.rstrip(), label.rstrip(), description.rstrip()]], columns=['UUID', 'Name', 'Description'])
+        n_df1.set_index(['UUID'], inplace=True)
+
+        return pd.concat([df1, n_df1])
+
+    '''
+        add :
+        Saves one sighting (when a person arrived and left, on which camera).
+    '''
+    def add(self, id, start_time, end_time, camera = 0):
+        self.add_many([(id, start_time, end_time, camera)])
+
+    '''
+        add_many :
+        Saves a list of sightings, (id, arrival, departure, camera) each, in one transaction.
+    '''
+    def add_many(self, sightings):
+        if not sightings:
+            return
+
+        rows = sighting_log.sighting_rows(sightings)
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO sightings (uuid, arrival, departure, total_time, camera) VALUES (?, ?, ?, ?, ?)',
+                                        [(id, int(start_time.astype(np.int64)), int(end_time.astype(np.int64)), total_time, camera) for id, start_time, end_time, total_time, camera in rows])
+
+            for id, start_time, end_time, total_time, camera in rows:
+                if id in self.visits:
+                    self.visits.add(id, start_time, end_time, total_time, camera)
+
+        self.sightings_added += len(rows)
+
+    '''
+        query_sightings :
+        Returns the sightings selected by where (SQL after WHERE, with params) as a DataFrame indexed by UUID, sorted by
+        order (default is the order they were saved).
+    '''
+    def query_sightings(self, where = None, params = (), order = 'id'):
+        sql = SIGHTING_SELECT + (' WHERE ' + where if where else '') + ' ORDER BY ' + order
+
+        with self.lock:
+            df = pd.read_sql_query(sql, self.connection, params=params, dtype={'UUID': object, 'Arrival Time': np.int64, 'Departure Time': np.int64, 'Total Time': np.int64, 'Camera': np.int64})
+
+        #our times are microseconds since 1970
+        df['Arrival Time'] = df['Arrival Time'].to_numpy().astype(sighting_log.TIME_DTYPE)
+        df['Departure Time'] = df['Departure Time'].to_numpy().astype(sighting_log.TIME_DTYPE)
+        df.set_index(['UUID'], inplace=True)
+
+        return df
+
+    '''
+        frame :
+        Returns every sighting as a DataFrame indexed by UUID. This reads the whole table, use person_sightings when you
+        only need one person.
+    '''
+    def frame(self):
+        return self.query_sightings()
+
+    '''
+        person_sightings :
+        Returns the sightings of one person by arrival time (read straight from our UUID index).
+    '''
+    def person_sightings(self, id):
+        return self.query_sightings('uuid = ?', (id,), 'arrival')
+
+    '''
+        person_visits :
+        Returns the visits of one person (a visit_index.PersonVisits). They are read from our UUID index the first time,
+        then kept in memory.
+    '''
+    def person_visits(self, id):
+        with self.lock:
+            if id not in self.visits:
+                self.visits.load(id, self.person_sightings(id))
+
+            return self.visits.get(id)
+
+    '''
+        __len__ :
+        Number of sightings.
+    '''
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM sightings').fetchone()[0]
+
+    '''
+        remove_person :
+        Removes this person and every sighting of them.
+    '''
+    def remove_person(self, id):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM sightings WHERE uuid = ?', (id,))
+            self.connection.execute('DELETE FROM people WHERE uuid = ?', (id,))
+            self.visits.remove(id)
+
+    '''
+        close :
+        Closes our database.
+    '''
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+'''
+    load_update_database :
+    Opens (or creates) our database, like face_data.load_update_pandas_db does for our CSV files. A new database imports
+    people_file and sightings_file first. Then the people we do not have are added. Returns (people DataFrame, database).
+'''
+def load_update_database(filename, people_file, sightings_file, labels, descriptions, ids) -> tuple:
+    database = SightingDatabase(filename)
+
+    if database.is_new():
+        starttime = time.perf_counter()
+        people, sightings = database.import_csv(people_file, sightings_file)
+        print('Imported ' + str(people) + ' people and ' + str(sightings) + ' sightings into ' + filename + ' (' + format(time.perf_counter() - starttime, '.2f') + ' s)')
+
+    return database.update_people(labels, descriptions, ids), database
+
+if __name__ == "__main__":
+    #import our CSV files into a database (only if it is new)
+    database_file = sys.argv[1] if len(sys.argv) > 1 else DATABASE_FILENAME
+    people_file = sys.argv[2] if len(sys.argv) > 2 else 'db_data/data1.cvs'
+    sightings_file = sys.argv[3] if len(sys.argv) > 3 else 'db_data/data2.cvs'
+
+    df1, database = load_update_database(database_file, people_file, sightings_file, [], [], [])
+    print(str(len(df1)) + ' people, ' + str(len(database)) + ' sightings in ' + database_file)
+    database.close()
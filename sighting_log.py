@@ -0,0 +1,453 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Saves sightings without rewriting our whole sightings file (data2) each time a person leaves. New sightings are
+appended to a log file next to it, one line each. Once the log gets big, it is merged into the sightings file on a
+background thread (compaction). Loading reads the sightings file and then the log. Removing a person only appends their UUID to a removed file, their
+rows are left out when we read and dropped for good by the next compaction.
+Follow the class below for flow.
+
+'''
+import os
+import csv
+import threading
+import numpy as np
+import pandas as pd
+import visit_index
+
+SIGHTING_COLUMNS = ['UUID', 'Arrival Time', 'Departure Time', 'Total Time', 'Camera'] #columns of our sightings file and log
+SIGHTING_DTYPES = {'UUID': str, 'Total Time': np.int64} #dtypes we read our columns as (times are parsed to TIME_DTYPE, missing cameras are 0)
+TIME_DTYPE = 'datetime64[us]' #dtype of arrival and departure times in memory
+LOG_SUFFIX = '.log' #sightings appended since the last compaction
+COMPACTING_SUFFIX = '.compacting' #the log being merged into the sightings file (kept until the merge is saved, its rows may already be in it)
+REMOVED_SUFFIX = '.removed' #UUIDs of people removed since the last compaction, one per line (their rows are left out when we read)
+COMPACT_MIN_ROWS = 1000 #log rows before we compact
+COMPACT_RATIO = 0.25 #log rows, as a part of the sightings file rows, before we compact
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f' #how arrival and departure times are saved
+
+'''
+    log_files :
+    Returns the log files of a sightings file, in the order they are read.
+'''
+def log_files(filename):
+    return [filename + COMPACTING_SUFFIX, filename + LOG_SUFFIX]
+
+'''
+    format_times :
+    Returns datetime64 times as we save them, like TIME_FORMAT (always with microseconds). Works on one time or an array.
+'''
+def format_times(times):
+    return np.char.replace(np.datetime_as_string(np.asarray(times, dtype=TIME_DTYPE), unit='us'), 'T', ' ')
+
+'''
+    sighting_rows :
+    Turns sightings, (id, arrival, departure, camera) each, into rows of our sightings file : arrival and departure as
+    datetime64 and total time in seconds.
+'''
+def sighting_rows(sightings):
+    rows = []
+
+    for id, start_time, end_time, camera in sightings:
+        start_time = np.datetime64(start_time, 'us')
+        end_time = np.datetime64(end_time, 'us')
+        rows.append([id, start_time, end_time, int((end_time - start_time) // np.timedelta64(1, 's')), int(camera)])
+
+    return rows
+
+'''
+    write_rows :
+    Appends rows to an open log file (file_handle), writing the header first if the file is empty.
+'''
+def write_rows(file_handle, rows):
+    writer = csv.writer(file_handle)
+
+    if file_handle.tell() == 0:
+        writer.writerow(SIGHTING_COLUMNS)
+
+    writer.writerows([id, str(format_times(start_time)), str(format_times(end_time)), total_time, camera] for id, start_time, end_time, total_time, camera in rows)
+    file_handle.flush()
+
+'''
+    append_sightings :
+    Appends sightings to the log of filename, without a SightingLog (ex: one off tools). Returns their rows.
+'''
+def append_sightings(filename, sightings):
+    rows = sighting_rows(sightings)
+
+    with open(filename + LOG_SUFFIX, 'a', newline='') as file_handle:
+        write_rows(file_handle, rows)
+
+    return rows
+
+'''
+    rows_to_frame :
+    Returns rows (like sighting_rows makes) as a sightings DataFrame with our dtypes, indexed by UUID like our sightings file.
+'''
+def rows_to_frame(rows):
+    columns = list(zip(*rows)) if rows else [[]] * len(SIGHTING_COLUMNS)
+    df = pd.DataFrame({'UUID': pd.Series(columns[0], dtype=object),
+                       'Arrival Time': np.array(columns[1], dtype=TIME_DTYPE),
+                       'Departure Time': np.array(columns[2], dtype=TIME_DTYPE),
+                       'Total Time': np.array(columns[3], dtype=np.int64),
+                       'Camera': np.array(columns[4], dtype=np.int64)})
+    df.set_index(['UUID'], inplace=True)
+
+    return df
+
+'''
+    read_sightings :
+    Reads a sightings file (or log) with our dtypes : times as datetime64, total time and camera as int64. Sightings
+    saved before we had more than one camera were all on our first camera.
+'''
+def read_sightings(filename):
+    df = pd.read_csv(filename, dtype=SIGHTING_DTYPES)
+
+    df['Arrival Time'] = visit_index.to_datetime64(df['Arrival Time'])
+    df['Departure Time'] = visit_index.to_datetime64(df['Departure Time'])
+    df['Camera'] = df['Camera'].fillna(0).astype(np.int64) if 'Camera' in df.columns else np.zeros(len(df), dtype=np.int64)
+    df.set_index(['UUID'], inplace=True)
+
+    return df
+
+'''
+    read_removed :
+    Returns the UUIDs removed from filename since its last compaction (an empty set if none).
+'''
+def read_removed(filename):
+    if not os.path.exists(filename + REMOVED_SUFFIX):
+        return set()
+
+    with open(filename + REMOVED_SUFFIX) as file_handle:
+        return set(line.strip() for line in file_handle if line.strip())
+
+'''
+    drop_removed :
+    Returns the sightings in df that are not of the people in removed.
+'''
+def drop_removed(df, removed):
+    if not removed or len(df) == 0:
+        return df
+
+    return df[~df.index.astype(str).isin(list(removed))]
+
+'''
+    load_sightings :
+    Returns every sighting of filename : its sightings file (if there is one) and its log, without the people removed since
+    the last compaction.
+'''
+def load_sightings(filename):
+    df2 = read_sightings(filename) if os.path.exists(filename) else rows_to_frame([])
+    log = read_log(filename, df2)
+
+    if len(log) > 0:
+        df2 = pd.concat([df2, log])
+
+    return drop_removed(df2, read_removed(filename))
+
+'''
+    read_log :
+    Returns the sightings in the log files of filename as one DataFrame (empty if there are none). Send in df2, the
+    sightings file as read_sightings loads it, so rows of a compacting file that are already in it are left out (a
+    compaction stopped after saving the sightings file, but before removing the compacting file). People removed since
+    the last compaction are left out.
+'''
+def read_log(filename, df2 = None):
+    frames = []
+    removed = read_removed(filename)
+
+    for log_file in log_files(filename):
+        if not os.path.exists(log_file) or os.path.getsize(log_file) == 0:
+            continue
+
+        log = read_sightings(log_file)
+
+        if df2 is not None and log_file.endswith(COMPACTING_SUFFIX):
+            log = drop_saved_rows(log, df2)
+
+        frames.append(drop_removed(log, removed))
+
+    if not frames:
+        return rows_to_frame([])
+
+    return pd.concat(frames)
+
+'''
+    drop_saved_rows :
+    Returns the sightings in log that are not in df2 (same UUID, arrival, departure and camera).
+'''
+def drop_saved_rows(log, df2):
+    if len(log) == 0 or len(df2) == 0:
+        return log
+
+    keys = ['Arrival Time', 'Departure Time', 'Camera']
+    saved = pd.MultiIndex.from_arrays([df2.index.astype(str)] + [df2[key] for key in keys])
+    rows = pd.MultiIndex.from_arrays([log.index.astype(str)] + [log[key] for key in keys])
+
+    return log[~rows.isin(saved)]
+
+'''
+    count_log_rows :
+    Returns the number of sightings in the log files of filename.
+'''
+def count_log_rows(filename):
+    rows = 0
+
+    for log_file in log_files(filename):
+        if os.path.exists(log_file):
+            with open(log_file) as file_handle:
+                #less the header
+                rows += max(0, sum(1 for line in file_handle) - 1)
+
+    return rows
+
+'''
+    class SightingLog :
+    Our sightings file and its log. add appends one line to the log (and keeps the row in memory), so saving a sighting
+    does not depend on how many sightings we have. frame returns every sighting as a DataFrame, new rows are added to it
+    only when it is asked for. compact merges the log into the sightings file, sorted by arrival time, on a background
+    thread. remove_person saves the UUID to our removed file and compacts in the background too. df2 is our sightings
+    file loaded with load_pandas_db (its log rows included, removed people left out).
+'''
+class SightingLog:
+    def __init__(self, filename, df2, compact_min_rows = COMPACT_MIN_ROWS, compact_ratio = COMPACT_RATIO):
+        self.filename = filename #our sightings file
+        self.log_filename = filename + LOG_SUFFIX
+        self.compacting_filename = filename + COMPACTING_SUFFIX
+        self.removed_filename = filename + REMOVED_SUFFIX
+        self.compact_min_rows = compact_min_rows
+        self.compact_ratio = compact_ratio
+        self.df = df2 if df2 is not None else rows_to_frame([]) #sightings up to the rows in pending
+        self.pending = [] #rows added since we last made df
+        self.log_rows = count_log_rows(filename) #rows in our log files
+        self.lock = threading.RLock() #guards our rows and log file (compaction runs on its own thread)
+        self.log_handle = None #our log file, opened on our first add
+        self.compact_thread = None
+        self.compactions = 0 #compactions done
+        self.removed = read_removed(filename) #people removed, whose rows may still be in our files (until a compaction started after their removal is saved)
+        self.visits = visit_index.VisitIndex() #each person's visits, for their history
+        self.visits.build(self.df)
+
+    '''
+        add :
+        Saves one sighting (when a person arrived and left, on which camera).
+    '''
+    def add(self, id, start_time, end_time, camera = 0):
+        self.add_many([(id, start_time, end_time, camera)])
+
+    '''
+        add_many :
+        Saves a list of sightings, (id, arrival, departure, camera) each, with one write to our log.
+    '''
+    def add_many(self, sightings):
+        if not sightings:
+            return
+
+        rows = sighting_rows(sightings)
+
+        with self.lock:
+            if self.log_handle is None:
+                self.log_handle = open(self.log_filename, 'a', newline='')
+
+            write_rows(self.log_handle, rows)
+            self.pending.extend(rows)
+            self.log_rows += len(rows)
+
+            for id, start_time, end_time, total_time, camera in rows:
+                self.visits.add(id, start_time, end_time, total_time, camera)
+
+            if self.needs_compaction():
+                self.compact()
+
+    '''
+        frame :
+        Returns every sighting as a DataFrame indexed by UUID. Rows added since the last call are joined once here.
+        Do not change the frame returned, use remove_person.
+    '''
+    def frame(self):
+        with self.lock:
+            if self.pending:
+                self.df = pd.concat([self.df, rows_to_frame(self.pending)])
+                self.pending = []
+
+            return self.df
+
+    '''
+        person_visits :
+        Returns the visits of one person (a visit_index.PersonVisits), None if we have none.
+    '''
+    def person_visits(self, id):
+        with self.lock:
+            return self.visits.get(id)
+
+    '''
+        person_sightings :
+        Returns the sightings of one person (this looks at every sighting, use person_visits).
+    '''
+    def person_sightings(self, id):
+        df = self.frame()
+
+        return df.loc[df.index == id]
+
+    '''
+        __len__ :
+        Number of sightings.
+    '''
+    def __len__(self):
+        with self.lock:
+            return len(self.df) + len(self.pending)
+
+    '''
+        needs_compaction :
+        Returns True if our log is big enough to merge into our sightings file.
+    '''
+    def needs_compaction(self):
+        return self.log_rows >= max(self.compact_min_rows, self.compact_ratio * (len(self) - self.log_rows))
+
+    '''
+        compact :
+        Merges our log into our sightings file on a background thread. New sightings go to a new log while we do, so adds
+        never wait on compaction. If a compaction is already running, does nothing, or with wait=True waits for it and
+        then compacts again and waits for that.
+    '''
+    def compact(self, wait = False):
+        while True:
+            with self.lock:
+                if self.compact_thread is None or not self.compact_thread.is_alive():
+                    self.rotate_log()
+                    self.log_rows = 0
+                    self.compact_thread = threading.Thread(target=self.run_compaction, args=(self.frame(), set(self.removed)), name='sighting compaction', daemon=True)
+                    self.compact_thread.start()
+                    thread = self.compact_thread
+                    break
+
+                #one is running, and its rows may be older than ours
+                if not wait:
+                    return
+
+                thread = self.compact_thread
+
+            thread.join()
+
+        if wait:
+            thread.join()
+
+    '''
+        rotate_log :
+        Call holding our lock. Moves our log to the compacting file (appending to it, if one was left by a compaction that
+        did not finish), so new sightings start a new log.
+    '''
+    def rotate_log(self):
+        if self.log_handle is not None:
+            self.log_handle.close()
+            self.log_handle = None
+
+        if not os.path.exists(self.log_filename):
+            return
+
+        if not os.path.exists(self.compacting_filename):
+            os.replace(self.log_filename, self.compacting_filename)
+            return
+
+        log = pd.read_csv(self.log_filename)
+        log.to_csv(self.compacting_filename, mode='a', header=False, index=False)
+        os.remove(self.log_filename)
+
+    '''
+        run_compaction :
+        Our compaction thread. Saves df, then if people were removed after it was taken (removed is who was removed
+        before), rotates our log and compacts again, so every removal is saved by a compaction that started after it.
+    '''
+    def run_compaction(self, df, removed):
+        while True:
+            self.write_compacted(df, removed)
+
+            with self.lock:
+                if not self.removed - removed:
+                    return
+
+                self.rotate_log()
+                self.log_rows = 0
+                df = self.frame()
+                removed = set(self.removed)
+
+    '''
+        write_compacted :
+        Saves df (every sighting up to the rotated log) sorted by arrival time to a temporary file, replaces our sightings
+        file with it and then removes the compacting file. If we stop in between, read_log leaves out the compacting rows
+        the sightings file already has. Then the people in removed (df was taken after their removal) are taken off our
+        removed file, their rows are gone from our files.
+    '''
+    def write_compacted(self, df, removed = frozenset()):
+        temp_filename = self.filename + '.tmp'
+
+        df = df.sort_values('Arrival Time', kind='mergesort')
+        df.to_csv(temp_filename, date_format=TIME_FORMAT)
+        os.replace(temp_filename, self.filename)
+
+        if os.path.exists(self.compacting_filename):
+            os.remove(self.compacting_filename)
+
+        if removed:
+            with self.lock:
+                self.removed -= removed
+                self.write_removed()
+
+        self.compactions += 1
+
+    '''
+        write_removed :
+        Call holding our lock. Saves our removed UUIDs (to a temporary file first), or removes the file if we have none.
+    '''
+    def write_removed(self):
+        if not self.removed:
+            if os.path.exists(self.removed_filename):
+                os.remove(self.removed_filename)
+            return
+
+        with open(self.removed_filename + '.tmp', 'w') as file_handle:
+            file_handle.writelines(id + '\n' for id in sorted(self.removed))
+
+        os.replace(self.removed_filename + '.tmp', self.removed_filename)
+
+    '''
+        remove_person :
+        Removes every sighting of this person. Their UUID is appended to our removed file first, so their rows in our
+        sightings file and logs are left out when we read, even if we stop before they are compacted away. The
+        compaction runs in the background like any other.
+    '''
+    def remove_person(self, id):
+        id = str(id)
+
+        with self.lock:
+            df = self.frame()
+
+            if id not in df.index:
+                return
+
+            with open(self.removed_filename, 'a') as file_handle:
+                file_handle.write(id + '\n')
+                file_handle.flush()
+                os.fsync(file_handle.fileno())
+
+            self.removed.add(id)
+            self.df = df.drop(index=[id])
+            self.visits.remove(id)
+
+        self.compact()
+
+    '''
+        close :
+        Waits for a running compaction and closes our log. Our sightings stay in the log until the next compaction.
+    '''
+    def close(self):
+        with self.lock:
+            thread = self.compact_thread
+
+            if self.log_handle is not None:
+                self.log_handle.close()
+                self.log_handle = None
+
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,123 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Keeps track of who is being seen right now, on each camera, so we know when they arrived and when they left.
+Used by the GUI (main_security.py) and the headless daemon (security_daemon.py). No GUI imports here.
+Follow the class below for flow.
+
+'''
+import threading
+import datetime
+
+'''
+    class SightingTracker :
+    Holds a FaceData for each known person being seen now, one for each camera they are on. add takes the faces data
+    recognition sends back, seen takes the faces our detection stages are still tracking, and expired returns the people
+    not seen for a while (their sighting is over and can be saved).
+'''
+class SightingTracker:
+    def __init__(self):
+        self.faces = [] #FaceData of each person seen now (date_time_first is when they arrived)
+        self.lock = threading.RLock() #guards faces (our GUI holds it while it updates its listbox)
+        self.seen_frames = {} #camera -> frame_id of the last DetectionResult we applied in seen (we are sent the same one until a new frame is detected)
+
+    '''
+        find :
+        Returns the current face of this person on this camera, or None.
+    '''
+    def find(self, id, camera):
+        for face in self.faces:
+            if face.id == id and face.camera == camera:
+                return face
+
+        return None
+
+    '''
+        add :
+        Adds the known faces in faces_data (one recognition result). People we already have are updated. Returns the
+        faces that are new (they just arrived).
+    '''
+    def add(self, faces_data):
+        new_faces = []
+
+        with self.lock:
+            for face in faces_data:
+                #make sure this face is not unknown
+                if face.name == "Unknown":
+                    continue
+
+                current_face = self.find(face.id, face.camera)
+
+                #update last time and track
+                if current_face is not None:
+                    current_face.date_time_last = face.date_time_first
+                    current_face.track_id = face.track_id
+                #not in list, so add to it (once, if they are in this result twice)
+                elif not any(new_face.id == face.id and new_face.camera == face.camera for new_face in new_faces):
+                    new_faces.append(face)
+
+            self.faces.extend(new_faces)
+
+        return new_faces
+
+    '''
+        seen :
+        Updates the last seen time of the people a detection stage is still tracking (known faces on tracks are not sent
+        to recognition every time). detection is a DetectionResult. Their last seen time is when its frame was captured,
+        and a result we already applied is skipped, so a camera that stalls or a source that ended does not keep them here.
+    '''
+    def seen(self, detection, now = None):
+        with self.lock:
+            if self.seen_frames.get(detection.camera) == detection.frame_id:
+                return
+
+            self.seen_frames[detection.camera] = detection.frame_id
+
+        ids = set(id for id, name in zip(detection.ids, detection.names) if id is not None and name != 'Unknown')
+
+        if not ids:
+            return
+
+        #when the frame was captured, on our clock
+        now = datetime.datetime.now() if now is None else now
+        captured = now - datetime.timedelta(seconds=max(0.0, detection.age()))
+
+        with self.lock:
+            for face in self.faces:
+                if face.id in ids and face.camera == detection.camera and captured > face.date_time_last:
+                    face.date_time_last = captured
+
+    '''
+        expired :
+        Returns the faces not seen for removal_time seconds or more (0 returns them all). They are removed from our faces,
+        unless remove is False (then the caller removes them).
+    '''
+    def expired(self, removal_time, now = None, remove = True):
+        now = datetime.datetime.now() if now is None else now
+
+        with self.lock:
+            removed_faces = [face for face in self.faces if (now - face.date_time_last).total_seconds() >= removal_time]
+
+            if remove:
+                for face in removed_faces:
+                    self.faces.remove(face)
+
+        return removed_faces
+
+    '''
+        first_last_seen :
+        Returns when this person was first and last seen, in the sighting we have for them now (None, None if we have none).
+    '''
+    def first_last_seen(self, id):
+        first = None
+        last = None
+
+        with self.lock:
+            for face in self.faces:
+                if face.id == id:
+                    first = face.date_time_first
+                    last = face.date_time_last
+
+        return first, last
@@ -0,0 +1,286 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Goes through a recorded video file (ex: after an incident) as fast as our cpu cores allow. The video is split
+into chunks of frames, each worker process finds and recognizes the faces in its chunks, and who was seen is saved to
+our sightings file (data2) with the time in the video they were seen.
+
+Run : python video_analyzer.py video.mp4 [--start "2024-01-22 14:00:00"] [--camera 1] [--fps 5] [--workers 4] [--chunk 30] [--config config.json]
+
+Without --start, the video is taken to have ended when the file was last changed. --config is a security_daemon.py
+config file, for where our people and sightings are saved.
+
+Files Needed :
+
+face_data.py
+face_gallery.py
+security_daemon.py (and its files)
+
+'''
+import os
+import sys
+import time
+import argparse
+import datetime
+import multiprocessing
+import cv2
+import numpy as np
+import face_recognition
+import face_data
+import face_gallery
+
+ANALYSIS_FPS = 5.0 #frames per second of video we look for faces in (the rest are skipped)
+CHUNK_SECONDS = 30 #seconds of video each job covers
+ANALYSIS_SCALE = 0.5 #scale frames are shrunk to before we look for faces
+ANALYSIS_UPSAMPLE = 1 #times the face detector upsamples
+ANALYSIS_BATCH_SIZE = 8 #frames with faces we encode together
+SIGHTING_GAP = 60 #seconds of video a person is not seen before their sighting ends
+REPORT_INTERVAL = 2.0 #seconds between progress reports
+
+'''
+    video_info :
+    Returns (frame count, frames per second, width, height) of a video file. Frame count is 0 if it can not be opened.
+'''
+def video_info(filename):
+    cap = cv2.VideoCapture(filename)
+
+    if not cap.isOpened():
+        return 0, 0.0, 0, 0
+
+    info = (int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    cap.release()
+
+    return info
+
+'''
+    plan_chunks :
+    Splits frame_count frames into (start, end) ranges of about chunk_frames each. Starts are a multiple of step, so the
+    frames we look at are the same however the video is split.
+'''
+def plan_chunks(frame_count, chunk_frames, step):
+    chunk_frames = max(step, (chunk_frames // step) * step)
+    return [(start, min(start + chunk_frames, frame_count)) for start in range(0, frame_count, chunk_frames)]
+
+'''
+    init_analysis_worker :
+    Runs once in each analysis process. Builds our gallery index and keeps the settings every chunk uses.
+'''
+def init_analysis_worker(filename, encodings, keys, step, scale, upsample, progress):
+    global analysis_filename, analysis_gallery, analysis_step, analysis_scale, analysis_upsample, analysis_progress
+    analysis_filename = filename
+    analysis_gallery = face_gallery.create_gallery_index(encodings, keys)
+    analysis_step = step
+    analysis_scale = scale
+    analysis_upsample = upsample
+    analysis_progress = progress
+
+'''
+    analyze_chunk :
+    Runs in an analysis process. Looks for faces in every step frames of one chunk (frames in between are grabbed, not
+    converted) and recognizes them. Returns (frames analyzed, faces found, list of (frame index, UUID, distance) for each
+    known face).
+'''
+def analyze_chunk(chunk):
+    start, end = chunk
+    cap = cv2.VideoCapture(analysis_filename)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    analyzed = 0
+    faces = 0
+    matches = []
+    batch = [] #(frame index, RGB small frame, locations) waiting to be encoded
+    counted = 0 #frames added to our progress counter
+
+    for index in range(start, end):
+        #frames we do not look at only need to be grabbed
+        if (index - start) % analysis_step:
+            if not cap.grab():
+                break
+            continue
+
+        ret, frame = cap.read()
+        if not ret:
+            break
+
+        analyzed += 1
+        small_frame = cv2.resize(frame, (0, 0), fx=analysis_scale, fy=analysis_scale)
+        locations = face_recognition.face_locations(cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY), number_of_times_to_upsample=analysis_upsample)
+
+        if locations:
+            faces += len(locations)
+            batch.append((index, cv2.cvtColor(small_frame, cv2.COLOR_BGR2RGB), locations))
+
+        if len(batch) >= ANALYSIS_BATCH_SIZE:
+            matches.extend(recognize_batch(batch))
+            batch = []
+
+        #let our main process know how far we are
+        if index - start - counted >= 100:
+            with analysis_progress.get_lock():
+                analysis_progress.value += index - start - counted
+            counted = index - start
+
+    if batch:
+        matches.extend(recognize_batch(batch))
+
+    cap.release()
+
+    with analysis_progress.get_lock():
+        analysis_progress.value += end - start - counted
+
+    return analyzed, faces, matches
+
+'''
+    recognize_batch :
+    Encodes the faces of a batch of frames together and matches them against our known people. Returns (frame index,
+    UUID, distance) for each known face.
+'''
+def recognize_batch(batch):
+    encodings = face_data.batch_face_encodings([image for index, image, locations in batch], [locations for index, image, locations in batch])
+    indexes = [index for (index, image, locations), image_encodings in zip(batch, encodings) for _ in image_encodings]
+    flat = [encoding for image_encodings in encodings for encoding in image_encodings]
+
+    if not flat or len(analysis_gallery) == 0:
+        return []
+
+    keys, distances, matched = analysis_gallery.match(flat)
+
+    return [(index, key, float(distance)) for index, key, distance, match in zip(indexes, keys, distances, matched) if match]
+
+'''
+    analyze_video :
+    Finds and recognizes the faces in a video file, on worker processes. face_encodings and unique_ids are our known
+    people (templates for each person, like load_encode_face_data returns). Prints progress every report_interval seconds.
+    Returns (list of (frame index, UUID, distance) in frame order, dict of stats).
+'''
+def analyze_video(filename, face_encodings, unique_ids, workers = None, analysis_fps = ANALYSIS_FPS, chunk_seconds = CHUNK_SECONDS, scale = ANALYSIS_SCALE, upsample = ANALYSIS_UPSAMPLE, report_interval = REPORT_INTERVAL):
+    frame_count, fps, width, height = video_info(filename)
+
+    if frame_count <= 0:
+        raise ValueError('Could not read video file ' + str(filename))
+
+    fps = fps if fps > 0 else 30.0
+    step = max(1, int(round(fps / analysis_fps))) if analysis_fps else 1
+    chunks = plan_chunks(frame_count, int(chunk_seconds * fps), step)
+    workers = workers if workers else multiprocessing.cpu_count()
+    progress = multiprocessing.Value('q', 0) #frames our workers got through
+    encodings, keys = face_gallery.flatten_templates(face_encodings, unique_ids)
+
+    print('Analyzing ' + str(filename) + ' : ' + str(frame_count) + ' frames (' + format(frame_count / fps, '.1f') + ' s at ' + format(fps, '.1f') + ' fps, ' + str(width) + 'x' + str(height) + '), every ' + str(step) + ' frames, ' + str(len(chunks)) + ' chunks on ' + str(workers) + ' processes')
+
+    starttime = time.perf_counter()
+
+    with multiprocessing.Pool(workers, initializer=init_analysis_worker, initargs=(filename, encodings, keys, step, scale, upsample, progress)) as pool:
+        result = pool.map_async(analyze_chunk, chunks, chunksize=1)
+
+        #report while we wait
+        while not result.ready():
+            result.wait(report_interval)
+            print_progress(progress.value, frame_count, fps, time.perf_counter() - starttime)
+
+        chunk_results = result.get()
+
+    elapsed = max(time.perf_counter() - starttime, 1e-9)
+
+    #chunks come back in order, so our matches are in frame order
+    matches = [match for analyzed, faces, chunk_matches in chunk_results for match in chunk_matches]
+    stats = {'frames': frame_count,
+             'fps': fps,
+             'frames_analyzed': sum(analyzed for analyzed, faces, chunk_matches in chunk_results),
+             'faces': sum(faces for analyzed, faces, chunk_matches in chunk_results),
+             'known_faces': len(matches),
+             'seconds': elapsed,
+             'frames_per_second': frame_count / elapsed,
+             'real_time': (frame_count / fps) / elapsed}
+
+    return matches, stats
+
+'''
+    print_progress :
+    Prints how far through the video we are, frames per second and how many times faster than real time that is.
+'''
+def print_progress(frames_done, frame_count, fps, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    print('Analyzed ' + format(frames_done * 100 / max(frame_count, 1), '.1f') + '% (' + str(frames_done) + ' of ' + str(frame_count) + ' frames), ' + format(frames_done / elapsed, '.1f') + ' frames/s, ' + format((frames_done / fps) / elapsed, '.1f') + 'x real time')
+
+'''
+    build_sightings :
+    Turns matches (frame index, UUID, distance) into sightings (UUID, arrival, departure, camera). A person not seen for
+    gap seconds of video has left. Times are start_time plus the time in the video.
+'''
+def build_sightings(matches, fps, start_time, camera = 0, gap = SIGHTING_GAP):
+    seen = {} #UUID -> list of seconds into the video they were seen
+
+    for index, key, distance in matches:
+        seen.setdefault(key, []).append(index / fps)
+
+    sightings = []
+
+    for key, times in seen.items():
+        times = np.sort(np.array(times))
+        #a new sighting starts after every gap
+        breaks = np.flatnonzero(np.diff(times) > gap)
+        starts = np.concatenate(([0], breaks + 1))
+        ends = np.concatenate((breaks, [len(times) - 1]))
+
+        for first, last in zip(starts, ends):
+            sightings.append((key, start_time + datetime.timedelta(seconds=float(times[first])), start_time + datetime.timedelta(seconds=float(times[last])), camera))
+
+    #in the order they arrived
+    sightings.sort(key=lambda sighting: sighting[1])
+
+    return sightings
+
+'''
+    video_start_time :
+    Returns when the video started : the file's last change time, less the length of the video.
+'''
+def video_start_time(filename):
+    frame_count, fps, width, height = video_info(filename)
+    length = frame_count / fps if fps > 0 else 0
+
+    return datetime.datetime.fromtimestamp(os.path.getmtime(filename)) - datetime.timedelta(seconds=length)
+
+'''
+    main :
+    Analyzes the video sent in and adds the sightings to our sightings file.
+'''
+def main(argv):
+    #only needed here, the daemon config has where our files are
+    import security_daemon
+
+    parser = argparse.ArgumentParser(description='Finds who was seen in a recorded video file and saves the sightings.')
+    parser.add_argument('video')
+    parser.add_argument('--start', help='when the video started (YYYY-MM-DD HH:MM:SS), default is the file time less the video length')
+    parser.add_argument('--camera', type=int, default=0, help='camera id saved with the sightings')
+    parser.add_argument('--fps', type=float, default=ANALYSIS_FPS, help='frames per second of video to look for faces in')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default is every cpu core)')
+    parser.add_argument('--chunk', type=float, default=CHUNK_SECONDS, help='seconds of video each job covers')
+    parser.add_argument('--gap', type=float, default=SIGHTING_GAP, help='seconds a person is not seen before their sighting ends')
+    parser.add_argument('--config', default=None, help='security_daemon.py config file, for where our people and sightings are saved')
+    args = parser.parse_args(argv[1:])
+
+    config = security_daemon.load_config(args.config)
+    start_time = datetime.datetime.fromisoformat(args.start) if args.start else video_start_time(args.video)
+
+    images, labels, descriptions, unique_ids, image_paths, face_encodings, face_names = face_data.load_encode_face_data(config['encoding_directory'])
+    df1, sighting_store = security_daemon.open_storage(config, labels, descriptions, unique_ids)
+
+    matches, stats = analyze_video(args.video, face_encodings, unique_ids, args.workers, args.fps, args.chunk)
+    sightings = build_sightings(matches, stats['fps'], start_time, args.camera, args.gap)
+    sighting_store.add_many(sightings)
+    sighting_store.close()
+
+    names = dict(zip(unique_ids, labels))
+    for key, arrival, departure, camera in sightings:
+        print(str(names.get(key, key)).rstrip() + ' : ' + str(arrival) + ' to ' + str(departure))
+
+    print('Done : ' + str(stats['frames_analyzed']) + ' frames analyzed, ' + str(stats['faces']) + ' faces (' + str(stats['known_faces']) + ' known), ' + str(len(sightings)) + ' sightings saved, ' + format(stats['seconds'], '.1f') + ' s (' + format(stats['frames_per_second'], '.1f') + ' frames/s, ' + format(stats['real_time'], '.1f') + 'x real time)')
+
+    return 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main(sys.argv))
@@ -0,0 +1,237 @@
+'''
+Created By : Christian Merriman
+
+Date : 1/22/2024
+
+Purpose : Keeps each person's visits (sightings) in memory, sorted by arrival, so showing a person's history only looks at
+their own visits, not every sighting we have. Visits are added as people leave.
+Follow the classes below for flow.
+
+'''
+import numpy as np
+import pandas as pd
+
+MIN_VISIT_CAPACITY = 8 #visits a person has room for before their arrays grow
+
+'''
+    to_datetime64 :
+    Returns times as a datetime64[us] array. Times can be datetime64 already, datetimes, or strings like older sightings
+    files have (with or without microseconds).
+'''
+def to_datetime64(times):
+    times = times.to_numpy() if isinstance(times, pd.Series) else np.asarray(times)
+
+    if np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[us]')
+
+    return pd.to_datetime(pd.Series(times, dtype=object), format='ISO8601').to_numpy().astype('datetime64[us]')
+
+'''
+    date_strings :
+    Returns datetime64 times as month-day-year strings (no leading zeros), all at once.
+'''
+def date_strings(times):
+    times = pd.Series(times)
+
+    return (times.dt.month.astype(str) + '-' + times.dt.day.astype(str) + '-' + times.dt.year.astype(str)).to_numpy()
+
+'''
+    time_strings :
+    Returns datetime64 times as hour:minute:second strings (no leading zeros), all at once.
+'''
+def time_strings(times):
+    times = pd.Series(times)
+
+    return (times.dt.hour.astype(str) + ':' + times.dt.minute.astype(str) + ':' + times.dt.second.astype(str)).to_numpy()
+
+'''
+    format_visits :
+    Returns the rows of our GUI's history table for these visits : (arrival date, arrival time, departure time, total
+    minutes) strings. Arrival dates get ' & ' and the departure date if they left on a later day. Each column is made for
+    every visit at once.
+'''
+def format_visits(visits):
+    arrival_dates = date_strings(visits.arrivals)
+    later_day = visits.arrivals.astype('datetime64[D]') < visits.departures.astype('datetime64[D]')
+    arrival_dates = np.where(later_day, arrival_dates + ' & ' + date_strings(visits.departures), arrival_dates)
+    minutes = np.char.mod('%.2f minutes.', visits.totals / 60.0)
+
+    return list(zip(arrival_dates.tolist(), time_strings(visits.arrivals).tolist(), time_strings(visits.departures).tolist(), minutes.tolist()))
+
+'''
+    class PersonVisits :
+    One person's visits as arrays sorted by arrival : arrivals, departures (datetime64[us]), totals (seconds) and cameras.
+    The arrays have room to grow, like our gallery matrix (see face_gallery.py), so adding a visit does not copy them.
+    Their first seen, last seen, visit count and total time are kept as visits are added.
+'''
+class PersonVisits:
+    def __init__(self, arrivals = (), departures = (), totals = (), cameras = ()):
+        arrivals = np.asarray(arrivals, dtype='datetime64[us]')
+        order = np.argsort(arrivals, kind='stable')
+
+        self.count = 0
+        self.resize(max(len(arrivals), MIN_VISIT_CAPACITY))
+        self.count = len(arrivals)
+        self.arrival_storage[:self.count] = arrivals[order]
+        self.departure_storage[:self.count] = np.asarray(departures, dtype='datetime64[us]')[order]
+        self.total_storage[:self.count] = np.asarray(totals, dtype=np.int64)[order]
+        self.camera_storage[:self.count] = np.asarray(cameras, dtype=np.int64)[order]
+
+        self.total_time = int(self.totals.sum()) #seconds seen over every visit
+        self.last_seen = self.departures.max() if self.count else None #latest departure
+
+    '''
+        resize :
+        Sets how many visits we have room for. Keeps the visits we already have.
+    '''
+    def resize(self, capacity):
+        count = getattr(self, 'count', 0)
+        arrival_storage = np.zeros(capacity, dtype='datetime64[us]')
+        departure_storage = np.zeros(capacity, dtype='datetime64[us]')
+        total_storage = np.zeros(capacity, dtype=np.int64)
+        camera_storage = np.zeros(capacity, dtype=np.int64)
+
+        if 'arrival_storage' in self.__dict__:
+            arrival_storage[:count] = self.arrival_storage[:count]
+            departure_storage[:count] = self.departure_storage[:count]
+            total_storage[:count] = self.total_storage[:count]
+            camera_storage[:count] = self.camera_storage[:count]
+
+        self.arrival_storage = arrival_storage
+        self.departure_storage = departure_storage
+        self.total_storage = total_storage
+        self.camera_storage = camera_storage
+
+    @property
+    def arrivals(self):
+        return self.arrival_storage[:self.count]
+
+    @property
+    def departures(self):
+        return self.departure_storage[:self.count]
+
+    @property
+    def totals(self):
+        return self.total_storage[:self.count]
+
+    @property
+    def cameras(self):
+        return self.camera_storage[:self.count]
+
+    '''
+        first_seen :
+        Arrival of our first visit (None if we have none).
+    '''
+    @property
+    def first_seen(self):
+        return self.arrivals[0] if self.count else None
+
+    def __len__(self):
+        return self.count
+
+    '''
+        latest :
+        Returns the position of our latest visit (latest arrival, the first of them if there is a tie). None if we have none.
+    '''
+    def latest(self):
+        return int(np.argmax(self.arrivals)) if self.count else None
+
+    '''
+        add :
+        Adds one visit. Visits usually come in arrival order and go on the end, older ones (ex: from a recorded video)
+        are moved into place.
+    '''
+    def add(self, arrival, departure, total, camera = 0):
+        if self.count == len(self.arrival_storage):
+            self.resize(2 * self.count)
+
+        arrival = np.datetime64(arrival, 'us')
+        departure = np.datetime64(departure, 'us')
+        position = self.count if self.count == 0 or arrival >= self.arrivals[-1] else int(np.searchsorted(self.arrivals, arrival, side='right'))
+
+        #make room
+        for storage in (self.arrival_storage, self.departure_storage, self.total_storage, self.camera_storage):
+            storage[position + 1:self.count + 1] = storage[position:self.count]
+
+        self.arrival_storage[position] = arrival
+        self.departure_storage[position] = departure
+        self.total_storage[position] = total
+        self.camera_storage[position] = camera
+        self.count += 1
+
+        self.total_time += int(total)
+        self.last_seen = departure if self.last_seen is None else max(self.last_seen, departure)
+
+'''
+    class VisitIndex :
+    The visits of each person, by UUID. build makes it from a sightings DataFrame (like df2) at once, add adds the visits
+    of people leaving.
+'''
+class VisitIndex:
+    def __init__(self):
+        self.people = {} #UUID -> PersonVisits
+
+    '''
+        build :
+        Makes our index from a sightings DataFrame indexed by UUID (any visits we had are dropped).
+    '''
+    def build(self, df2):
+        self.people = {}
+
+        if len(df2) == 0:
+            return
+
+        ids = np.asarray(df2.index, dtype=object).astype(str)
+        arrivals = to_datetime64(df2['Arrival Time'])
+        departures = to_datetime64(df2['Departure Time'])
+        totals = df2['Total Time'].to_numpy(dtype=np.int64)
+        cameras = df2['Camera'].fillna(0).to_numpy(dtype=np.int64) if 'Camera' in df2.columns else np.zeros(len(df2), dtype=np.int64)
+
+        #group by person, each group by arrival
+        order = np.lexsort((arrivals, ids))
+        ids = ids[order]
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        ends = np.append(starts[1:], len(ids))
+
+        for start, end in zip(starts, ends):
+            rows = order[start:end]
+            self.people[ids[start]] = PersonVisits(arrivals[rows], departures[rows], totals[rows], cameras[rows])
+
+    '''
+        load :
+        Sets the visits of one person from a DataFrame of only their sightings (it can be empty).
+    '''
+    def load(self, id, df):
+        if len(df) == 0:
+            self.people[id] = PersonVisits()
+            return
+
+        cameras = df['Camera'].fillna(0) if 'Camera' in df.columns else np.zeros(len(df))
+        self.people[id] = PersonVisits(to_datetime64(df['Arrival Time']), to_datetime64(df['Departure Time']), df['Total Time'], cameras)
+
+    '''
+        add :
+        Adds one visit of a person.
+    '''
+    def add(self, id, arrival, departure, total, camera = 0):
+        if id not in self.people:
+            self.people[id] = PersonVisits()
+
+        self.people[id].add(arrival, departure, total, camera)
+
+    '''
+        get :
+        Returns this person's PersonVisits, or None if we have none for them.
+    '''
+    def get(self, id):
+        return self.people.get(id)
+
+    '''
+        remove :
+        Drops the visits of this person.
+    '''
+    def remove(self, id):
+        self.people.pop(id, None)
+
+    def __contains__(self, id):
+        return id in self.people